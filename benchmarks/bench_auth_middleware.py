@@ -0,0 +1,139 @@
+"""
+Microbenchmark: AuthMiddleware before/after the pure-ASGI rewrite.
+
+before: ContextMiddleware(RequestIdPlugin, CorrelationIdPlugin) -> Request-based AuthMiddleware
+after:  fused pure-ASGI AuthMiddleware
+
+    python -m benchmarks.bench_auth_middleware [n_requests]
+
+Run from the repository root.
+"""
+import asyncio
+import configparser
+import sys
+import time
+
+from jwt.exceptions import InvalidSignatureError
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette_context import ctx, plugins
+from starlette_context.middleware import ContextMiddleware
+
+from reddwarf.middlewares import AuthMiddleware
+from reddwarf.services.config_service import BaseConfig
+from reddwarf.utils.auth import authenticate_token, create_token
+
+
+class LegacyAuthMiddleware:
+    """AuthMiddleware as it was before the pure-ASGI rewrite"""
+    def __init__(self, app, no_auth_routes=None):
+        self.app = app
+        self.no_auth_routes = no_auth_routes if no_auth_routes else []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        if request.url.path in self.no_auth_routes:
+            await self.app(scope, receive, send)
+            return
+
+        auth_header = request.headers.get('authorization')
+        if not auth_header:
+            res = JSONResponse({"auth": "invalid"})
+            await res(scope, receive, send)
+            return
+
+        match auth_header.split(" "):
+            case "Bearer", bearer_token:
+                try:
+                    user = authenticate_token(bearer_token)
+                except InvalidSignatureError:
+                    response = JSONResponse({"auth": "invalid"}, status_code=403)
+                    await response(scope, receive, send)
+                    return
+                if user is None:
+                    response = JSONResponse({"auth": "invalid"}, status_code=403)
+                    await response(scope, receive, send)
+                    return
+                for k, v in user.items():
+                    ctx.context.setdefault(k, v)
+                await self.app(scope, receive, send)
+            case _:
+                res = JSONResponse({"auth": "invalid"})
+                await res(scope, receive, send)
+                return
+
+
+async def endpoint(scope, receive, send):
+    assert ctx.context.data['username'] == 'bench'
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': b'{}'})
+
+
+def build_before():
+    return ContextMiddleware(
+        app=LegacyAuthMiddleware(endpoint, no_auth_routes=['/rpc/login']),
+        plugins=(plugins.RequestIdPlugin(), plugins.CorrelationIdPlugin()),
+    )
+
+
+def build_after():
+    return AuthMiddleware(endpoint, no_auth_routes=['/rpc/login'])
+
+
+def make_scope(token):
+    return {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'POST', 'scheme': 'http', 'path': '/rpc/echo', 'raw_path': b'/rpc/echo',
+        'query_string': b'', 'root_path': '', 'server': ('127.0.0.1', 8000), 'client': ('127.0.0.1', 50000),
+        'headers': [
+            (b'host', b'127.0.0.1:8000'),
+            (b'content-type', b'application/json'),
+            (b'authorization', f'Bearer {token}'.encode()),
+        ],
+    }
+
+
+def make_receive():
+    """the request body once, then waits like a client that is still connected"""
+    messages = [{'type': 'http.request', 'body': b'{}', 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+    return receive
+
+
+async def drive(app, scope, n):
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(n):
+        await app(dict(scope), make_receive(), send)
+    return n / (time.perf_counter() - started)
+
+
+def main(n=20000):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'DEFAULT': {'secret': 'bench-secret'},
+        'MySQL': {'db_host': '127.0.0.1', 'db_user': 'bench', 'db_password': 'bench', 'db_name': 'bench'},
+        'Redis': {'db_host': '127.0.0.1'},
+    })
+    BaseConfig().apply(config)
+    scope = make_scope(create_token({'username': 'bench'}))
+
+    loop = asyncio.new_event_loop()
+    before = loop.run_until_complete(drive(build_before(), scope, n))
+    after = loop.run_until_complete(drive(build_after(), scope, n))
+    print(f"before: {before:>10.0f} req/s")
+    print(f"after:  {after:>10.0f} req/s  ({after / before:.2f}x)")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
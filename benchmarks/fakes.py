@@ -0,0 +1,192 @@
+"""
+In-memory stand-ins for the services RedDwarf talks to, only the calls RedDwarf makes are implemented.
+They answer without any I/O so the benchmarks time RedDwarf itself.
+"""
+import asyncio
+import datetime
+import decimal
+
+
+def make_rows(n, cols=8) -> tuple[tuple, list[tuple]]:
+    """(cursor description, rows) shaped like a typical orders table"""
+    names = ['id', 'user_id', 'status', 'amount', 'currency', 'created_at', 'note', 'flags'][:cols]
+    description = tuple((name, None, None, None, None, None, None) for name in names)
+    created = datetime.datetime(2022, 11, 1, 12, 0, 0)
+    rows = [
+        (i, i % 97, 'paid' if i % 3 else 'shipped', decimal.Decimal(f'{i}.50'), 'EUR',
+         created, f'order {i}', i & 7)[:cols]
+        for i in range(n)
+    ]
+    return description, rows
+
+
+class FakeCursor:
+    def __init__(self, description, rows):
+        self.description = None
+        self._result_description = description
+        self._rows = rows
+        self._position = 0
+        self.max_stmt_length = 1024000
+        self.rowcount = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, params=None):
+        self.description = self._result_description
+        self._position = 0
+        self.rowcount = len(self._rows)
+        return self.rowcount
+
+    async def executemany(self, sql, params):
+        self.rowcount = len(params)
+        return self.rowcount
+
+    async def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    async def fetchmany(self, size):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+
+class FakeConnection:
+    """aiomysql.Connection, every query returns the same result set"""
+    def __init__(self, description, rows):
+        self._description = description
+        self._rows = rows
+
+    def cursor(self, *cursor_class):
+        return FakeCursor(self._description, self._rows)
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+    async def ping(self, reconnect=False):
+        pass
+
+
+class FakeMySQLPool:
+    """aiomysql.Pool, installed as MySQLPool._pool"""
+    def __init__(self, description, rows, maxsize=10):
+        self.minsize = 1
+        self.maxsize = maxsize
+        self._free = asyncio.Queue()
+        for _ in range(maxsize):
+            self._free.put_nowait(FakeConnection(description, rows))
+
+    @property
+    def size(self):
+        return self.maxsize
+
+    @property
+    def freesize(self):
+        return self._free.qsize()
+
+    async def acquire(self):
+        return await self._free.get()
+
+    def release(self, conn):
+        self._free.put_nowait(conn)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        return [await method(*args, **kwargs) for method, args, kwargs in self._commands]
+
+
+class FakeRedis:
+    """aioredis.Redis with decode_responses=True, dict backed, expiry ignored"""
+    def __init__(self):
+        self._data = {}
+        self.published = 0
+
+    async def get(self, key):
+        return self._data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self._data[key] = value.decode() if isinstance(value, bytes) else value
+        return True
+
+    async def sadd(self, key, *members):
+        self._data.setdefault(key, set()).update(members)
+        return len(members)
+
+    async def smembers(self, key):
+        return set(self._data.get(key, ()))
+
+    async def expire(self, key, seconds):
+        return key in self._data
+
+    async def delete(self, *keys):
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def publish(self, channel, message):
+        self.published += 1
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def close(self):
+        pass
+
+
+class FakeWebSocket:
+    """counts what the WSConnectionManager sender task writes to it"""
+    def __init__(self, on_message=None):
+        self.received = 0
+        self._on_message = on_message
+
+    async def send_text(self, text):
+        self.received += 1
+        if self._on_message is not None:
+            self._on_message()
+
+    async def send_json(self, data):
+        await self.send_text(data)
+
+    async def close(self, code=1000, reason=None):
+        pass
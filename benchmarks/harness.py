@@ -0,0 +1,126 @@
+"""
+Measurement, baselines and regression reports for the benchmark suite.
+
+A benchmark is an async callable doing one operation, it is warmed up then timed
+one call at a time so latency percentiles come with the throughput.
+"""
+import json
+import os
+import platform
+import time
+
+
+def percentile(sorted_values: list, q: float):
+    """nearest rank percentile, q in [0, 100]"""
+    if not sorted_values:
+        return 0
+    rank = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class BenchResult:
+    __slots__ = ('name', 'n', 'ops', 'mean', 'p50', 'p90', 'p99', 'max')
+
+    def __init__(self, name, latencies_ns: list[int], elapsed: float):
+        latencies_ns.sort()
+        self.name = name
+        self.n = len(latencies_ns)
+        self.ops = self.n / elapsed if elapsed else 0.0
+        # microseconds
+        self.mean = sum(latencies_ns) / self.n / 1000 if self.n else 0.0
+        self.p50 = percentile(latencies_ns, 50) / 1000
+        self.p90 = percentile(latencies_ns, 90) / 1000
+        self.p99 = percentile(latencies_ns, 99) / 1000
+        self.max = latencies_ns[-1] / 1000 if latencies_ns else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'n': self.n, 'ops': round(self.ops, 1), 'mean_us': round(self.mean, 2),
+            'p50_us': round(self.p50, 2), 'p90_us': round(self.p90, 2),
+            'p99_us': round(self.p99, 2), 'max_us': round(self.max, 2),
+        }
+
+    def __str__(self):
+        return (
+            f"{self.name:<32} {self.ops:>12.0f} ops/s  "
+            f"p50 {self.p50:>9.1f}us  p90 {self.p90:>9.1f}us  p99 {self.p99:>9.1f}us"
+        )
+
+
+async def measure(name, op, n: int, warmup: int = None, rounds: int = 3) -> BenchResult:
+    """
+    runs `await op()` warmup times untimed, then rounds rounds of n timed calls,
+    the round with the lowest median is kept (like timeit) so background noise does not read as a regression
+    """
+    for _ in range(n // 10 if warmup is None else warmup):
+        await op()
+    perf_counter_ns = time.perf_counter_ns
+    best = None
+    for _ in range(rounds):
+        latencies = [0] * n
+        started = time.perf_counter()
+        for i in range(n):
+            t = perf_counter_ns()
+            await op()
+            latencies[i] = perf_counter_ns() - t
+        result = BenchResult(name, latencies, time.perf_counter() - started)
+        if best is None or result.p50 < best.p50:
+            best = result
+    return best
+
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def load_baseline(path) -> dict | None:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results: list[BenchResult]):
+    """merges into the existing file so a filtered run only replaces its own entries"""
+    baseline = load_baseline(path) or {'results': {}}
+    baseline['environment'] = environment()
+    baseline['results'].update({result.name: result.as_dict() for result in results})
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results: list[BenchResult], baseline: dict, threshold: float) -> tuple[str, list[str]]:
+    """
+    median latency and throughput of every result against the baseline, a benchmark regressed
+    when its p50 grew by more than threshold (0.1 = 10%), the median is the least noisy of the numbers
+    return: (report, names of regressed benchmarks)
+    """
+    lines = [
+        f"baseline: {baseline.get('environment')}",
+        f"current:  {environment()}",
+        '',
+        f"{'benchmark':<32} {'base p50':>10} {'p50':>10} {'change':>8} {'base ops/s':>12} {'ops/s':>12}",
+    ]
+    regressed = []
+    for result in results:
+        base = baseline['results'].get(result.name)
+        if base is None:
+            lines.append(f"{result.name:<32} {'-':>10} {result.p50:>9.1f}u {'new':>8} {'-':>12} {result.ops:>12.0f}")
+            continue
+        change = result.p50 / base['p50_us'] - 1 if base['p50_us'] else 0.0
+        flag = ''
+        if change > threshold:
+            regressed.append(result.name)
+            flag = '  REGRESSION'
+        lines.append(
+            f"{result.name:<32} {base['p50_us']:>9.1f}u {result.p50:>9.1f}u {change:>+8.1%} "
+            f"{base['ops']:>12.0f} {result.ops:>12.0f}{flag}"
+        )
+    return '\n'.join(lines), regressed
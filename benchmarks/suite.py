@@ -0,0 +1,374 @@
+"""
+Benchmark suite for the RedDwarf hot paths.
+
+The app is driven in-process through ASGI calls, no sockets; MySQL and Redis are the
+in-memory stand-ins from benchmarks/fakes.py, so numbers measure RedDwarf and not the network.
+
+    python -m benchmarks.suite                     run everything, print results
+    python -m benchmarks.suite --compare           also compare against benchmarks/baselines.json,
+                                                   exits 1 when a median latency grew more than --threshold
+    python -m benchmarks.suite --save              store the results as the new baseline
+    python -m benchmarks.suite -k rpc -n 5000      only benchmarks whose name contains "rpc"
+
+Run from the repository root. Baselines are only comparable on the same machine and Python,
+the stored environment is printed with the report.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+import pydantic
+
+from benchmarks.fakes import FakeMySQLPool, FakeRedis, FakeWebSocket, make_rows
+from benchmarks.harness import compare, load_baseline, measure, save_baseline
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+BENCH_CONFIG = """
+[DEFAULT]
+host = 127.0.0.1
+port = 8000
+rpc_prefix = /rpc
+ws_prefix = /ws
+log_file = {log_file}
+; the RPC call log is level 10, keep it out of the numbers
+log_level = 20
+secret = bench-secret
+
+[MySQL]
+db_host = 127.0.0.1
+db_port = 3306
+db_user = bench
+db_password = bench
+db_name = bench
+
+[Redis]
+db_host = 127.0.0.1
+db_password = bench
+"""
+
+_benchmarks = []
+
+
+def benchmark(name, n=None):
+    """registers `async def setup(ctx) -> op`, op is the coroutine function timed n times"""
+    def register(setup):
+        _benchmarks.append((name, n, setup))
+        return setup
+    return register
+
+
+class BenchContext:
+    """one RedDwarf app with fake services, shared by every benchmark of a run"""
+    def __init__(self):
+        self._tmp = tempfile.TemporaryDirectory(prefix='reddwarf-bench-')
+        with open(os.path.join(self._tmp.name, 'config-bench.ini'), 'w') as f:
+            f.write(BENCH_CONFIG.format(log_file=os.path.join(self._tmp.name, 'bench.log')))
+        cwd = os.getcwd()
+        os.environ['ENV'] = 'bench'
+        os.chdir(self._tmp.name)
+        try:
+            self._build()
+        finally:
+            os.chdir(cwd)
+
+    def _build(self):
+        from reddwarf.server import RedDwarf
+        from reddwarf.services.mysql_service import MySQLPool, select_many
+        from reddwarf.utils.auth import create_token
+
+        pool = MySQLPool()
+        self.orders_description, self.orders = make_rows(50)
+
+        async def echo(message: str, n: int = 0):
+            return {"message": message, "n": n}
+
+        class OrderQuery(pydantic.BaseModel):
+            user_id: int
+            status: list[str] = ['paid', 'shipped']
+            limit: int = 50
+
+        async def list_orders(query: OrderQuery):
+            async with pool.acquire() as dbc:
+                return await select_many(
+                    dbc, 'orders', where={'user_id': query.user_id, 'status': query.status}, limit=query.limit
+                )
+
+        async def ping():
+            return {"pong": True}
+
+        self.server = RedDwarf(routes=[echo, list_orders], ws_routes=[], no_auth_routes=[ping])
+        self.loop = self.server._loop
+        self.app = self.server._app
+        self.pool = pool
+        self.token = create_token({'username': 'bench'})
+        self.loop.run_until_complete(self._start_services())
+
+    async def _start_services(self):
+        await self.pool.create_mysql_pool(
+            host='127.0.0.1', port=3306, user='bench', password='bench', db='bench',
+            loop=asyncio.get_running_loop(), acquire_timeout=5, lazy=True,
+        )
+        self.pool._pool = FakeMySQLPool(self.orders_description, self.orders)
+        self.server._ws_connection.initialize(max_clients=100_000, send_queue_size=256)
+
+    def request(self, path, body: bytes, token=True, app=None):
+        """async () -> status, one POST through the ASGI app (the RedDwarf app by default) per call"""
+        headers = [(b'host', b'127.0.0.1:8000'), (b'content-type', b'application/json')]
+        if token:
+            headers.append((b'authorization', f'Bearer {self.token}'.encode()))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'POST', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+            'query_string': b'', 'root_path': '', 'server': ('127.0.0.1', 8000),
+            'client': ('127.0.0.1', 50000), 'headers': headers,
+        }
+        message = {'type': 'http.request', 'body': body, 'more_body': False}
+        app = app or self.app
+
+        async def call():
+            status = None
+
+            async def receive():
+                return message
+
+            async def send(sent):
+                nonlocal status
+                if sent['type'] == 'http.response.start':
+                    status = sent['status']
+
+            await app(dict(scope), receive, send)
+            return status
+        return call
+
+    def close(self):
+        self.loop.run_until_complete(self.server.get_ws_connection_manager().close_all())
+        self.server.get_logger().shutdown()
+        self._tmp.cleanup()
+
+
+async def _expect_ok(call):
+    status = await call()
+    if status not in (200, 204):
+        raise RuntimeError(f"benchmark request answered {status}")
+    return call
+
+
+@benchmark('rpc_dispatch_no_auth')
+async def bench_rpc_no_auth(ctx: BenchContext):
+    return await _expect_ok(ctx.request('/rpc/ping', b'', token=False))
+
+
+@benchmark('rpc_dispatch_auth')
+async def bench_rpc_auth(ctx: BenchContext):
+    return await _expect_ok(ctx.request('/rpc/echo', b'{"message":"hello","n":3}'))
+
+
+@benchmark('rpc_select_many_50_rows')
+async def bench_rpc_select_many(ctx: BenchContext):
+    return await _expect_ok(ctx.request('/rpc/list_orders', b'{"user_id":42}'))
+
+
+@benchmark('rpc_jsonrpc_batch_10')
+async def bench_rpc_batch(ctx: BenchContext):
+    from reddwarf.utils import codec
+    body = codec.dumps([
+        {"jsonrpc": "2.0", "method": "echo", "params": {"message": "hello", "n": i}, "id": i}
+        for i in range(10)
+    ])
+    return await _expect_ok(ctx.request('/rpc', body))
+
+
+@benchmark('auth_middleware_valid_token')
+async def bench_auth_middleware(ctx: BenchContext):
+    from reddwarf.middlewares import AuthMiddleware
+
+    async def endpoint(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+
+    middleware = AuthMiddleware(endpoint, no_auth_routes=['/rpc/ping'])
+    return await _expect_ok(ctx.request('/rpc/echo', b'{}', app=middleware))
+
+
+ORDERS_WHERE = {
+    'user_id': 42,
+    'status': ['paid', 'shipped', 'refunded'],
+    'amount': {'>=': 10, '<': 1000},
+    'note': {'regexp': '^order'},
+    'currency': 'EUR',
+}
+
+
+@benchmark('build_select_query')
+async def bench_build_select_query(ctx: BenchContext):
+    from reddwarf.utils.sql import build_select_query
+
+    async def op():
+        build_select_query(
+            'orders', cols=['id', 'user_id', 'amount', {'aggr': 'count', 'col': 'flags'}],
+            where=ORDERS_WHERE, group_by=['id', 'user_id', 'amount'],
+            order_by=[('created_at', 'DESC'), 'id'], limit=50, offset=100,
+        )
+    return op
+
+
+@benchmark('compile_select_query')
+async def bench_compile_select_query(ctx: BenchContext):
+    from reddwarf.utils.sql import compile_select_query
+
+    async def op():
+        compile_select_query(
+            'orders', cols=['id', 'user_id', 'amount'], where=ORDERS_WHERE,
+            order_by=[('created_at', 'DESC'), 'id'], after=['2022-11-01 12:00:00', 100], limit=50,
+        )
+    return op
+
+
+@benchmark('build_where')
+async def bench_build_where(ctx: BenchContext):
+    from reddwarf.utils.sql import SQLDialect, build_where
+
+    async def op():
+        build_where(ORDERS_WHERE, dialect=SQLDialect.MySQL)
+    return op
+
+
+def _select_many_bench(row_format):
+    async def setup(ctx: BenchContext):
+        from benchmarks.fakes import FakeConnection
+        from reddwarf.services.mysql_service import select_many
+        description, rows = make_rows(1000)
+        dbc = FakeConnection(description, rows)
+
+        async def op():
+            await select_many(dbc, 'orders', where={'user_id': 42}, row_format=row_format)
+        return op
+    return setup
+
+
+for _row_format in ('dict', 'tuple', 'named', 'columns'):
+    benchmark(f'select_many_1000_rows_{_row_format}', n=2000)(_select_many_bench(_row_format))
+
+
+@benchmark('select_many_cached_hit', n=20000)
+async def bench_select_many_cached(ctx: BenchContext):
+    from benchmarks.fakes import FakeConnection
+    from reddwarf.services.cache_service import QueryCache
+    from reddwarf.services.mysql_service import select_many
+    description, rows = make_rows(50)
+    dbc = FakeConnection(description, rows)
+    cache = QueryCache()
+    cache.initialize(redis=FakeRedis(), l1_size=1024, l1_ttl=60)
+
+    async def op():
+        await select_many(dbc, 'orders', where={'user_id': 42}, cache_ttl=60)
+    return op
+
+
+@benchmark('escape_in_20000_ints', n=500)
+async def bench_escape_in_list(ctx: BenchContext):
+    """compiling plus the driver escaping the params, what aiomysql does before sending"""
+    import pymysql.converters
+    from reddwarf.utils.sql import compile_select_query
+    ids = list(range(20000))
+
+    async def op():
+        sql, params = compile_select_query('orders', where={'id': ids, 'currency': 'EUR'})
+        sql % {k: pymysql.converters.escape_item(v, 'utf8mb4', pymysql.converters.encoders) for k, v in params.items()}
+    return op
+
+
+@benchmark('select_many_in_20000_ids', n=500)
+async def bench_select_many_in(ctx: BenchContext):
+    from reddwarf.services.mysql_service import select_many_in
+    ids = list(range(20000))
+
+    async def op():
+        await select_many_in(ctx.pool, 'orders', 'id', ids, where={'currency': 'EUR'})
+    return op
+
+
+def _broadcast_bench(clients):
+    async def setup(ctx: BenchContext):
+        manager = ctx.server.get_ws_connection_manager()
+        for connection_id in manager.get_all_connection_ids():
+            manager.unregister_connection(connection_id)
+        done = asyncio.Event()
+        pending = 0
+
+        def delivered():
+            nonlocal pending
+            pending -= 1
+            if pending == 0:
+                done.set()
+
+        for i in range(clients):
+            manager.register_connection(f"user{i}::feed", FakeWebSocket(delivered))
+        payload = {"topic": "prices", "data": {"symbol": "RDW", "price": 42.5, "volume": 1200}}
+
+        async def op():
+            nonlocal pending
+            done.clear()
+            pending = clients
+            manager.broadcast(payload, endpoint='feed')
+            await done.wait()
+        return op
+    return setup
+
+
+for _clients in (100, 1000):
+    benchmark(f'ws_broadcast_{_clients}_clients', n=500)(_broadcast_bench(_clients))
+
+
+def run(names_filter=None, n=None, rounds=3) -> list:
+    ctx = BenchContext()
+    results = []
+    try:
+        for name, default_n, setup in _benchmarks:
+            if names_filter and names_filter not in name:
+                continue
+            op = ctx.loop.run_until_complete(setup(ctx))
+            result = ctx.loop.run_until_complete(measure(name, op, n or default_n or 10000, rounds=rounds))
+            print(result)
+            results.append(result)
+    finally:
+        ctx.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('-n', type=int, help='iterations per benchmark, overrides the defaults')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='timed rounds per benchmark, the best is kept')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare against the baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=0.15, help='allowed median latency growth, 0.15 = 15%%')
+    args = parser.parse_args(argv)
+
+    results = run(args.filter, args.n, args.rounds)
+    status = 0
+    if args.compare:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            print(f"no baseline at {args.baseline}, run with --save first")
+            status = 2
+        else:
+            report, regressed = compare(results, baseline, args.threshold)
+            print()
+            print(report)
+            if regressed:
+                print(f"\n{len(regressed)} regression(s) over {args.threshold:.0%}: {', '.join(regressed)}")
+                status = 1
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"baseline written to {args.baseline}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+from typing import Any, AsyncIterator
+
+from starlette.responses import JSONResponse, StreamingResponse
+
+from reddwarf.utils import codec
+
+
+class RPCResponse(JSONResponse):
+    """JSONResponse rendered with the configured fast JSON codec"""
+
+    def render(self, content: Any) -> bytes:
+        return codec.dumps(content)
+
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+async def encode_json_array(rows: AsyncIterator, chunk_size=STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """encodes rows as one JSON array, yielded in chunks of roughly chunk_size bytes"""
+    buffer = bytearray(b'[')
+    first = True
+    async for row in rows:
+        if not first:
+            buffer += b','
+        first = False
+        buffer += codec.dumps(row)
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b']'
+    yield bytes(buffer)
+
+
+async def encode_ndjson(rows: AsyncIterator, chunk_size=STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """encodes rows as newline delimited JSON, yielded in chunks of roughly chunk_size bytes"""
+    buffer = bytearray()
+    async for row in rows:
+        buffer += codec.dumps(row)
+        buffer += b'\n'
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class RPCStreamingResponse(StreamingResponse):
+    """
+    Streams the rows of an async iterator with bounded memory,
+    as NDJSON when the client accepts application/x-ndjson, as a chunked JSON array otherwise
+    """
+    def __init__(self, rows: AsyncIterator, ndjson=False, status_code=200, headers=None):
+        if ndjson:
+            super().__init__(encode_ndjson(rows), status_code, headers, media_type=NDJSON_MEDIA_TYPE)
+        else:
+            super().__init__(encode_json_array(rows), status_code, headers, media_type='application/json')
+
+    @staticmethod
+    def wants_ndjson(request) -> bool:
+        return NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
@@ -1,26 +1,29 @@
-import json
+import asyncio
 from typing import Any
-from uuid import uuid4
 
 from starlette.endpoints import WebSocketEndpoint
 from starlette.websockets import WebSocket
+from starlette_context import request_cycle_context
 
-from reddwarf.exceptions import InvalidCredential
+from reddwarf.exceptions import InvalidCredential, TooManyConnections
+from reddwarf.utils import codec
 from reddwarf.utils.auth import authenticate_token
+from reddwarf.utils.rpc import PARSE_ERROR, RPCDispatcher, rpc_error, rpc_notification
 
+from reddwarf.services.logger_service import BaseLogger
 from reddwarf.services.websocket_service import WSConnectionManager
 
 
 connection_manager = WSConnectionManager()
+logger = BaseLogger()
 
 
 class BaseWebsocketHandler(WebSocketEndpoint):
-    encoding: 'json'
-
     def __init__(self, scope, receive, send) -> None:
         super().__init__(scope, receive, send)
         self.authenticated = False
         self.user: dict = {}
+        self.connection_id: str | None = None
 
     @staticmethod
     def get_endpoint():
@@ -29,40 +32,185 @@ class BaseWebsocketHandler(WebSocketEndpoint):
     async def on_connect(self, websocket: WebSocket):
         await websocket.accept()
 
-    async def on_receive(self, websocket: WebSocket, data: Any) -> None:
-        if not self.authenticated:
-            # try:
-            print(data)
-            auth_data = json.loads(data.strip())
-            print(auth_data)
-            try:
-                match auth_data:
-                    case {"token": str(token)}:
-                        print(f"token -> {token}")
-                        auth_user = authenticate_token(token)
-                        if auth_user is None:
-                            raise InvalidCredential
-                        self.authenticated = True
-                        self.user = auth_user
-                        connection_manager.register_connection(
-                            f"{auth_user['username']}::{self.get_endpoint()}", websocket
-                        )
-                        print(connection_manager.get_all_connections())
-                        await websocket.send_json({"status": "success"})
-                        return
-                    case _:
+    async def authenticate(self, websocket: WebSocket, data: Any) -> bool:
+        """the first frame of a connection must be {"token": ...}"""
+        try:
+            match codec.loads(data.strip()):
+                case {"token": str(token)}:
+                    auth_user = authenticate_token(token)
+                    if auth_user is None:
                         raise InvalidCredential
+                case _:
+                    raise InvalidCredential
+        except (ValueError, InvalidCredential):
+            logger.log(10, '[INFO] websocket %s authentication failed', self.get_endpoint())
+            await websocket.send_json({"error": "not authenticated"})
+            return False
+
+        connection_id = f"{auth_user['username']}::{self.get_endpoint()}"
+        try:
+            connection_manager.register_connection(connection_id, websocket)
+        except TooManyConnections:
+            await websocket.send_json({"error": "too many connections"})
+            await websocket.close(code=1013)
+            return False
+        self.authenticated = True
+        self.user = auth_user
+        self.connection_id = connection_id
+        logger.log(10, '[INFO] websocket %s authenticated', connection_id)
+        await websocket.send_json({"status": "success"})
+        return True
 
-            except (json.decoder.JSONDecodeError, InvalidCredential):
-                await websocket.send_json({"error": "not authenticated"})
-                print('no auth')
-                return
-        print("auth success")
+    async def on_receive(self, websocket: WebSocket, data: Any) -> None:
+        if not self.authenticated:
+            await self.authenticate(websocket, data)
+            return
         await websocket.send_json(await self.handle_received_message(data))
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
-        print("client disconnected")
+        logger.log(10, '[INFO] websocket %s disconnected with %s', self.connection_id, close_code)
+        # the id may have been taken over by a newer socket of the same user
+        if self.connection_id is not None and connection_manager.get_connection(self.connection_id) is websocket:
+            connection_manager.unregister_connection(self.connection_id)
         await websocket.close(code=0, reason=None)
 
     async def handle_received_message(self, data: Any):
         raise NotImplementedError()
+
+
+class ConcurrentWebsocketHandler(BaseWebsocketHandler):
+    """
+    Handles the frames of one socket concurrently instead of one after another.
+    Frames are decoded with the JSON codec and handled in their own task, at most
+    max_in_flight at a time per connection. When every slot is taken the socket
+    is not read until one frees up, so a fast sender is slowed down by TCP instead of
+    piling up tasks. Replies are sent as each handler finishes and may be out of order,
+    handlers that need to correlate them should echo an id from the message.
+
+    batch_size > 1 collects decoded messages into lists of up to batch_size, a partial
+    batch is handed over after batch_delay seconds. Batches go to handle_batch and
+    take one slot each.
+    """
+    max_in_flight = 16
+    batch_size = 1
+    batch_delay = 0.005
+    # reply to frames that are not valid JSON
+    invalid_message = {"error": "invalid message"}
+
+    def __init__(self, scope, receive, send) -> None:
+        super().__init__(scope, receive, send)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._tasks: set[asyncio.Task] = set()
+        self._batch: list = []
+        self._batch_timer: asyncio.TimerHandle | None = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def on_receive(self, websocket: WebSocket, data: Any) -> None:
+        if not self.authenticated:
+            await self.authenticate(websocket, data)
+            return
+        try:
+            message = codec.loads(data)
+        except ValueError:
+            await websocket.send_json(self.invalid_message)
+            return
+
+        if self.batch_size <= 1:
+            await self._slots.acquire()
+            self._spawn(websocket, self.handle_received_message(message))
+            return
+
+        self._batch.append(message)
+        if len(self._batch) >= self.batch_size:
+            await self._flush_batch(websocket)
+        elif self._batch_timer is None:
+            self._batch_timer = asyncio.get_running_loop().call_later(
+                self.batch_delay, self._flush_batch_later, websocket
+            )
+
+    def _flush_batch_later(self, websocket: WebSocket):
+        task = asyncio.get_running_loop().create_task(self._flush_batch(websocket))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_batch(self, websocket: WebSocket):
+        # the timer stays set while a flush waits for a slot, so at most one partial batch is pending
+        await self._slots.acquire()
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            self._slots.release()
+            return
+        self._spawn(websocket, self.handle_batch(batch))
+
+    def _spawn(self, websocket: WebSocket, handler):
+        """the caller holds a slot, the task releases it"""
+        task = asyncio.get_running_loop().create_task(self._run(websocket, handler))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, websocket: WebSocket, handler):
+        try:
+            result = await handler
+            if result is not None:
+                await websocket.send_text(codec.dumps(result).decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.log(40, '[ERROR] websocket %s handler failed: %s', self.connection_id, e)
+            try:
+                await websocket.send_json({"error": "internal error"})
+            except Exception:
+                pass
+        finally:
+            self._slots.release()
+
+    async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        self._batch = []
+        for task in list(self._tasks):
+            task.cancel()
+        await super().on_disconnect(websocket, close_code)
+
+    async def handle_batch(self, messages: list):
+        """called with up to batch_size decoded messages, by default handles them one by one"""
+        return [await self.handle_received_message(message) for message in messages]
+
+
+class RPCWebsocketHandler(ConcurrentWebsocketHandler):
+    """
+    JSON-RPC 2.0 over one authenticated socket, calling the same registered RPCs as the HTTP routes.
+    Every frame is a call or a batch, calls run concurrently and are answered as they finish,
+    matched by their id. The server pushes with push_notification().
+    RedDwarf creates the concrete handler with its dispatcher when ws_rpc_endpoint is set.
+    """
+    dispatcher: RPCDispatcher = None
+    endpoint = 'rpc'
+    invalid_message = rpc_error(PARSE_ERROR, "parse error")
+
+    @classmethod
+    def get_endpoint(cls):
+        return cls.endpoint
+
+    @classmethod
+    def create(cls, dispatcher: RPCDispatcher, endpoint='rpc', max_in_flight=16) -> type['RPCWebsocketHandler']:
+        return type(cls.__name__, (cls,), {
+            'dispatcher': dispatcher, 'endpoint': endpoint, 'max_in_flight': max_in_flight,
+        })
+
+    async def handle_received_message(self, message):
+        # RPCs read the user from the request context like they do over HTTP
+        with request_cycle_context(dict(self.user)):
+            return await self.dispatcher.dispatch(message)
+
+
+def push_notification(user: str, method: str, params=None, endpoint='rpc') -> bool:
+    """pushes a JSON-RPC notification to user's RPC socket, through the backplane when it runs"""
+    return connection_manager.deliver(f"{user}::{endpoint}", rpc_notification(method, params))
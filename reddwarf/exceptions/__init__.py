@@ -4,3 +4,7 @@ class CallRegisterException(Exception):
 
 class InvalidCredential(BaseException):
     """when u are not authenticated"""
+
+
+class TooManyConnections(Exception):
+    """websocket connection limit reached"""
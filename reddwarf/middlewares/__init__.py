@@ -1,49 +1,144 @@
-from jwt.exceptions import InvalidSignatureError
-from starlette.requests import Request
-from starlette.responses import JSONResponse
-from starlette_context import ctx
+from uuid import UUID, uuid4
+
+from jwt.exceptions import InvalidTokenError
+from starlette_context import request_cycle_context
 
-# from reddwarf.server import APP_SECRET
 from reddwarf.utils.auth import authenticate_token
+from reddwarf.utils.metrics import registry
+
+REQUEST_ID_KEY = 'X-Request-ID'
+CORRELATION_ID_KEY = 'X-Correlation-ID'
+
+_AUTHORIZATION = b'authorization'
+_REQUEST_ID = REQUEST_ID_KEY.lower().encode('latin-1')
+_CORRELATION_ID = CORRELATION_ID_KEY.lower().encode('latin-1')
+
+
+def _raw_response(status: int, body: bytes) -> tuple[dict, dict]:
+    return (
+        {
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin-1')),
+            ],
+        },
+        {'type': 'http.response.body', 'body': body},
+    )
+
+
+auth_seconds = registry.histogram('reddwarf_auth_seconds', 'AuthMiddleware token check time').labels()
+auth_rejected = registry.counter('reddwarf_auth_rejected_total', 'requests refused by AuthMiddleware', ('reason',))
+_auth_missing = auth_rejected.labels('missing')
+_auth_forbidden = auth_rejected.labels('forbidden')
+
+AUTH_INVALID = _raw_response(200, b'{"auth":"invalid"}')
+AUTH_FORBIDDEN = _raw_response(403, b'{"auth":"invalid"}')
+
+
+def _valid_uuid(value: str) -> bool:
+    try:
+        UUID(value)
+    except ValueError:
+        return False
+    return True
 
 
 class AuthMiddleware:
-    def __init__(self, app, no_auth_routes=None):
+    """
+    Pure ASGI auth + request context middleware.
+    Reads the path and headers straight from the scope, fills the starlette_context
+    request context in one write (user claims, X-Request-ID, X-Correlation-ID)
+    and echoes the ids back on the response, replacing ContextMiddleware with
+    RequestIdPlugin and CorrelationIdPlugin.
+    """
+    def __init__(self, app, no_auth_routes=None, request_id=True, correlation_id=True):
         self.app = app
-        self.no_auth_routes = no_auth_routes if no_auth_routes else []
+        self.no_auth_routes = frozenset(no_auth_routes) if no_auth_routes else frozenset()
+        self.request_id = request_id
+        self.correlation_id = correlation_id
 
     async def __call__(self, scope, receive, send):
         if scope['type'] != 'http':
             await self.app(scope, receive, send)
             return
 
-        request = Request(scope)
-        if request.url.path in self.no_auth_routes:
-            await self.app(scope, receive, send)
-            return
+        auth_header = request_id = correlation_id = None
+        for name, value in scope['headers']:
+            if name == _AUTHORIZATION:
+                auth_header = value
+            elif name == _REQUEST_ID:
+                request_id = value
+            elif name == _CORRELATION_ID:
+                correlation_id = value
 
-        auth_header = request.headers.get('authorization')
-        if not auth_header:
-            res = JSONResponse({"auth": "invalid"})
-            await res(scope, receive, send)
-            return
+        context = {}
+        response_headers = []
+        if self.request_id:
+            request_id = self._resolve_id(request_id)
+            if request_id is None:
+                await self._send_error(send, REQUEST_ID_KEY)
+                return
+            context[REQUEST_ID_KEY] = request_id
+            response_headers.append((_REQUEST_ID, request_id.encode('latin-1')))
+        if self.correlation_id:
+            correlation_id = self._resolve_id(correlation_id)
+            if correlation_id is None:
+                await self._send_error(send, CORRELATION_ID_KEY)
+                return
+            context[CORRELATION_ID_KEY] = correlation_id
+            response_headers.append((_CORRELATION_ID, correlation_id.encode('latin-1')))
+
+        if scope['path'] not in self.no_auth_routes:
+            with auth_seconds.time():
+                user = self._authenticate(auth_header)
+            if user is None or user is AUTH_FORBIDDEN:
+                (_auth_missing if user is None else _auth_forbidden).inc()
+                start, body = AUTH_INVALID if user is None else AUTH_FORBIDDEN
+                await send(start)
+                await send(body)
+                return
+            context = {**user, **context}
 
-        match auth_header.split(" "):
+        if response_headers:
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    message.setdefault('headers', [])
+                    message['headers'] = [*message['headers'], *response_headers]
+                await send(message)
+        else:
+            send_wrapper = send
+
+        with request_cycle_context(context):
+            await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _authenticate(auth_header: bytes | None):
+        """returns the user, None when the header is missing/malformed or AUTH_FORBIDDEN"""
+        if not auth_header:
+            return None
+        match auth_header.decode('latin-1').split(" "):
             case "Bearer", bearer_token:
                 try:
                     user = authenticate_token(bearer_token)
-                except InvalidSignatureError:
-                    response = JSONResponse({"auth": "invalid"}, status_code=403)
-                    await response(scope, receive, send)
-                    return
-                if user is None:
-                    response = JSONResponse({"auth": "invalid"}, status_code=403)
-                    await response(scope, receive, send)
-                    return
-                for k, v in user.items():
-                    ctx.context.setdefault(k, v)
-                await self.app(scope, receive, send)
+                except InvalidTokenError:
+                    # bad signature, but also tokens that are not JWTs at all
+                    return AUTH_FORBIDDEN
+                return AUTH_FORBIDDEN if user is None else user
             case _:
-                res = JSONResponse({"auth": "invalid"})
-                await res(scope, receive, send)
-                return
+                return None
+
+    @staticmethod
+    def _resolve_id(raw: bytes | None) -> str | None:
+        if raw is None:
+            return uuid4().hex
+        value = raw.decode('latin-1')
+        return value if _valid_uuid(value) else None
+
+    @staticmethod
+    async def _send_error(send, header: str):
+        start, body = _raw_response(400, f'Invalid UUID in request header {header}'.encode('latin-1'))
+        start['headers'][0] = (b'content-type', b'text/plain; charset=utf-8')
+        await send(start)
+        await send(body)
@@ -1,128 +1,458 @@
+import asyncio
+import signal
 import traceback
 import uvloop
 from typing import Awaitable, Callable, Union
-from inspect import iscoroutinefunction, get_annotations
+from inspect import iscoroutinefunction, isasyncgenfunction
 
 import pydantic
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse, Response
 from starlette.routing import Route, WebSocketRoute, BaseRoute, Mount
-from starlette.responses import JSONResponse
-from starlette_context import plugins
-from starlette_context.middleware import ContextMiddleware
 from hypercorn.config import Config
 from hypercorn.asyncio import serve
 
-from reddwarf.endpoints.websocket_endpoint import BaseWebsocketHandler
+from reddwarf.endpoints.http_endpoint import RPCResponse, RPCStreamingResponse
+from reddwarf.endpoints.websocket_endpoint import BaseWebsocketHandler, RPCWebsocketHandler
 from reddwarf.exceptions import CallRegisterException
 from reddwarf.middlewares import AuthMiddleware
 from reddwarf.services.logger_service import BaseLogger
 from reddwarf.services.websocket_service import WSConnectionManager
-from reddwarf.services.config_service import BaseConfig
-from reddwarf.services.mysql_service import MySQLPool
+from reddwarf.services.config_service import (
+    BaseConfig, Settings, ServerSettings, MySQLSettings, RedisSettings, ClickHouseSettings,
+)
+from reddwarf.services.mysql_service import MySQLPool, read_options, write_options
 from reddwarf.services.redis_service import RedisConnection
+from reddwarf.services.clickhouse_service import ClickHousePool
+from reddwarf.services.cache_service import QueryCache
+from reddwarf.services.write_buffer import WriteCoalescer
+from reddwarf.services.ws_backplane import WSBackplane
+from reddwarf.supervisor import WorkerSupervisor
+from reddwarf.utils.auth import reset_secret, token_cache
+from reddwarf.utils.codec import set_json_codec
+from reddwarf.utils.metrics import registry
+from reddwarf.utils.profiling import RPCProfiler
+from reddwarf.utils.rpc import DispatchPlan, InvalidRPCParams, RPCDispatcher
+
+
+# settings read once when the process starts, a reload only warns that they changed
+# (with workers, a SIGHUP to the supervisor also applies host, port, workers and reuse_port)
+RESTART_ONLY_SETTINGS = {
+    'default': (
+        'host', 'port', 'rpc_prefix', 'ws_prefix', 'workers', 'reuse_port', 'log_file', 'log_queue_size',
+        'stats_path', 'metrics_path', 'ws_rpc_endpoint', 'ws_backplane', 'profile_dump_dir',
+    ),
+    'mysql': ('db_host', 'db_port', 'db_user', 'db_password', 'db_name', 'minsize', 'maxsize', 'pool_recycle'),
+    'redis': ('db_host', 'db_password', 'max_connections'),
+}
 
 
 class RedDwarf:
-    def __init__(self, routes=None, ws_routes=None, no_auth_routes=None, loop=None):
+    def __init__(self, routes=None, ws_routes=None, no_auth_routes=None, loop=None, json_codec=None):
+        if json_codec is not None:
+            set_json_codec(json_codec)
         if loop is None:
             self._loop = uvloop.new_event_loop()
         else:
             self._loop = loop
         self._config = BaseConfig()
         self._config.load_conf()
-        self._host_ip = self._config.get_config()['DEFAULT']['host']
-        self._port = self._config.get_config()['DEFAULT']['port']
-        self._ws_prefix = self._config.get_config()['DEFAULT']['ws_prefix']
-        self._rpc_prefix = self._config.get_config()['DEFAULT']['rpc_prefix']
+        settings = self._config.settings.default
+        self._host_ip = settings.host
+        self._port = settings.port
+        self._ws_prefix = settings.ws_prefix
+        self._rpc_prefix = settings.rpc_prefix
+        self._stats_path = settings.stats_path
+        self._metrics_path = settings.metrics_path
         self._logger = BaseLogger()
-        self._logger.setup_logger(self._config.get_config()['DEFAULT']['log_file'])
+        self._setup_logger()
         self._logger.log(level=10, msg="[INFO] Initializing Red Dwarf RPC Services...")
+        token_cache.configure(max_size=settings.token_cache_size, ttl=settings.token_cache_ttl)
+        self._profiler = RPCProfiler(
+            sample_rate=settings.profile_sample_rate,
+            allow_header=settings.profile_header,
+            dump_dir=settings.profile_dump_dir,
+        )
+        self._dispatcher = RPCDispatcher(
+            max_concurrency=settings.rpc_batch_max_concurrency,
+            max_batch=settings.rpc_batch_max_size,
+            on_error=self._log_rpc_error,
+        )
         self._app = self.get_app(routes=routes, ws_routes=ws_routes, no_auth_routes=no_auth_routes)
-        self._logger.log(level=10, msg="[INFO] Initializing MySQL Connection Pool...")
         self._mysql_pool = MySQLPool()
-        self._loop.run_until_complete(self._mysql_pool.create_mysql_pool(
-            host=self._config.get_config()['MySQL']['db_host'],
-            port=self._config.get_config()['MySQL']['db_port'],
-            user=self._config.get_config()['MySQL']['db_user'],
-            password=self._config.get_config()['MySQL']['db_password'],
-            db=self._config.get_config()['MySQL']['db_name'],
-            loop=loop
-        ))
-        self._logger.log(level=10, msg="[INFO] Initializing Redis Connection Pool...")
+        self._write_coalescer = WriteCoalescer()
         self._redis_pool = RedisConnection()
-        self._loop.run_until_complete(self._redis_pool.initialize(
-            self._config.get_config()['Redis']['db_host'],
-            password=self._config.get_config()['Redis']['db_password']
-        ))
-        self._logger.log(level=10, msg="[INFO] Initializing WebSocket Connection Manager...")
+        self._query_cache = QueryCache()
+        self._clickhouse_pool = None
         self._ws_connection = WSConnectionManager()
-        self._ws_connection.initialize()
-        self._logger.log(
-            level=10,
-            msg=f'[INFO] Red Dwarf Started! Listening at {f"{self._host_ip}:{self._port}"}'
+        self._ws_backplane = None
+        self._config_watcher = None
+        self._register_gauges()
+        self._config.on_reload(self._apply_settings)
+
+    def _setup_logger(self, log_queue=None):
+        settings = self._config.settings.default
+        self._logger.setup_logger(
+            settings.log_file,
+            level=settings.log_level,
+            queue_size=settings.log_queue_size,
+            overflow=settings.log_overflow,
+            batch_size=settings.log_batch_size,
+            log_queue=log_queue,
         )
 
-    def init(self):
+    def share_logger(self, context):
+        """the supervisor writes the log file for all its workers, they send their records through this queue"""
+        log_queue = context.JoinableQueue(self._config.settings.default.log_queue_size)
+        self._setup_logger(log_queue)
+        return log_queue
+
+    async def startup(self):
+        """
+        lifespan startup, runs in every worker once its loop is running.
+        MySQL, Redis and ClickHouse connect concurrently, with lazy_services = true
+        MySQL only connects on its first acquire()
+        """
+        settings = self._config.settings
+        self._logger.log(level=10, msg="[INFO] Initializing Connection Pools...")
+        pools = [self._start_mysql(settings.mysql, settings.default.lazy_services), self._start_redis(settings.redis)]
+        if settings.clickhouse is not None:
+            pools.append(self._start_clickhouse(settings.clickhouse))
+        await asyncio.gather(*pools)
+
+        write_options['max_packet_size'] = settings.mysql.max_packet_size
+        read_options['in_chunk_size'] = settings.mysql.in_chunk_size
+        read_options['in_concurrency'] = settings.mysql.in_concurrency
+        self._write_coalescer.initialize(
+            self._mysql_pool,
+            max_batch=settings.mysql.write_buffer_max_batch,
+            max_delay=settings.mysql.write_buffer_max_delay,
+        )
+        self._query_cache.initialize(
+            redis=self._redis_pool.get_pool(),
+            l1_size=settings.default.query_cache_l1_size,
+            l1_ttl=settings.default.query_cache_l1_ttl,
+            max_ttl=settings.default.query_cache_max_ttl,
+        )
+        self._logger.log(level=10, msg="[INFO] Initializing WebSocket Connection Manager...")
+        self._ws_connection.initialize(
+            max_clients=settings.default.ws_max_clients,
+            send_queue_size=settings.default.ws_send_queue_size,
+        )
+        if settings.default.ws_backplane:
+            self._logger.log(level=10, msg="[INFO] Starting WebSocket Redis Backplane...")
+            self._ws_backplane = WSBackplane()
+            self._ws_backplane.initialize(
+                self._redis_pool.get_pool(), self._ws_connection,
+                flush_interval=settings.default.ws_backplane_flush_interval,
+            )
+            await self._ws_backplane.start()
+        self._start_config_reload(settings.default)
+        self._logger.log(10, '[INFO] Red Dwarf Started! Listening at %s:%s', self._host_ip, self._port)
+
+    async def _start_mysql(self, settings: MySQLSettings, lazy=False):
+        await self._mysql_pool.create_mysql_pool(
+            host=settings.db_host,
+            port=settings.db_port,
+            user=settings.db_user,
+            password=settings.db_password,
+            db=settings.db_name,
+            loop=asyncio.get_running_loop(),
+            minsize=settings.minsize,
+            maxsize=settings.maxsize,
+            pool_recycle=settings.pool_recycle,
+            connect_timeout=settings.connect_timeout,
+            acquire_timeout=settings.acquire_timeout or None,
+            prewarm=settings.prewarm,
+            health_check_interval=settings.health_check_interval,
+            lazy=lazy,
+        )
+
+    async def _start_redis(self, settings: RedisSettings):
+        await self._redis_pool.initialize(
+            settings.db_host,
+            password=settings.db_password,
+            max_connections=settings.max_connections or None,
+        )
+
+    async def _start_clickhouse(self, settings: ClickHouseSettings):
+        self._clickhouse_pool = ClickHousePool()
+        await self._clickhouse_pool.create_clickhouse_pool(
+            host=settings.db_host,
+            port=settings.db_port,
+            user=settings.db_user,
+            password=settings.db_password,
+            db=settings.db_name,
+            max_connections=settings.max_connections,
+        )
+
+    def _start_config_reload(self, settings: ServerSettings):
+        """SIGUSR1 and/or polling the config file's mtime reload the settings in this process"""
+        loop = asyncio.get_running_loop()
+        if settings.config_reload_signal:
+            loop.add_signal_handler(signal.SIGUSR1, self.reload_config)
+        if settings.config_watch_interval > 0:
+            self._config_watcher = loop.create_task(self._config.watch(settings.config_watch_interval))
+
+    def reload_config(self):
+        """a rejected reload is logged by BaseConfig.reload() and keeps the current settings"""
+        self._config.reload()
+
+    def _apply_settings(self, old: Settings, new: Settings):
+        """
+        pushes reloaded settings into the running services.
+        Listening address, workers, prefixes and pool sizes only change with a restart
+        (SIGHUP reloads the workers when running with workers > 1).
+        """
+        if new.default.secret != old.default.secret:
+            reset_secret()
+        settings = new.default
+        self._logger.root_logger.setLevel(settings.log_level)
+        token_cache.configure(max_size=settings.token_cache_size, ttl=settings.token_cache_ttl)
+        self._profiler.configure(sample_rate=settings.profile_sample_rate, allow_header=settings.profile_header)
+        self._dispatcher.configure(
+            max_concurrency=settings.rpc_batch_max_concurrency, max_batch=settings.rpc_batch_max_size
+        )
+        if self._query_cache.enabled:
+            self._query_cache.configure(
+                l1_size=settings.query_cache_l1_size,
+                l1_ttl=settings.query_cache_l1_ttl,
+                max_ttl=settings.query_cache_max_ttl,
+            )
+        self._ws_connection.configure(
+            max_clients=settings.ws_max_clients, send_queue_size=settings.ws_send_queue_size
+        )
+        write_options['max_packet_size'] = new.mysql.max_packet_size
+        read_options['in_chunk_size'] = new.mysql.in_chunk_size
+        read_options['in_concurrency'] = new.mysql.in_concurrency
+        self._write_coalescer.configure(
+            max_batch=new.mysql.write_buffer_max_batch, max_delay=new.mysql.write_buffer_max_delay
+        )
+        self._mysql_pool.configure(acquire_timeout=new.mysql.acquire_timeout or None)
+        restart_only = [
+            f"{section}.{key}"
+            for section, keys in RESTART_ONLY_SETTINGS.items()
+            for key in keys
+            if getattr(getattr(old, section), key) != getattr(getattr(new, section), key)
+        ]
+        if restart_only:
+            self._logger.log(30, '[WARNING] %s changed, they take effect after a restart', ', '.join(restart_only))
+        self._logger.log(20, '[INFO] config reloaded')
+
+    async def shutdown(self):
+        """
+        lifespan shutdown: closes websockets (1001 going away), writes out buffered rows,
+        leaves the backplane, then closes every pool concurrently
+        """
+        self._logger.log(level=10, msg="[INFO] Stopping Red Dwarf...")
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        if self._config_watcher is not None:
+            self._config_watcher.cancel()
+            self._config_watcher = None
+        await self._ws_connection.close_all(1001)
+        await self._write_coalescer.flush()
+        if self._ws_backplane is not None:
+            await self._ws_backplane.stop()
+        pools = [self._mysql_pool.close(), self._redis_pool.close()]
+        if self._clickhouse_pool is not None:
+            pools.append(self._clickhouse_pool.close())
+        for result in await asyncio.gather(*pools, return_exceptions=True):
+            if isinstance(result, Exception):
+                self._logger.log(40, '[ERROR] closing pool failed: %s', result)
+
+    def get_hypercorn_config(self) -> Config:
+        """hypercorn tunables from [DEFAULT], unset keys keep hypercorn's defaults"""
+        settings = self._config.settings.default
         config = Config()
-        config.bind = [f"{self._host_ip}:{self._port}"]
-        self._loop.run_until_complete(serve(self._app, config))
-        self._mysql_pool.get_mysql_pool().close()
-        self._loop.run_until_complete(self._mysql_pool.get_mysql_pool().wait_closed())
+        config.bind = [f"{settings.host}:{settings.port}"]
+        for key in (
+                'backlog', 'keep_alive_timeout', 'graceful_timeout', 'h2_max_concurrent_streams',
+                'h11_max_incomplete_size', 'max_app_queue_size',
+        ):
+            value = getattr(settings, key)
+            if value is not None:
+                setattr(config, key, value)
+        if not settings.h2:
+            config.alpn_protocols = ['http/1.1']
+        return config
+
+    def init(self):
+        settings = self._config.settings.default
+        if settings.workers > 1:
+            WorkerSupervisor(self).run()
+            self._logger.shutdown()
+            return
+        self._loop.run_until_complete(serve(self._app, self.get_hypercorn_config()))
+        self._logger.shutdown()
+
+    def run_worker(self, config: Config, shutdown_trigger, log_queue=None):
+        """entry point of a forked worker, gets its own loop and connection pools, logs through the supervisor"""
+        self._loop = uvloop.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        settings = self._config.settings.default
+        if log_queue is None:
+            self._logger.reset_after_fork()
+            self._setup_logger()
+        else:
+            self._logger.setup_worker_logger(log_queue, level=settings.log_level, overflow=settings.log_overflow)
+        self._loop.run_until_complete(serve(self._app, config, shutdown_trigger=shutdown_trigger))
+        self._logger.shutdown()
 
     def get_mysql_pool(self):
         return self._mysql_pool
 
+    def get_stats(self) -> dict:
+        return {
+            'mysql': self._mysql_pool.get_stats(),
+            'logger': self._logger.get_stats(),
+            'token_cache': token_cache.stats(),
+            'query_cache': self._query_cache.get_stats(),
+            'write_buffer': self._write_coalescer.get_stats(),
+            'websocket': self._ws_connection.get_stats(),
+            'ws_backplane': self._ws_backplane.get_stats() if self._ws_backplane is not None else None,
+        }
+
+    async def stats_endpoint(self, request):
+        return RPCResponse(self.get_stats())
+
+    def _register_gauges(self):
+        """gauges are sampled from the services when /metrics is scraped, nothing runs on the hot path"""
+        registry.gauge('reddwarf_ws_connections', 'open websockets', self._ws_connection.count)
+        registry.gauge(
+            'reddwarf_ws_send_queued', 'messages waiting in websocket send queues',
+            lambda: self._ws_connection.get_stats()['queued'],
+        )
+        registry.gauge(
+            'reddwarf_db_pool_connections', 'MySQL pool connections by state',
+            lambda: {(state,): self._mysql_pool.get_stats()[state] for state in ('in_use', 'idle')},
+            labels=('state',),
+        )
+        registry.gauge(
+            'reddwarf_db_pool_waiters', 'coroutines waiting in MySQLPool.acquire()',
+            lambda: self._mysql_pool.get_stats()['waiters'],
+        )
+        registry.gauge(
+            'reddwarf_log_queued', 'log records waiting for the writer thread',
+            lambda: self._logger.log_queue.qsize(),
+        )
+
+    async def metrics_endpoint(self, request):
+        """Prometheus text format, served without auth"""
+        return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def get_clickhouse_pool(self):
+        return self._clickhouse_pool
+
     def get_logger(self):
         return self._logger
 
     def get_ws_connection_manager(self):
         return self._ws_connection
 
+    def get_ws_backplane(self):
+        return self._ws_backplane
+
     def create_route_for_websocket(self, handler) -> BaseRoute:
         return WebSocketRoute(
             '/'.join([self._ws_prefix, handler.get_endpoint()]),
             handler
         )
 
-    def create_route_for_rpc(self, func) -> Route:
+    def create_route_for_rpc(self, func, authenticated=True) -> Route:
         return Route(
             '/'.join([self._rpc_prefix, func.__name__]),
-            self.rpc_wrapper(func), methods=['POST']
+            self.rpc_wrapper(func, authenticated), methods=['POST']
         )
 
-    def rpc_wrapper(self, func):
+    def rpc_wrapper(self, func, authenticated=True):
         try:
-            assert iscoroutinefunction(func)
+            assert iscoroutinefunction(func) or isasyncgenfunction(func)
         except AssertionError:
-            raise CallRegisterException(f"{func} is not an awaitable coroutine function!")
+            raise CallRegisterException(f"{func} is not an awaitable coroutine or async generator function!")
+
+        plan = DispatchPlan(func)
+        self._dispatcher.register(plan)
 
         async def execute(request):
-            params = get_annotations(func)
-            if params and len(params) == 1:
-                param_name, param_model = next(iter(params.items()))
-                if issubclass(param_model, pydantic.BaseModel):
-                    params = {param_name: param_model(**await request.json())}
-            else:
-                request_body = await request.json()
-                params = {
-                    param_name: request_body[param_name]
-                    for param_name, param_type in params.items()
-                    if request_body.get(param_name)
-                }
-                self._logger.log(level=10, msg=f'[INFO] extracting {params}')
+            try:
+                params = plan.bind(plan.decode(await request.body())) if plan.takes_params else None
+            except (ValueError, InvalidRPCParams, pydantic.ValidationError) as e:
+                plan.rejected.inc()
+                return RPCResponse({"error": str(e)}, status_code=400)
 
             try:
-                self._logger.log(level=10, msg=f'[INFO] calling {func.__name__} {params}')
-                if not params:
-                    return JSONResponse(await func())
-                return JSONResponse(await func(**params))
-            except Exception as e:
+                self._logger.log(10, '[INFO] calling %s %s', plan.name, params)
+                if plan.streaming:
+                    return RPCStreamingResponse(
+                        func(**params) if params else func(),
+                        ndjson=RPCStreamingResponse.wants_ndjson(request)
+                    )
+                with plan.latency.time():
+                    result = await func(**params) if params else await func()
+                return RPCResponse(result)
+            except Exception:
+                plan.failed.inc()
                 self._logger.log(level=50, msg='str(e)', exc_info=traceback.format_exc())
 
-        print(f"binding {func.__name__} {get_annotations(func)}")
+        async def execute_profiled(request):
+            # anyone can call a no-auth route, the profile header would let them run cProfile and fill dump_dir
+            if not self._profiler.wants(request.headers, authenticated):
+                return await execute(request)
+            profile, token = self._profiler.start(plan.name)
+            try:
+                with profile.phase('read'):
+                    body = await request.body()
+                try:
+                    with profile.phase('decode'):
+                        body = plan.decode(body) if plan.takes_params else None
+                    with profile.phase('validate'):
+                        params = plan.bind(body) if plan.takes_params else None
+                except (ValueError, InvalidRPCParams, pydantic.ValidationError) as e:
+                    plan.rejected.inc()
+                    return RPCResponse({"error": str(e)}, status_code=400)
+
+                if plan.streaming:
+                    # the stream runs after this returns, only decode and validation are profiled
+                    response = RPCStreamingResponse(
+                        func(**params) if params else func(),
+                        ndjson=RPCStreamingResponse.wants_ndjson(request)
+                    )
+                else:
+                    cprofile = self._profiler.cprofile()
+                    try:
+                        with profile.phase('handler', plan.latency):
+                            result = await func(**params) if params else await func()
+                    except Exception:
+                        plan.failed.inc()
+                        self._logger.log(level=50, msg='str(e)', exc_info=traceback.format_exc())
+                        return None
+                    finally:
+                        if cprofile is not None:
+                            path = await self._profiler.dump(cprofile, plan.name)
+                            self._logger.log(20, '[PROFILE] %s cProfile written to %s', plan.name, path)
+                    with profile.phase('encode'):
+                        response = RPCResponse(result)
+                response.headers['Server-Timing'] = profile.server_timing()
+                self._logger.log(20, '[PROFILE] %s', profile)
+                return response
+            finally:
+                self._profiler.finish(token)
+
+        print(f"binding {plan}")
 
-        return execute
+        # picked once here, the profiling path does not exist unless profiling is configured
+        return execute_profiled if self._profiler.enabled else execute
+
+    async def rpc_batch_endpoint(self, request):
+        """JSON-RPC 2.0 call or batch of calls to the registered RPCs, authenticated once for the whole batch"""
+        response = await self._dispatcher.handle(await request.body())
+        if response is None:
+            return Response(status_code=204)
+        return RPCResponse(response)
+
+    def _log_rpc_error(self, plan, e):
+        self._logger.log(50, '[ERROR] %s failed: %s', plan.name, e, exc_info=traceback.format_exc())
 
     def get_app(
             self,
@@ -150,18 +480,21 @@ class RedDwarf:
             config = {}
         rpc_routes = [self.create_route_for_rpc(func) for func in routes]
         ws_routes = [self.create_route_for_websocket(handler) for handler in ws_routes]
-        no_auth_routes = [self.create_route_for_rpc(func) for func in no_auth_routes]
+        no_auth_routes = [self.create_route_for_rpc(func, authenticated=False) for func in no_auth_routes]
+        no_auth_routes.append(Route(self._metrics_path, self.metrics_endpoint, methods=['GET']))
+        settings = self._config.settings.default
+        if settings.ws_rpc_endpoint:
+            ws_routes.append(self.create_route_for_websocket(RPCWebsocketHandler.create(
+                self._dispatcher, settings.ws_rpc_endpoint, max_in_flight=settings.ws_rpc_max_in_flight,
+            )))
+        stats_routes = [Route(self._stats_path, self.stats_endpoint, methods=['GET'])]
+        batch_routes = [Route(self._rpc_prefix, self.rpc_batch_endpoint, methods=['POST'])]
         return Starlette(
             debug=True,
-            routes=no_auth_routes+rpc_routes+ws_routes,
+            routes=no_auth_routes+rpc_routes+batch_routes+ws_routes+stats_routes,
             middleware=[
-                Middleware(
-                    ContextMiddleware,
-                    plugins=(
-                        plugins.RequestIdPlugin(),
-                        plugins.CorrelationIdPlugin(),
-                    )
-                ),
                 Middleware(AuthMiddleware, no_auth_routes=[f.path for f in no_auth_routes]),
             ],
+            on_startup=[self.startup],
+            on_shutdown=[self.shutdown],
         )
@@ -0,0 +1,201 @@
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from reddwarf.utils import codec
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+# {"$t": type, "v": value} stands for a value JSON has no type for
+_TAG = '$t'
+
+
+def _tag(obj):
+    match obj:
+        case decimal.Decimal():
+            return {_TAG: 'decimal', 'v': str(obj)}
+        case datetime.datetime():
+            return {_TAG: 'datetime', 'v': obj.isoformat()}
+        case datetime.date():
+            return {_TAG: 'date', 'v': obj.isoformat()}
+        case datetime.time():
+            return {_TAG: 'time', 'v': obj.isoformat()}
+        case datetime.timedelta():
+            return {_TAG: 'timedelta', 'v': obj.total_seconds()}
+        case bytes():
+            return {_TAG: 'bytes', 'v': base64.b64encode(obj).decode()}
+        case set() | frozenset():
+            return list(obj)
+        case _:
+            raise TypeError(f"{type(obj)} can not be cached")
+
+
+def _untag(obj: dict):
+    match obj:
+        case {'$t': 'decimal', 'v': v}:
+            return decimal.Decimal(v)
+        case {'$t': 'datetime', 'v': v}:
+            return datetime.datetime.fromisoformat(v)
+        case {'$t': 'date', 'v': v}:
+            return datetime.date.fromisoformat(v)
+        case {'$t': 'time', 'v': v}:
+            return datetime.time.fromisoformat(v)
+        case {'$t': 'timedelta', 'v': v}:
+            return datetime.timedelta(seconds=v)
+        case {'$t': 'bytes', 'v': v}:
+            return base64.b64decode(v)
+        case _:
+            return obj
+
+
+_MUTABLE = (list, dict)
+
+
+def copy_result(value):
+    """
+    copies the two container levels a select result has (rows / columns, then their values),
+    the scalars in them are immutable and shared
+    """
+    match value:
+        case list():
+            return [v.copy() if type(v) in _MUTABLE else v for v in value]
+        case dict():
+            return {k: v.copy() if type(v) in _MUTABLE else v for k, v in value.items()}
+        case _:
+            return value
+
+
+def encode(value) -> bytes:
+    """JSON keeping the types MySQL rows carry (Decimal, datetime, date, time, timedelta, bytes)"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_tag, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(value, default=_tag, separators=(',', ':')).encode()
+
+
+def decode(raw: bytes | str):
+    """rows without tagged values skip the object_hook"""
+    if (b'"$t"' if isinstance(raw, bytes) else '"$t"') not in raw:
+        return codec.loads(raw)
+    return json.loads(raw, object_hook=_untag)
+
+
+class QueryCache:
+    """
+    Read-through cache for select results.
+    L1 is a small in-process LRU with a short ttl, L2 is Redis.
+    Every Redis entry is also tracked in a per table set so a write to the table
+    can invalidate all of its cached queries at once.
+    Redis holds the value encoded with the types the query returned (see encode),
+    L1 holds the value itself and every hit gets its own copy of it,
+    so callers can not change each other's results.
+    """
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super(QueryCache, cls).__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        pass
+
+    def initialize(self, redis=None, l1_size=1024, l1_ttl=1.0, max_ttl=3600, prefix='rdw:q'):
+        self._redis = redis
+        self._l1: OrderedDict[str, tuple[float, object, str]] = OrderedDict()
+        self._l1_tables: dict[str, set[str]] = {}
+        self._l1_size = l1_size
+        self._l1_ttl = l1_ttl
+        self._max_ttl = max_ttl
+        self._prefix = prefix
+        self.hits_l1 = 0
+        self.hits_l2 = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def configure(self, l1_size=None, l1_ttl=None, max_ttl=None):
+        if l1_size is not None:
+            self._l1_size = l1_size
+        if l1_ttl is not None:
+            self._l1_ttl = l1_ttl
+        if max_ttl is not None:
+            self._max_ttl = max_ttl
+
+    @property
+    def enabled(self) -> bool:
+        return hasattr(self, '_l1')
+
+    def key(self, table, sql, params, variant='') -> str:
+        digest = hashlib.blake2b(
+            b'\0'.join((sql.encode(), codec.dumps(params), variant.encode())), digest_size=16
+        ).hexdigest()
+        return f"{self._prefix}:{table}:{digest}"
+
+    def _table_key(self, table) -> str:
+        return f"{self._prefix}:{table}:keys"
+
+    async def get(self, table, key) -> tuple[bool, object]:
+        """return: (found, value)"""
+        entry = self._l1.get(key)
+        if entry is not None:
+            expires, value, _ = entry
+            if expires > time.monotonic():
+                self._l1.move_to_end(key)
+                self.hits_l1 += 1
+                return True, copy_result(value)
+            self._l1_drop(table, key)
+        if self._redis is not None:
+            raw = await self._redis.get(key)
+            if raw is not None:
+                value = decode(raw)
+                self._l1_put(table, key, value)
+                self.hits_l2 += 1
+                return True, copy_result(value)
+        self.misses += 1
+        return False, None
+
+    async def set(self, table, key, value, ttl):
+        """value stays with the caller, the cache keeps a copy"""
+        self._l1_put(table, key, copy_result(value))
+        if self._redis is None:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, encode(value), ex=min(int(ttl), self._max_ttl))
+            pipe.sadd(self._table_key(table), key)
+            pipe.expire(self._table_key(table), self._max_ttl)
+            await pipe.execute()
+
+    async def invalidate(self, table):
+        self.invalidations += 1
+        for key in self._l1_tables.pop(table, ()):
+            self._l1.pop(key, None)
+        if self._redis is None:
+            return
+        table_key = self._table_key(table)
+        keys = await self._redis.smembers(table_key)
+        await self._redis.delete(table_key, *keys)
+
+    def _l1_put(self, table, key, value):
+        if self._l1_size <= 0:
+            return
+        self._l1[key] = (time.monotonic() + self._l1_ttl, value, table)
+        self._l1.move_to_end(key)
+        self._l1_tables.setdefault(table, set()).add(key)
+        while len(self._l1) > self._l1_size:
+            old_key, (_, _, old_table) = self._l1.popitem(last=False)
+            self._l1_tables.get(old_table, set()).discard(old_key)
+
+    def _l1_drop(self, table, key):
+        self._l1.pop(key, None)
+        self._l1_tables.get(table, set()).discard(key)
+
+    def get_stats(self) -> dict:
+        return {
+            'hits_l1': self.hits_l1, 'hits_l2': self.hits_l2,
+            'misses': self.misses, 'invalidations': self.invalidations,
+            'l1_size': len(self._l1),
+        }
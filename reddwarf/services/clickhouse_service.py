@@ -0,0 +1,160 @@
+import datetime
+import decimal
+import uuid
+
+import httpx
+
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.utils import codec
+from reddwarf.utils.sql import IntList, SQLDialect, compile_select_query, int_list_literal
+
+
+DEFAULT_BLOCK_SIZE = 100_000
+
+# ask for 64 bit integers as JSON numbers instead of quoted strings
+DEFAULT_SETTINGS = {
+    'output_format_json_quote_64bit_integers': 0,
+    'date_time_input_format': 'best_effort',
+}
+
+
+class ClickHouseError(Exception):
+    """ClickHouse answered with an error"""
+
+
+class ClickHousePool:
+    """
+    Talks to ClickHouse over its HTTP interface,
+    the pool is the keep-alive connection pool of one httpx.AsyncClient
+    """
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super(ClickHousePool, cls).__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        pass
+
+    async def create_clickhouse_pool(
+            self, host, port=8123, user='default', password='', db='default',
+            max_connections=100, timeout=30.0, secure=False
+    ):
+        self._pool = httpx.AsyncClient(
+            base_url=f"{'https' if secure else 'http'}://{host}:{int(port)}",
+            headers={'X-ClickHouse-User': user, 'X-ClickHouse-Key': password or ''},
+            params={'database': db, **DEFAULT_SETTINGS},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+        )
+        BaseLogger().log(10, "[INFO] ClickHouse pool created for %s:%s", host, port)
+
+    def get_clickhouse_pool(self) -> httpx.AsyncClient:
+        return self._pool
+
+    async def close(self):
+        await self._pool.aclose()
+
+
+def to_clickhouse_literal(v) -> str:
+    match v:
+        case None:
+            return 'NULL'
+        case bool():
+            return '1' if v else '0'
+        case int() | float() | decimal.Decimal():
+            return str(v)
+        case str():
+            return "'" + v.replace('\\', '\\\\').replace("'", "\\'") + "'"
+        case datetime.datetime():
+            return f"'{v.strftime('%Y-%m-%d %H:%M:%S')}'"
+        case datetime.date():
+            return f"'{v.isoformat()}'"
+        case uuid.UUID():
+            return f"'{v}'"
+        case IntList():
+            return int_list_literal(v)
+        case list():
+            return f"[{','.join(map(to_clickhouse_literal, v))}]"
+        case tuple():
+            return f"({','.join(map(to_clickhouse_literal, v))})"
+        case _:
+            raise TypeError(f"{type(v)} can not be rendered as a ClickHouse literal")
+
+
+def render_query(template: str, params: dict) -> str:
+    """
+    binds compiled template params client side, ClickHouse HTTP has no pyformat binding.
+    Always formats, even without params, so escaped %% become % again
+    """
+    return template % {k: to_clickhouse_literal(v) for k, v in params.items()}
+
+
+async def execute(chc: httpx.AsyncClient, sql: str, data: bytes = None) -> bytes:
+    if data is None:
+        response = await chc.post('/', content=sql.encode())
+    else:
+        response = await chc.post('/', params={'query': sql}, content=data)
+    if response.status_code != 200:
+        raise ClickHouseError(response.text.strip())
+    return response.content
+
+
+async def select_many(
+        chc, table, *,
+        cols=None, where=None, limit=None,
+        offset=None, group_by=None, order_by=None, columnar=False
+) -> list[dict] | dict[str, list]:
+    """
+    columnar=True returns {column: [values, ...]} straight from ClickHouse's JSONColumns output
+    instead of one dict per row
+    """
+    template, params = compile_select_query(
+        table=table, cols=cols, where=where,
+        limit=limit, offset=offset, group_by=group_by,
+        order_by=order_by, dialect=SQLDialect.ClickHouse
+    )
+    sql = render_query(template, params)
+    if columnar:
+        return codec.loads(await execute(chc, f"{sql} FORMAT JSONColumns"))
+    result = codec.loads(await execute(chc, f"{sql} FORMAT JSONCompact"))
+    result_cols = [col['name'] for col in result['meta']]
+    return [dict(zip(result_cols, row)) for row in result['data']]
+
+
+async def select_one(
+        chc, table, *,
+        cols=None, where=None, offset=None, group_by=None, order_by=None
+) -> dict | None:
+    rows = await select_many(
+        chc, table, cols=cols, where=where, limit=1,
+        offset=offset, group_by=group_by, order_by=order_by
+    )
+    return rows[0] if rows else None
+
+
+def to_columns(data: list[dict]) -> dict[str, list]:
+    cols = data[0].keys()
+    return {col: [row[col] for row in data] for col in cols}
+
+
+async def insert_many(chc, table, data: list[dict] | dict[str, list], block_size=DEFAULT_BLOCK_SIZE) -> int:
+    """
+    data: rows, or columns {column: [values, ...]} which are sent without any per row work.
+    Rows are sent in blocks of block_size rows, one JSONColumns block per request.
+    return: number of rows inserted
+    """
+    if not data:
+        return 0
+    columns = data if isinstance(data, dict) else to_columns(data)
+    n_rows = len(next(iter(columns.values())))
+    if any(len(values) != n_rows for values in columns.values()):
+        raise ValueError("all columns must have the same number of rows")
+    sql = f"INSERT INTO {table} ({','.join(columns)}) FORMAT JSONColumns"
+    for start in range(0, n_rows, block_size):
+        block = {col: values[start:start + block_size] for col, values in columns.items()}
+        await execute(chc, sql, codec.dumps(block))
+    return n_rows
+
+
+async def insert_one(chc, table, data: dict):
+    await insert_many(chc, table, [data])
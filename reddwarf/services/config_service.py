@@ -1,5 +1,186 @@
+import asyncio
 import os
 import configparser
+import re
+from typing import Callable, Optional
+
+import pydantic
+from pydantic import ByteSize
+
+from reddwarf.services.logger_service import BaseLogger
+
+# REDDWARF_<SECTION>__<KEY>=value overrides [Section] key, e.g. REDDWARF_MYSQL__MAXSIZE=20
+ENV_PREFIX = 'REDDWARF_'
+
+_DURATION = re.compile(r'^\s*(-?[0-9.]+)\s*(ms|s|m|h)?\s*$')
+_DURATION_UNITS = {None: 1.0, 'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+
+class Duration(float):
+    """seconds, written as a number (seconds) or with a unit: 500ms, 5s, 2m, 1h"""
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, (int, float)):
+            return cls(value)
+        match = _DURATION.match(str(value))
+        if match is None:
+            raise ValueError(f"{value!r} is not a duration")
+        return cls(float(match.group(1)) * _DURATION_UNITS[match.group(2)])
+
+
+class _Section(pydantic.BaseModel):
+    class Config:
+        frozen = True
+        # configparser hands every section the [DEFAULT] keys as well
+        extra = pydantic.Extra.ignore
+
+
+class ServerSettings(_Section):
+    host: str = '127.0.0.1'
+    port: int = 8000
+    rpc_prefix: str = '/rpc'
+    ws_prefix: str = '/ws'
+    secret: str
+    log_file: str = './red_dwarf_server.log'
+    log_level: int = 10
+    log_queue_size: int = 10000
+    log_overflow: str = 'drop'
+    log_batch_size: int = 256
+    workers: int = 1
+    reuse_port: bool = False
+    # hypercorn, None keeps hypercorn's default
+    backlog: Optional[int] = None
+    keep_alive_timeout: Optional[Duration] = None
+    graceful_timeout: Optional[Duration] = None
+    h2: bool = True
+    h2_max_concurrent_streams: Optional[int] = None
+    h11_max_incomplete_size: Optional[ByteSize] = None
+    max_app_queue_size: Optional[int] = None
+    lazy_services: bool = False
+    config_watch_interval: Duration = 0.0
+    config_reload_signal: bool = True
+    token_cache_size: int = 10000
+    token_cache_ttl: Duration = 300.0
+    stats_path: str = '/_reddwarf/stats'
+    metrics_path: str = '/metrics'
+    profile_sample_rate: float = 0.0
+    profile_header: bool = False
+    profile_dump_dir: str = ''
+    rpc_batch_max_size: int = 100
+    rpc_batch_max_concurrency: int = 32
+    ws_rpc_endpoint: str = ''
+    ws_rpc_max_in_flight: int = 16
+    query_cache_l1_size: int = 1024
+    query_cache_l1_ttl: Duration = 1.0
+    query_cache_max_ttl: int = 3600
+    ws_max_clients: int = 10000
+    ws_send_queue_size: int = 256
+    ws_backplane: bool = False
+    ws_backplane_flush_interval: Duration = 0.002
+
+    @pydantic.validator('log_overflow')
+    def _overflow(cls, value):
+        if value not in ('drop', 'block'):
+            raise ValueError("log_overflow is drop or block")
+        return value
+
+    @pydantic.validator('profile_sample_rate')
+    def _rate(cls, value):
+        if not 0 <= value <= 1:
+            raise ValueError("profile_sample_rate is between 0 and 1")
+        return value
+
+    @pydantic.validator('workers', 'rpc_batch_max_concurrency', 'ws_rpc_max_in_flight')
+    def _positive(cls, value):
+        if value < 1:
+            raise ValueError("must be at least 1")
+        return value
+
+
+class MySQLSettings(_Section):
+    db_host: str
+    db_port: int = 3306
+    db_user: str
+    db_password: str
+    db_name: str
+    minsize: int = 1
+    maxsize: int = 10
+    pool_recycle: int = -1
+    connect_timeout: Duration = 10.0
+    # 0 waits forever
+    acquire_timeout: Duration = 0.0
+    prewarm: int = 0
+    health_check_interval: Duration = 0.0
+    max_packet_size: ByteSize = 1024000
+    write_buffer_max_batch: int = 500
+    write_buffer_max_delay: Duration = 0.005
+    in_chunk_size: int = 5000
+    in_concurrency: int = 4
+
+    @pydantic.validator('maxsize')
+    def _pool_size(cls, value, values):
+        if value < values.get('minsize', 1):
+            raise ValueError("maxsize is smaller than minsize")
+        return value
+
+    @pydantic.validator('in_chunk_size', 'in_concurrency')
+    def _positive(cls, value):
+        if value < 1:
+            raise ValueError("must be at least 1")
+        return value
+
+
+class RedisSettings(_Section):
+    db_host: str
+    db_password: str = ''
+    # 0 leaves the pool unbounded
+    max_connections: int = 0
+
+
+class ClickHouseSettings(_Section):
+    db_host: str
+    db_port: int = 8123
+    db_user: str = 'default'
+    db_password: str = ''
+    db_name: str = 'default'
+    max_connections: int = 100
+
+
+class Settings(_Section):
+    """config-{ENV}.ini parsed and validated once, attribute access only"""
+    default: ServerSettings
+    mysql: MySQLSettings
+    redis: RedisSettings
+    clickhouse: Optional[ClickHouseSettings] = None
+
+    @classmethod
+    def from_parser(cls, parser: configparser.ConfigParser) -> 'Settings':
+        sections = {'default': dict(parser.defaults())}
+        for name in parser.sections():
+            sections[name.lower()] = dict(parser[name])
+        return cls(**sections)
+
+
+def apply_env_overrides(parser: configparser.ConfigParser, environ=os.environ):
+    """REDDWARF_<SECTION>__<KEY> variables, sections are matched case-insensitively"""
+    sections = {name.lower(): name for name in parser.sections()}
+    for variable, value in environ.items():
+        if not variable.startswith(ENV_PREFIX) or '__' not in variable:
+            continue
+        section, _, key = variable[len(ENV_PREFIX):].partition('__')
+        section, key = section.lower(), key.lower()
+        if section == 'default':
+            parser.defaults()[key] = value
+            continue
+        if section not in sections:
+            sections[section] = section.capitalize()
+            parser.add_section(sections[section])
+        parser[sections[section]][key] = value
 
 
 class BaseConfig:
@@ -12,16 +193,71 @@ class BaseConfig:
         pass
 
     def load_conf(self):
-        self._config = configparser.ConfigParser()
         env = os.environ['ENV']
         if not env:
             raise Exception("$ENV is not set, abort!")
-        self._config.read(f'config-{env}.ini')
+        self._path = f'config-{env}.ini'
+        # on_reload callbacks outlive a second load_conf()
+        if not hasattr(self, '_callbacks'):
+            self._callbacks: list[Callable[[Settings, Settings], None]] = []
+        self._mtime = self._stat()
+        self.apply(self._read())
+
+    def _read(self) -> configparser.ConfigParser:
+        parser = configparser.ConfigParser()
+        parser.read(self._path)
+        apply_env_overrides(parser)
+        return parser
+
+    def _stat(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except OSError:
+            return None
+
+    def apply(self, parser: configparser.ConfigParser) -> Settings:
+        """validates parser and makes it current, raises pydantic.ValidationError and keeps the old one if invalid"""
+        settings = Settings.from_parser(parser)
+        self._config = parser
+        self._settings = settings
+        return settings
+
+    @property
+    def settings(self) -> Settings:
+        return self._settings
 
     def get_config(self):
         return self._config
 
+    def on_reload(self, callback: Callable[[Settings, Settings], None]):
+        """callback(old, new) runs after every successful reload"""
+        self._callbacks.append(callback)
+
+    def reload(self) -> Settings | None:
+        """re-reads the file and the environment, returns the new settings or None if they did not parse or validate"""
+        self._mtime = self._stat()
+        old = self._settings
+        try:
+            new = self.apply(self._read())
+        except (configparser.Error, pydantic.ValidationError) as e:
+            BaseLogger().log(40, '[ERROR] config reload rejected, keeping the current settings: %s', e)
+            return None
+        for callback in self._callbacks:
+            callback(old, new)
+        return new
+
+    async def watch(self, interval: float):
+        """reloads whenever the config file's mtime changes, checked every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            if self._stat() != self._mtime:
+                self.reload()
+
 
 def get_config():
     config = BaseConfig()
     return config.get_config()
+
+
+def get_settings() -> Settings:
+    return BaseConfig().settings
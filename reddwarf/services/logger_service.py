@@ -1,11 +1,116 @@
+import atexit
 import logging
 import queue
+import threading
 from logging.handlers import QueueHandler
 from logging.handlers import QueueListener
 from logging.handlers import RotatingFileHandler
 
 
+class LoggerStats:
+    __slots__ = ('enqueued', 'dropped', 'blocked', 'written', 'batches')
+
+    def __init__(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.written = 0
+        self.batches = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler over a bounded queue.
+    overflow='drop' discards the record when the queue is full, overflow='block' waits for room.
+    Records are enqueued as-is and formatted on the listener thread, unless format_records is set:
+    records crossing a process boundary are formatted first so they can be pickled.
+    """
+    def __init__(self, log_queue, stats: LoggerStats, overflow='drop', format_records=False):
+        super().__init__(log_queue)
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f"unsupported overflow policy {overflow}")
+        self.overflow = overflow
+        self.stats = stats
+        self.format_records = format_records
+
+    def prepare(self, record):
+        if self.format_records:
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == 'drop':
+                self.stats.dropped += 1
+                return
+            self.stats.blocked += 1
+            self.queue.put(record)
+        self.stats.enqueued += 1
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that only flushes once per batch written by BatchingQueueListener"""
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+
+class BatchingQueueListener(QueueListener):
+    """QueueListener draining up to batch_size records per wake up"""
+
+    def __init__(self, log_queue, *handlers, stats: LoggerStats, batch_size=256):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.stats = stats
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._write_batch(batch)
+            for _ in batch:
+                q.task_done()
+            if stop:
+                return
+
+    def _write_batch(self, batch) -> bool:
+        stop = False
+        for handler in self.handlers:
+            handler.batching = True
+        try:
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                    continue
+                self.handle(record)
+                self.stats.written += 1
+        finally:
+            for handler in self.handlers:
+                handler.batching = False
+                handler.flush()
+        self.stats.batches += 1
+        return stop
+
+
 class BaseLogger:
+    # until setup_logger() runs, services log straight to the stdlib root logger
+    root_logger = logging.getLogger()
+
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(BaseLogger, cls).__new__(cls)
@@ -14,17 +119,76 @@ class BaseLogger:
     def __init__(self):
         pass
 
-    def setup_logger(self, filename):
-        self.log_queue = queue.Queue(-1)
-        self.queue_handler = QueueHandler(self.log_queue)
-        self.rot_handler = RotatingFileHandler(filename)
-        self.queue_listener = QueueListener(self.log_queue, self.rot_handler)
+    def setup_logger(self, filename, level=10, queue_size=10000, overflow='drop', batch_size=256, log_queue=None):
+        """
+        The listener thread is started once here and lives until shutdown(),
+        log() only puts records on the queue.
+        log_queue is a multiprocessing queue shared with forked workers (setup_worker_logger),
+        this process is then the only one writing and rotating the log file.
+        """
+        if getattr(self, 'queue_listener', None) is not None:
+            self.shutdown()
+        self.stats = LoggerStats()
+        self.log_queue = queue.Queue(queue_size) if log_queue is None else log_queue
+        self.queue_handler = BoundedQueueHandler(
+            self.log_queue, self.stats, overflow=overflow, format_records=log_queue is not None
+        )
+        self.rot_handler = BatchedRotatingFileHandler(filename)
+        self.queue_listener = BatchingQueueListener(
+            self.log_queue, self.rot_handler, stats=self.stats, batch_size=batch_size
+        )
 
         self.root_logger = logging.getLogger()
-        self.root_logger.setLevel(10)
+        self.root_logger.setLevel(level)
         self.root_logger.addHandler(self.queue_handler)
-
-    def log(self, level, msg, exc_info=None):
         self.queue_listener.start()
-        self.root_logger.log(level=level, msg=msg, exc_info=exc_info)
-        self.queue_listener.stop()
+        atexit.register(self.shutdown)
+        self._lock = threading.Lock()
+
+    def setup_worker_logger(self, log_queue, level=10, overflow='drop'):
+        """
+        forked worker, records go to the log_queue of the parent's setup_logger(),
+        the worker never opens the log file itself
+        """
+        self.reset_after_fork()
+        self.stats = LoggerStats()
+        self.log_queue = log_queue
+        self.queue_handler = BoundedQueueHandler(log_queue, self.stats, overflow=overflow, format_records=True)
+        self.queue_listener = None
+        self.root_logger = logging.getLogger()
+        self.root_logger.setLevel(level)
+        self.root_logger.addHandler(self.queue_handler)
+        self._lock = threading.Lock()
+
+    def log(self, level, msg, *args, exc_info=None):
+        """msg is %-formatted with args on the listener thread, only if level is enabled"""
+        if not self.root_logger.isEnabledFor(level):
+            return
+        self.root_logger.log(level, msg, *args, exc_info=exc_info)
+
+    def is_enabled_for(self, level) -> bool:
+        return self.root_logger.isEnabledFor(level)
+
+    def get_stats(self) -> dict:
+        return {**self.stats.as_dict(), 'queued': self.log_queue.qsize()}
+
+    def reset_after_fork(self):
+        """drops the listener inherited from the parent process, its thread does not exist after a fork"""
+        if getattr(self, 'queue_handler', None) is None:
+            return
+        self.root_logger.removeHandler(self.queue_handler)
+        self.queue_handler = None
+        self.queue_listener = None
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        """flushes whatever is queued and stops the listener thread"""
+        listener = getattr(self, 'queue_listener', None)
+        if listener is None:
+            return
+        with self._lock:
+            if listener._thread is not None:
+                listener.stop()
+            self.root_logger.removeHandler(self.queue_handler)
+            self.rot_handler.close()
+            self.queue_listener = None
@@ -1,9 +1,54 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+
 import aiomysql
+import pymysql.converters
 
 from reddwarf.utils.sql import (
-    SQLDialect, InvalidSQLBuilderInstruction,
-    build_insert_query, build_select_query, build_delete_query, build_update_query
+    SQLDialect, InvalidSQLBuilderInstruction, IntList,
+    build_insert_query, build_bulk_update_query,
+    compile_select_query, compile_delete_query, compile_update_query, int_list_literal
 )
+from reddwarf.utils.pagination import encode_cursor, decode_cursor
+from reddwarf.services.cache_service import QueryCache
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.utils import profiling
+from reddwarf.utils.metrics import registry
+from reddwarf.utils.rows import RowFormat, format_rows, row_formatter
+
+
+db_query_seconds = registry.histogram(
+    'reddwarf_db_query_seconds', 'MySQL statement time, fetching included', ('table', 'op')
+)
+db_pool_wait_seconds = registry.histogram('reddwarf_db_pool_wait_seconds', 'MySQLPool.acquire() wait time')
+
+
+def _escape_int_list(val, mapping=None):
+    return int_list_literal(val)
+
+
+# aiomysql connections escape params through pymysql's global encoders
+pymysql.converters.encoders[IntList] = _escape_int_list
+
+
+def _timed(table, op):
+    """query timer, also adds to the current RPC profile when the call is being profiled"""
+    histogram = db_query_seconds.labels(table, op)
+    profile = profiling.active()
+    if profile is None:
+        return histogram.time()
+    return profile.phase(f"db:{op}:{table}", histogram)
+
+
+class MySQLPoolTimeout(Exception):
+    """no connection became available within acquire_timeout"""
+
+
+class NestedTransactionError(Exception):
+    """transaction() on another connection while one is open, the outer rollback could not undo it"""
 
 
 class MySQLPool:
@@ -19,78 +64,478 @@ class MySQLPool:
     def __init__(self):
         pass
 
-    async def create_mysql_pool(self, host, port, user, password, db, loop, autocommit=False):
-        port = int(port)
-        self._pool = await aiomysql.create_pool(
-            host=host, port=port, user=user, password=password,
-            db=db, loop=loop, autocommit=autocommit
+    async def create_mysql_pool(
+            self, host, port, user, password, db, loop, autocommit=False,
+            minsize=1, maxsize=10, pool_recycle=-1, connect_timeout=10,
+            acquire_timeout=None, prewarm=0, health_check_interval=0, lazy=False
+    ):
+        """
+        minsize connections are opened before this returns, prewarm opens up to that many more.
+        pool_recycle: seconds after which idle connections are reconnected, -1 never
+        acquire_timeout: seconds acquire() waits for a free connection before raising MySQLPoolTimeout
+        health_check_interval: seconds between background pings, 0 disables them
+        lazy: only store the settings, the pool is created by the first acquire()
+        """
+        self._settings = dict(
+            host=host, port=int(port), user=user, password=password,
+            db=db, loop=loop, autocommit=autocommit,
+            minsize=minsize, maxsize=maxsize, pool_recycle=pool_recycle,
+            connect_timeout=connect_timeout,
         )
-        print("mysql pool created!")
+        self._prewarm = prewarm
+        self._health_check_interval = health_check_interval
+        self._acquire_timeout = acquire_timeout
+        self._waiters = 0
+        self._timeouts = 0
+        self._acquire_latency = db_pool_wait_seconds.labels()
+        self._healthy = True
+        self._health_failures = 0
+        self._health_task = None
+        self._pool = None
+        self._connect_lock = asyncio.Lock()
+        if not lazy:
+            await self.connect()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self._pool is not None:
+                return self._pool
+            self._pool = await aiomysql.create_pool(**self._settings)
+            if self._prewarm > self._settings['minsize']:
+                await self.warm_up(self._prewarm)
+            if self._health_check_interval > 0:
+                self._health_task = asyncio.get_running_loop().create_task(
+                    self._health_check(self._health_check_interval)
+                )
+            print("mysql pool created!")
+            return self._pool
 
     def get_mysql_pool(self):
+        """None until connected when the pool is lazy, acquire() connects it"""
         # if self._pool is None:
         #     raise ConnectionError("MySQL Pool has not been created yet!")
         return self._pool
 
+    def configure(self, acquire_timeout=None):
+        """acquire_timeout None waits forever"""
+        self._acquire_timeout = acquire_timeout
+
+    @property
+    def acquire_timeout(self) -> float | None:
+        return self._acquire_timeout
+
+    @property
+    def maxsize(self) -> int:
+        return self._settings['maxsize']
+
+    @asynccontextmanager
+    async def acquire(self):
+        """pool.acquire() with acquire_timeout, waiter count and acquire latency recorded"""
+        pool = self._pool or await self.connect()
+        self._waiters += 1
+        started = time.perf_counter()
+        try:
+            if self._acquire_timeout:
+                conn = await asyncio.wait_for(pool.acquire(), self._acquire_timeout)
+            else:
+                conn = await pool.acquire()
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise MySQLPoolTimeout(f"no MySQL connection available after {self._acquire_timeout}s")
+        finally:
+            self._waiters -= 1
+            self._acquire_latency.observe(time.perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+    async def warm_up(self, n):
+        """opens connections until n are held by the pool (capped at maxsize)"""
+        if min(n, self._pool.maxsize) <= self._pool.size:
+            return
+        # acquire() hands out the idle connections first, they have to be held too
+        n = min(n, self._pool.maxsize) - self._pool.size + self._pool.freesize
+        conns = await asyncio.gather(*(self._pool.acquire() for _ in range(n)))
+        for conn in conns:
+            self._pool.release(conn)
+
+    async def _health_check(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with self.acquire() as conn:
+                    await conn.ping(reconnect=True)
+                self._healthy = True
+            except Exception:
+                self._healthy = False
+                self._health_failures += 1
+
+    def get_stats(self) -> dict:
+        pool = self._pool
+        return {
+            'connected': pool is not None,
+            'size': pool.size if pool else 0,
+            'minsize': self._settings['minsize'],
+            'maxsize': self._settings['maxsize'],
+            'in_use': pool.size - pool.freesize if pool else 0,
+            'idle': pool.freesize if pool else 0,
+            'waiters': self._waiters,
+            'acquire_timeouts': self._timeouts,
+            'healthy': self._healthy,
+            'health_check_failures': self._health_failures,
+            'acquire_latency': self._acquire_latency.snapshot(),
+        }
+
+    async def close(self):
+        """waits for acquired connections to be released, then closes them"""
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._pool is None:
+            return
+        self._pool.close()
+        await self._pool.wait_closed()
+        self._pool = None
+
 
 async def select_one(
         dbc, table, *,
         cols=None, where=None, limit=None,
-        offset=None, group_by=None
-) -> dict:
-    sql = build_select_query(
+        offset=None, group_by=None, row_format=RowFormat.DICT, cache_ttl=None
+) -> dict | None:
+    """
+    row_format: dict, tuple or named, see RowFormat
+    cache_ttl: seconds to serve this query from QueryCache, None bypasses the cache
+    """
+    sql, params = compile_select_query(
         table=table, cols=cols, where=where,
         limit=limit, offset=offset, group_by=group_by, dialect=SQLDialect.MySQL
     )
-    async with dbc.cursor() as cur:
-        await cur.execute(sql)
-        result_cols = [i[0] for i in cur.description]
-        result = dict(zip(result_cols, await cur.fetchone()))
-    return result
+    if cache_ttl:
+        return await _cached(
+            table, sql, params, row_format, cache_ttl,
+            lambda: select_one(dbc, table, cols=cols, where=where, limit=limit,
+                               offset=offset, group_by=group_by, row_format=row_format)
+        )
+    with _timed(table, 'select'):
+        async with dbc.cursor() as cur:
+            await cur.execute(sql, params)
+            result_cols = [i[0] for i in cur.description]
+            row = await cur.fetchone()
+    if row is None:
+        return None
+    return row_formatter(result_cols, row_format)(row)
 
 
 async def select_many(
         dbc, table, *,
         cols=None, where=None, limit=None,
-        offset=None, group_by=None
-) -> list[dict]:
-    sql = build_select_query(
+        offset=None, group_by=None, order_by=None, after=None,
+        row_format=RowFormat.DICT, cache_ttl=None
+) -> list[dict] | list[tuple] | dict:
+    """
+    row_format: see RowFormat, dicts per row by default
+    cache_ttl: seconds to serve this query from QueryCache, None bypasses the cache
+    """
+    sql, params = compile_select_query(
         table=table, cols=cols, where=where,
-        limit=limit, offset=offset, group_by=group_by, dialect=SQLDialect.MySQL
+        limit=limit, offset=offset, group_by=group_by,
+        order_by=order_by, after=after, dialect=SQLDialect.MySQL
     )
-    async with dbc.cursor() as cur:
-        await cur.execute(sql)
-        result_cols = [i[0] for i in cur.description]
-        result = [dict(zip(result_cols, row_tuple)) for row_tuple in await cur.fetchall()]
+    if cache_ttl:
+        return await _cached(
+            table, sql, params, row_format, cache_ttl,
+            lambda: select_many(dbc, table, cols=cols, where=where, limit=limit, offset=offset,
+                                group_by=group_by, order_by=order_by, after=after, row_format=row_format)
+        )
+    with _timed(table, 'select'):
+        async with dbc.cursor() as cur:
+            await cur.execute(sql, params)
+            result_cols = [i[0] for i in cur.description]
+            rows = await cur.fetchall()
+    return format_rows(result_cols, rows, row_format)
+
+
+async def select_many_in(
+        pool: 'MySQLPool', table, column, values, *,
+        cols=None, where=None, row_format=RowFormat.DICT, chunk_size=None, concurrency=None, dbc=None
+) -> list[dict] | list[tuple] | dict:
+    """
+    select_many with `column IN values` for very large value lists.
+    Duplicates are dropped and the list is split into chunk_size values per query, the queries run
+    concurrently on up to concurrency pool connections and the rows are merged (in chunk order),
+    so no statement outgrows max_allowed_packet and the list is built and sent once.
+    The chunks run one after another on dbc instead when the caller passes its connection,
+    and on the transaction's connection inside a transaction().
+    Fanning out over the pool takes at most maxsize - 1 connections and needs an acquire_timeout:
+    a caller holding a connection while every other one waits in acquire() would otherwise wait forever.
+    Without an acquire_timeout the chunks run one after another on a single pool connection.
+    No limit / order_by: they would apply per chunk.
+    """
+    if where is not None and column in where:
+        raise InvalidSQLBuilderInstruction(f"{column} is given both as the IN column and in where")
+    values = list(values)
+    # checked before de-duplicating: True == 1 would be merged with 1, and IN (NULL) never matches
+    types = set(map(type, values))
+    if bool in types or type(None) in types:
+        raise InvalidSQLBuilderInstruction(f"{column} IN values can not be booleans or None")
+    values = list(dict.fromkeys(values))
+    chunk_size = chunk_size or read_options['in_chunk_size']
+    # all ints: the chunks are IntLists already, compiling them does not scan them again
+    as_param = IntList if types == {int} else list
+    chunks = [as_param(values[start:start + chunk_size]) for start in range(0, len(values), chunk_size)]
+    if not chunks:
+        return format_rows([], [], row_format)
+
+    async def fetch(dbc, chunk):
+        sql, params = compile_select_query(
+            table=table, cols=cols, where={**(where or {}), column: chunk}, dialect=SQLDialect.MySQL
+        )
+        with _timed(table, 'select'):
+            async with dbc.cursor() as cur:
+                await cur.execute(sql, params)
+                return [i[0] for i in cur.description], await cur.fetchall()
+
+    tx = _transaction.get()
+    if tx is not None:
+        dbc = tx.dbc
+    concurrency = min(concurrency or read_options['in_concurrency'], pool.maxsize - 1)
+    if dbc is not None:
+        results = [await fetch(dbc, chunk) for chunk in chunks]
+    elif concurrency <= 1 or not pool.acquire_timeout:
+        async with pool.acquire() as dbc:
+            results = [await fetch(dbc, chunk) for chunk in chunks]
+    else:
+        slots = asyncio.Semaphore(concurrency)
+
+        async def fetch_pooled(chunk):
+            async with slots, pool.acquire() as dbc:
+                return await fetch(dbc, chunk)
+        results = await asyncio.gather(*map(fetch_pooled, chunks))
+    rows = []
+    for _, chunk_rows in results:
+        rows.extend(chunk_rows)
+    return format_rows(results[0][0], rows, row_format)
+
+
+async def _cached(table, sql, params, row_format, ttl, load):
+    cache = QueryCache()
+    if not cache.enabled:
+        return await load()
+    row_format = RowFormat(row_format)
+    if row_format in (RowFormat.NAMED, RowFormat.ARRAYS):
+        raise ValueError(f"{row_format} results can not be cached, they do not survive JSON")
+    key = cache.key(table, sql, params, row_format.value)
+    found, result = await cache.get(table, key)
+    if not found:
+        result = await load()
+        await cache.set(table, key, result, ttl)
+    elif row_format is RowFormat.TUPLE and result is not None:
+        # JSON brings tuples back as lists, select_one returns the row, select_many {"columns", "rows"}
+        if isinstance(result, dict):
+            result['rows'] = list(map(tuple, result['rows']))
+        else:
+            result = tuple(result)
     return result
 
 
+async def invalidate_cached(table):
+    """
+    runs after the write committed, a failure (Redis down) is logged and not raised:
+    the write succeeded and the cached entries expire with their ttl
+    """
+    cache = QueryCache()
+    if not cache.enabled:
+        return
+    try:
+        await cache.invalidate(table)
+    except Exception:
+        BaseLogger().log(40, '[ERROR] cache invalidation of %s failed, entries expire by ttl', table, exc_info=True)
+
+
+async def select_page(
+        dbc, table, *,
+        order_by, limit, cursor=None,
+        cols=None, where=None
+) -> dict:
+    """
+    Keyset pagination, every page costs the same however deep it is.
+    return: {"rows": [...], "next": continuation token or None on the last page}
+    """
+    after = decode_cursor(order_by, cursor) if cursor else None
+    rows = await select_many(
+        dbc, table, cols=cols, where=where,
+        limit=limit + 1, order_by=order_by, after=after
+    )
+    if len(rows) <= limit:
+        return {"rows": rows, "next": None}
+    rows = rows[:limit]
+    return {"rows": rows, "next": encode_cursor(order_by, rows[-1])}
+
+
+async def iter_many(
+        dbc, table, *,
+        cols=None, where=None, limit=None,
+        offset=None, group_by=None, order_by=None, batch_size=1000,
+        row_format=RowFormat.DICT
+) -> AsyncIterator[dict | tuple]:
+    """
+    Streams rows through an unbuffered server-side cursor (SSCursor), fetching batch_size rows at a time,
+    so memory stays bounded by the batch instead of the result set.
+    The connection is busy until the iterator is exhausted or closed.
+    """
+    sql, params = compile_select_query(
+        table=table, cols=cols, where=where,
+        limit=limit, offset=offset, group_by=group_by, order_by=order_by, dialect=SQLDialect.MySQL
+    )
+    async with dbc.cursor(aiomysql.SSCursor) as cur:
+        await cur.execute(sql, params)
+        to_row = row_formatter([i[0] for i in cur.description], row_format)
+        while rows := await cur.fetchmany(batch_size):
+            for row_tuple in rows:
+                yield to_row(row_tuple)
+
+
+stream_select = iter_many
+
+
+class Transaction:
+    __slots__ = ('dbc', 'tables')
+
+    def __init__(self, dbc):
+        self.dbc = dbc
+        self.tables: set[str] = set()
+
+
+_transaction: ContextVar[Transaction | None] = ContextVar('reddwarf_mysql_transaction', default=None)
+
+read_options = {
+    # values per query and queries in flight of select_many_in
+    'in_chunk_size': 5000,
+    'in_concurrency': 4,
+}
+
+# pymysql's default max_stmt_length, multi row INSERTs built by executemany are split at this size
+write_options = {
+    'max_packet_size': 1024000,
+    'bulk_update_chunk_size': 1000,
+}
+
+
+@asynccontextmanager
+async def transaction(dbc):
+    """
+    Unit of work, writes through this module on dbc inside the block share one commit
+    (rolled back if the block raises) and invalidate cached queries once it is committed.
+
+        async with transaction(dbc):
+            await insert_many(dbc, 'orders', orders)
+            await update_many(dbc, 'users', {'id': uid}, {'balance': balance})
+
+    Nested blocks must use the same connection, a nested transaction() on another
+    connection raises NestedTransactionError instead of committing on its own.
+    """
+    current = _transaction.get()
+    if current is not None:
+        if current.dbc is not dbc:
+            raise NestedTransactionError(
+                "a transaction is already open on another connection, pass its connection to nest"
+            )
+        # nested, the outermost block commits
+        yield current
+        return
+    tx = Transaction(dbc)
+    await dbc.begin()
+    token = _transaction.set(tx)
+    try:
+        yield tx
+    except BaseException:
+        await dbc.rollback()
+        raise
+    else:
+        await dbc.commit()
+    finally:
+        _transaction.reset(token)
+    for table in tx.tables:
+        await invalidate_cached(table)
+
+
+async def _written(dbc, table):
+    """commits right away unless a transaction on dbc is open"""
+    tx = _transaction.get()
+    if tx is not None and tx.dbc is dbc:
+        tx.tables.add(table)
+        return
+    await dbc.commit()
+    await invalidate_cached(table)
+
+
 async def remove_many(dbc, table, where):
     if not where:
         raise InvalidSQLBuilderInstruction("Empty where in DELETE clause is forbidden")
-    async with dbc.cursor() as cur:
-        sql = build_delete_query(table, where)
-        await cur.execute(sql)
-        await cur.execute('commit')
+    sql, params = compile_delete_query(table, where)
+    with _timed(table, 'delete'):
+        async with dbc.cursor() as cur:
+            await cur.execute(sql, params)
+    await _written(dbc, table)
 
 
-async def insert_many(dbc, table, data: list[dict]):
+async def insert_many(dbc, table, data: list[dict], *, on_duplicate=None, max_packet_size=None):
+    """
+    Rows are sent as multi row INSERT ... VALUES (...),(...) statements of at most max_packet_size bytes.
+    on_duplicate: columns to overwrite when the key already exists, True for all of them
+    """
     if not data:
         return
-    async with dbc.cursor() as cur:
-        sql, data = build_insert_query(table, data)
-        await cur.executemany(sql, data)
-        await cur.execute('commit')
+    sql, data = build_insert_query(table, data, on_duplicate=on_duplicate)
+    with _timed(table, 'insert'):
+        async with dbc.cursor() as cur:
+            cur.max_stmt_length = max_packet_size or write_options['max_packet_size']
+            await cur.executemany(sql, data)
+    await _written(dbc, table)
 
 
 async def insert_one(dbc, table, data: dict):
-    await insert_many(dbc, table, [data])
+    sql, _ = build_insert_query(table, [data])
+    with _timed(table, 'insert'):
+        async with dbc.cursor() as cur:
+            await cur.execute(sql, data)
+    await _written(dbc, table)
+
+
+async def upsert_many(dbc, table, data: list[dict], update_cols=None, *, max_packet_size=None):
+    """INSERT ... ON DUPLICATE KEY UPDATE, update_cols defaults to every inserted column"""
+    await insert_many(
+        dbc, table, data,
+        on_duplicate=update_cols or True, max_packet_size=max_packet_size
+    )
 
 
 async def update_many(dbc, table, where, data):
     if not where:
         raise InvalidSQLBuilderInstruction("Empty where in UPDATE clause is forbidden")
-    async with dbc.cursor() as cur:
-        sql = build_update_query(table, where, data)
-        await cur.execute(sql)
-        await cur.execute('COMMIT')
+    if not data:
+        return
+    sql, params = compile_update_query(table, where, data)
+    with _timed(table, 'update'):
+        async with dbc.cursor() as cur:
+            await cur.execute(sql, params)
+    await _written(dbc, table)
+
+
+async def update_many_by_key(dbc, table, key, rows: list[dict], *, chunk_size=None):
+    """
+    Applies per row updates keyed by primary key, chunk_size rows per UPDATE ... CASE statement.
+    rows: [{key: 1, 'col': new_value, ...}, ...]
+    """
+    if not rows:
+        return
+    chunk_size = chunk_size or write_options['bulk_update_chunk_size']
+    with _timed(table, 'update'):
+        async with dbc.cursor() as cur:
+            for start in range(0, len(rows), chunk_size):
+                query = build_bulk_update_query(table, key, rows[start:start + chunk_size])
+                if query is not None:
+                    await cur.execute(*query)
+    await _written(dbc, table)
@@ -10,11 +10,21 @@ class RedisConnection:
     def __init__(self):
         pass
 
-    async def initialize(self, host, port=None, username=None, password=None):
+    async def initialize(self, host, port=None, username=None, password=None, max_connections=None):
+        """connections are opened lazily by the first command"""
         self._connection = await aioredis.from_url(
             f'redis://{host}{":"+str(port) if port else ""}',
             username=username, password=password, decode_responses=True,
+            max_connections=max_connections,
         )
 
+    async def ping(self):
+        return await self._connection.ping()
+
+    async def close(self):
+        await self._connection.close()
+        await self._connection.connection_pool.disconnect()
+
     def get_pool(self):
-        return self._connection.client()
+        """the Redis client, every command borrows a connection from its pool (max_connections)"""
+        return self._connection
@@ -1,13 +1,51 @@
+import asyncio
+from typing import Iterator
+
 from starlette.websockets import WebSocket
+
+from reddwarf.exceptions import TooManyConnections
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.utils import codec
 from reddwarf.utils.context import get_current_user
 
+# policy violation, the client did not keep up with its send queue
+SLOW_CONSUMER_CLOSE_CODE = 1008
+
 
 def get_connection(endpoint):
     connection_manager = WSConnectionManager()
     return connection_manager.get_connection(f"{get_current_user()}::{endpoint.get_endpoint()}")
 
 
+def send_to_endpoint(endpoint, payload) -> bool:
+    """
+    sends payload to the current user's socket on endpoint, through the backplane when it runs
+    so the socket may live in any process, returns False if it was not delivered locally
+    """
+    return WSConnectionManager().deliver(f"{get_current_user()}::{endpoint.get_endpoint()}", payload)
+
+
+class ConnectionState:
+    """a registered socket, its indexes and its bounded send queue drained by a sender task"""
+    __slots__ = ('connection_id', 'websocket', 'user', 'endpoint', 'topics', 'queue', 'sender')
+
+    def __init__(self, connection_id, websocket, user, endpoint, send_queue_size):
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.user = user
+        self.endpoint = endpoint
+        self.topics: set[str] = set()
+        self.queue: asyncio.Queue[str] = asyncio.Queue(send_queue_size)
+        self.sender: asyncio.Task | None = None
+
+
 class WSConnectionManager:
+    """
+    Sockets are keyed `user::endpoint` and indexed by user, endpoint and subscribed topic.
+    Sends never await the socket: payloads are encoded once and put on each connection's bounded
+    send queue, a per connection task writes them out. A connection whose queue is full is evicted,
+    so one slow client can not hold back the others.
+    """
     def __new__(cls):
         if not hasattr(cls, 'instance'):
             cls.instance = super(WSConnectionManager, cls).__new__(cls)
@@ -16,17 +54,185 @@ class WSConnectionManager:
     def __init__(self):
         pass
 
-    def initialize(self, max_clients=10000):
-        self._connections: dict[str, WebSocket] = {}
+    def initialize(self, max_clients=10000, send_queue_size=256):
+        self._max_clients = max_clients
+        self._send_queue_size = send_queue_size
+        self._connections: dict[str, ConnectionState] = {}
+        self._by_user: dict[str, set[str]] = {}
+        self._by_endpoint: dict[str, set[str]] = {}
+        self._topics: dict[str, set[str]] = {}
+        # close() of evicted sockets, referenced until done so they are not garbage collected
+        self._closing: set[asyncio.Task] = set()
+        self.evicted = 0
+        self.sent = 0
+        # WSBackplane, told about registrations so other processes can route to this one
+        self.backplane = None
+
+    def configure(self, max_clients=None, send_queue_size=None):
+        """send_queue_size applies to connections registered from now on"""
+        if max_clients is not None:
+            self._max_clients = max_clients
+        if send_queue_size is not None:
+            self._send_queue_size = send_queue_size
 
     def get_connection(self, connection_id: str) -> WebSocket | None:
-        return self._connections.get(connection_id)
+        state = self._connections.get(connection_id)
+        return state.websocket if state is not None else None
+
+    def get_all_connections(self) -> Iterator[WebSocket]:
+        return (state.websocket for state in self._connections.values())
+
+    def get_all_connection_ids(self) -> list[str]:
+        return list(self._connections)
 
-    def get_all_connections(self) -> list[WebSocket]:
-        return list(self._connections.values())
+    def get_user_connections(self, user: str) -> list[str]:
+        return list(self._by_user.get(user, ()))
+
+    def get_endpoint_connections(self, endpoint: str) -> list[str]:
+        return list(self._by_endpoint.get(endpoint, ()))
+
+    def count(self) -> int:
+        return len(self._connections)
 
     def register_connection(self, connection_id: str, new_connection: WebSocket):
-        self._connections[connection_id] = new_connection
+        existing = self._connections.get(connection_id)
+        if existing is None and len(self._connections) >= self._max_clients:
+            raise TooManyConnections(f"{self._max_clients} websocket connections reached")
+        if existing is not None:
+            self._evict(existing, code=1000)
+        user, _, endpoint = connection_id.partition('::')
+        state = ConnectionState(connection_id, new_connection, user, endpoint, self._send_queue_size)
+        state.sender = asyncio.get_running_loop().create_task(self._sender(state))
+        self._connections[connection_id] = state
+        self._by_user.setdefault(user, set()).add(connection_id)
+        self._by_endpoint.setdefault(endpoint, set()).add(connection_id)
+        if self.backplane is not None:
+            self.backplane.connection_added(connection_id)
+
+    def unregister_connection(self, connection_id) -> WebSocket | None:
+        state = self._connections.pop(connection_id, None)
+        if state is None:
+            return None
+        if state.sender is not None and state.sender is not asyncio.current_task():
+            state.sender.cancel()
+        self._discard(self._by_user, state.user, connection_id)
+        self._discard(self._by_endpoint, state.endpoint, connection_id)
+        for topic in state.topics:
+            self._discard(self._topics, topic, connection_id)
+        if self.backplane is not None:
+            self.backplane.connection_removed(connection_id)
+        return state.websocket
+
+    def subscribe(self, connection_id: str, topic: str):
+        state = self._connections.get(connection_id)
+        if state is None:
+            return
+        state.topics.add(topic)
+        self._topics.setdefault(topic, set()).add(connection_id)
+
+    def unsubscribe(self, connection_id: str, topic: str):
+        state = self._connections.get(connection_id)
+        if state is not None:
+            state.topics.discard(topic)
+        self._discard(self._topics, topic, connection_id)
+
+    def send(self, connection_id: str, payload) -> bool:
+        """queues payload for one connection, False if it is not connected here"""
+        state = self._connections.get(connection_id)
+        if state is None:
+            return False
+        return self._enqueue(state, codec.dumps(payload).decode())
+
+    def deliver(self, connection_id: str, payload) -> bool:
+        """send() through the backplane when it runs, the connection may then live in any process"""
+        if self.backplane is not None:
+            return self.backplane.send(connection_id, payload)
+        return self.send(connection_id, payload)
+
+    def send_to_user(self, user: str, payload) -> int:
+        return self._fan_out(self._by_user.get(user, ()), payload)
+
+    def broadcast(self, payload, topic: str = None, endpoint: str = None) -> int:
+        """
+        queues payload for every connection subscribed to topic / on endpoint (all connections if neither),
+        the payload is serialized once, returns the number of connections it was queued for
+        """
+        if topic is not None:
+            targets = self._topics.get(topic, ())
+            if endpoint is not None:
+                targets = [cid for cid in targets if self._connections[cid].endpoint == endpoint]
+        elif endpoint is not None:
+            targets = self._by_endpoint.get(endpoint, ())
+        else:
+            targets = self._connections.keys()
+        return self._fan_out(targets, payload)
+
+    def _fan_out(self, connection_ids, payload) -> int:
+        text = codec.dumps(payload).decode()
+        queued = 0
+        for state in [self._connections[cid] for cid in connection_ids]:
+            queued += self._enqueue(state, text)
+        return queued
+
+    def _enqueue(self, state: ConnectionState, text: str) -> bool:
+        try:
+            state.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self._evict(state)
+            return False
+        return True
+
+    async def _sender(self, state: ConnectionState):
+        websocket = state.websocket
+        try:
+            while True:
+                text = await state.queue.get()
+                await websocket.send_text(text)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.unregister_connection(state.connection_id)
+
+    def _evict(self, state: ConnectionState, code=SLOW_CONSUMER_CLOSE_CODE):
+        if code == SLOW_CONSUMER_CLOSE_CODE:
+            self.evicted += 1
+        self.unregister_connection(state.connection_id)
+        task = asyncio.get_running_loop().create_task(self._close(state.websocket, code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            # usually the client is already gone
+            BaseLogger().log(10, '[DEBUG] closing websocket with %s failed', code, exc_info=True)
+
+    async def close_all(self, code=1001):
+        """closes every socket, 1001 going away"""
+        states = list(self._connections.values())
+        for state in states:
+            self.unregister_connection(state.connection_id)
+        await asyncio.gather(*(self._close(state.websocket, code) for state in states), *self._closing)
+
+    def get_stats(self) -> dict:
+        return {
+            'connections': len(self._connections),
+            'max_clients': self._max_clients,
+            'topics': len(self._topics),
+            'queued': sum(state.queue.qsize() for state in self._connections.values()),
+            'sent': self.sent,
+            'evicted': self.evicted,
+            'closing': len(self._closing),
+        }
 
-    def unregister_connection(self, connection_id) -> WebSocket:
-        return self._connections.pop(connection_id)
+    @staticmethod
+    def _discard(index: dict[str, set[str]], key, connection_id):
+        ids = index.get(key)
+        if ids is None:
+            return
+        ids.discard(connection_id)
+        if not ids:
+            del index[key]
@@ -0,0 +1,119 @@
+import asyncio
+import contextvars
+
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.services.mysql_service import MySQLPool, insert_many, insert_one, invalidate_cached, transaction
+
+
+class WriteCoalescer:
+    """
+    Coalesces single row inserts from concurrent requests into multi row insert_many calls.
+    Rows for the same table (and column set) are buffered until max_batch rows are waiting
+    or max_delay seconds passed since the first one, then written and committed in one go.
+    insert() returns once its row is committed. If the batch INSERT or its COMMIT fails nothing
+    was written and every row is retried on its own, so each caller gets its own result or error;
+    nothing after the commit (cache invalidation) can make a batch run again.
+    """
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super(WriteCoalescer, cls).__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        pass
+
+    def initialize(self, pool: MySQLPool = None, max_batch=500, max_delay=0.005):
+        self._pool = pool or MySQLPool()
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._buffers: dict[tuple, list[tuple[dict, asyncio.Future]]] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        self._flushing: set[asyncio.Task] = set()
+        self.batches = 0
+        self.rows = 0
+        self.fallbacks = 0
+
+    def configure(self, max_batch=None, max_delay=None):
+        if max_batch is not None:
+            self._max_batch = max_batch
+        if max_delay is not None:
+            self._max_delay = max_delay
+
+    async def insert(self, table, row: dict):
+        key = (table, tuple(row))
+        future = asyncio.get_running_loop().create_future()
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append((row, future))
+        if len(buffer) >= self._max_batch:
+            self._start_flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self._max_delay, self._start_flush, key)
+        await future
+
+    def _start_flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._buffers.pop(key, None)
+        if not batch:
+            return
+        # a fresh context: the batch is not part of a transaction() the first caller may have open
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._flush(key[0], batch))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, table, batch):
+        committed = False
+        try:
+            async with self._pool.acquire() as dbc:
+                async with transaction(dbc) as tx:
+                    await insert_many(dbc, table, [row for row, _ in batch])
+                    # invalidated below, once the batch is known to be committed
+                    tx.tables.clear()
+                committed = True
+        except Exception:
+            if not committed:
+                self.fallbacks += 1
+                await self._flush_one_by_one(table, batch)
+                return
+            BaseLogger().log(40, '[ERROR] releasing the connection of a committed %s batch failed', table, exc_info=True)
+        self.batches += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        await invalidate_cached(table)
+
+    async def _flush_one_by_one(self, table, batch):
+        for row, future in batch:
+            try:
+                async with self._pool.acquire() as dbc:
+                    await insert_one(dbc, table, row)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.rows += 1
+                if not future.done():
+                    future.set_result(None)
+
+    async def flush(self):
+        """writes everything buffered and waits for in flight batches"""
+        for key in list(self._buffers):
+            self._start_flush(key)
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+    def get_stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'fallbacks': self.fallbacks,
+            'buffered': sum(len(buffer) for buffer in self._buffers.values()),
+            'in_flight': len(self._flushing),
+        }
+
+
+async def buffered_insert(table, row: dict):
+    """insert_one through the WriteCoalescer, returns once the row is committed"""
+    await WriteCoalescer().insert(table, row)
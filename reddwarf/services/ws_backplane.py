@@ -0,0 +1,251 @@
+import asyncio
+import math
+from uuid import uuid4
+
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.services.websocket_service import WSConnectionManager
+from reddwarf.utils import codec
+
+# deletes a directory entry only if it still points at this node
+_UNREGISTER_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class WSBackplane:
+    """
+    Routes websocket sends between processes through Redis pub/sub.
+    Every process (node) subscribes to its own channel and to a shared broadcast channel,
+    a Redis hash maps connection ids (`user::endpoint`) to the node holding the socket.
+    Outbound messages are buffered and flushed every flush_interval seconds:
+    one PUBLISH per target node per flush, carrying every message for that node.
+    Registrations are flushed the same way, only the last change of a connection id within
+    a flush reaches the directory (a reconnect inside one window stays registered).
+    Every node refreshes an `alive` key with a node_ttl expiry; directory entries of a node
+    whose key expired (it died without stop()) are deleted by the first node routing to them,
+    and the whole directory expires node_ttl after the last node is gone.
+    """
+    def __new__(cls):
+        if not hasattr(cls, 'instance'):
+            cls.instance = super(WSBackplane, cls).__new__(cls)
+        return cls.instance
+
+    def __init__(self):
+        pass
+
+    def initialize(
+            self, redis, manager: WSConnectionManager = None, prefix='rdw:ws', flush_interval=0.002, node_ttl=30.0
+    ):
+        self._redis = redis
+        self._manager = manager or WSConnectionManager()
+        self._prefix = prefix
+        self._flush_interval = flush_interval
+        self._node_ttl = node_ttl
+        self.node_id = uuid4().hex
+        self._directory = f"{prefix}:conn"
+        self._alive_key = self._alive(self.node_id)
+        self._node_channel = f"{prefix}:node:{self.node_id}"
+        self._broadcast_channel = f"{prefix}:all"
+        self._direct: list[tuple[str, object]] = []
+        self._fanout: list[dict] = []
+        # connection id -> registered, the last change wins
+        self._membership: dict[str, bool] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self.published = 0
+        self.delivered = 0
+        self.undeliverable = 0
+        self.reconnects = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self):
+        await self._beat()
+        await self._subscribe()
+        self._manager.backplane = self
+        for connection_id in self._manager.get_all_connection_ids():
+            self.connection_added(connection_id)
+        loop = asyncio.get_running_loop()
+        self._tasks = [
+            loop.create_task(self._listen()), loop.create_task(self._flusher()), loop.create_task(self._heartbeat()),
+        ]
+
+    async def _subscribe(self):
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self._node_channel, self._broadcast_channel)
+
+    async def stop(self):
+        self._manager.backplane = None
+        for connection_id in self._manager.get_all_connection_ids():
+            self._membership[connection_id] = False
+        await self.flush()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self._redis.delete(self._alive_key)
+        await self._pubsub.unsubscribe()
+        await self._pubsub.close()
+
+    # called by WSConnectionManager
+    def connection_added(self, connection_id):
+        self._membership[connection_id] = True
+        self._wakeup.set()
+
+    def connection_removed(self, connection_id):
+        self._membership[connection_id] = False
+        self._wakeup.set()
+
+    def send(self, connection_id: str, payload) -> bool:
+        """delivers locally when the socket is here, otherwise routes it to the node holding it"""
+        if self._manager.send(connection_id, payload):
+            return True
+        self._direct.append((connection_id, payload))
+        self._wakeup.set()
+        return False
+
+    def send_to_user(self, user: str, payload) -> int:
+        self._fanout.append({"u": user, "p": payload})
+        self._wakeup.set()
+        return self._manager.send_to_user(user, payload)
+
+    def broadcast(self, payload, topic: str = None, endpoint: str = None) -> int:
+        self._fanout.append({"t": topic, "e": endpoint, "p": payload})
+        self._wakeup.set()
+        return self._manager.broadcast(payload, topic=topic, endpoint=endpoint)
+
+    async def _flusher(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                BaseLogger().log(40, '[ERROR] websocket backplane flush failed', exc_info=True)
+
+    async def flush(self):
+        membership, self._membership = self._membership, {}
+        try:
+            await self._flush_membership(membership)
+        except Exception:
+            # retried with the next flush, changes made since then are newer and win;
+            # the buffered messages stay queued for it as well
+            for connection_id, registered in membership.items():
+                self._membership.setdefault(connection_id, registered)
+            raise
+        direct, self._direct = self._direct, []
+        fanout, self._fanout = self._fanout, []
+
+        by_node: dict[str, list[dict]] = {}
+        if direct:
+            nodes = await self._redis.hmget(self._directory, [cid for cid, _ in direct])
+            for (connection_id, payload), node in zip(direct, nodes):
+                if node is None or node == self.node_id:
+                    self.undeliverable += 1
+                    continue
+                by_node.setdefault(node, []).append({"c": connection_id, "p": payload})
+            await self._drop_dead_nodes(by_node)
+
+        if not by_node and not fanout:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for node, messages in by_node.items():
+                pipe.publish(f"{self._prefix}:node:{node}", self._envelope(messages))
+            if fanout:
+                pipe.publish(self._broadcast_channel, self._envelope(fanout))
+            await pipe.execute()
+        self.published += len(by_node) + bool(fanout)
+
+    async def _flush_membership(self, membership: dict[str, bool]):
+        for connection_id, registered in membership.items():
+            if not registered:
+                await self._redis.eval(_UNREGISTER_SCRIPT, 1, self._directory, connection_id, self.node_id)
+        registered = [connection_id for connection_id, registered in membership.items() if registered]
+        if registered:
+            await self._redis.hset(self._directory, mapping={cid: self.node_id for cid in registered})
+
+    async def _drop_dead_nodes(self, by_node: dict[str, list[dict]]):
+        """messages for nodes that stopped refreshing their alive key are undeliverable, their entries go"""
+        if not by_node:
+            return
+        nodes = list(by_node)
+        for node, alive in zip(nodes, await self._redis.mget([self._alive(node) for node in nodes])):
+            if alive is not None:
+                continue
+            for m in by_node.pop(node):
+                self.undeliverable += 1
+                await self._redis.eval(_UNREGISTER_SCRIPT, 1, self._directory, m["c"], node)
+
+    def _alive(self, node) -> str:
+        return f"{self._prefix}:alive:{node}"
+
+    async def _beat(self):
+        ttl = math.ceil(self._node_ttl)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._alive_key, 1, ex=ttl)
+            pipe.expire(self._directory, ttl)
+            await pipe.execute()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self._node_ttl / 3)
+            try:
+                await self._beat()
+            except Exception:
+                BaseLogger().log(40, '[ERROR] websocket backplane heartbeat failed', exc_info=True)
+
+    def _envelope(self, messages) -> str:
+        return codec.dumps({"n": self.node_id, "m": messages}).decode()
+
+    async def _listen(self, max_backoff=5.0):
+        """resubscribes with exponential backoff when the pub/sub connection fails"""
+        backoff = 0.1
+        while True:
+            try:
+                async for message in self._pubsub.listen():
+                    backoff = 0.1
+                    if message['type'] != 'message':
+                        continue
+                    envelope = codec.loads(message['data'])
+                    if envelope["n"] == self.node_id:
+                        continue
+                    for m in envelope["m"]:
+                        self._deliver(m)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                BaseLogger().log(
+                    40, '[ERROR] websocket backplane subscription lost, resubscribing in %ss', backoff, exc_info=True
+                )
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            try:
+                await self._pubsub.close()
+                await self._subscribe()
+                self.reconnects += 1
+            except Exception:
+                BaseLogger().log(40, '[ERROR] websocket backplane resubscribe failed', exc_info=True)
+
+    def _deliver(self, m: dict):
+        match m:
+            case {"c": connection_id, "p": payload}:
+                self.delivered += self._manager.send(connection_id, payload)
+            case {"u": user, "p": payload}:
+                self.delivered += self._manager.send_to_user(user, payload)
+            case {"t": topic, "e": endpoint, "p": payload}:
+                self.delivered += self._manager.broadcast(payload, topic=topic, endpoint=endpoint)
+
+    def get_stats(self) -> dict:
+        return {
+            'node_id': self.node_id,
+            'published': self.published,
+            'delivered': self.delivered,
+            'undeliverable': self.undeliverable,
+            'reconnects': self.reconnects,
+            'pending': len(self._direct) + len(self._fanout),
+        }
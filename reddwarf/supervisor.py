@@ -0,0 +1,192 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+
+class WorkerSupervisor:
+    """
+    Pre-fork multi process mode for RedDwarf.
+
+    The listening socket is created once in the supervisor and inherited by every forked worker
+    (hypercorn binds to it through fd://), or with reuse_port each worker binds its own
+    SO_REUSEPORT socket and the kernel balances connections between them.
+    Every worker creates its own event loop and connection pools after the fork,
+    log records are sent to the supervisor which is the only process writing the log file.
+
+    signals:
+        SIGTERM / SIGINT: drain workers (hypercorn graceful_timeout) and exit
+        SIGHUP: graceful reload, re-read the config (including bind, workers and reuse_port),
+                start a new generation of workers then drain the old one
+        SIGUSR1: forwarded to the workers, which reload their settings in place
+    workers that die unexpectedly are restarted, a worker exiting within min_uptime of its start
+    is restarted after an exponential backoff, after max_crashes such exits in a row the supervisor gives up
+    """
+    def __init__(self, server, check_interval=0.5, min_uptime=5.0, max_backoff=30.0, max_crashes=5):
+        self._server = server
+        self._check_interval = check_interval
+        self._min_uptime = min_uptime
+        self._max_backoff = max_backoff
+        self._max_crashes = max_crashes
+        self._context = multiprocessing.get_context('fork')
+        self._logger = server.get_logger()
+        self._log_queue = None
+        self._workers = 1
+        self._reuse_port = False
+        self._processes: list[multiprocessing.Process | None] = []
+        self._started: list[float] = []
+        self._crashes: list[int] = []
+        self._respawn_at: list[float] = []
+        self._stopping = False
+        self._reloading = False
+        self._failed = False
+
+    def run(self):
+        self._log_queue = self._server.share_logger(self._context)
+        config, sockets = self._load(None, [])
+        previous = {
+            sig: signal.signal(sig, self._on_signal)
+            for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1)
+        }
+        try:
+            self._start_generation(config, sockets)
+            while not self._stopping:
+                time.sleep(self._check_interval)
+                if self._reloading:
+                    self._reloading = False
+                    self._server._config.reload()
+                    old, old_config, old_sockets = self._processes, config, sockets
+                    config, sockets = self._load(old_config, old_sockets)
+                    self._start_generation(config, sockets)
+                    self._drain(old, old_config.graceful_timeout)
+                    if sockets is not old_sockets:
+                        for sock in old_sockets:
+                            sock.close()
+                    continue
+                self._check_workers(config, sockets)
+            self._drain(self._processes, config.graceful_timeout)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            for sock in sockets:
+                sock.close()
+        if self._failed:
+            raise SystemExit(1)
+
+    def _load(self, previous, sockets):
+        """hypercorn config and worker count from the current settings, the sockets are kept if the bind did not change"""
+        settings = self._server._config.settings.default
+        config = self._server.get_hypercorn_config()
+        reuse_port = settings.reuse_port
+        self._workers = max(settings.workers, 1)
+        if previous is None or config.bind != previous.bind or reuse_port != self._reuse_port:
+            sockets = [] if reuse_port else self._create_sockets(config.bind, config.backlog)
+        self._reuse_port = reuse_port
+        return config, sockets
+
+    def _start_generation(self, config, sockets):
+        now = time.monotonic()
+        self._processes = [self._spawn(config, sockets) for _ in range(self._workers)]
+        self._started = [now] * self._workers
+        self._crashes = [0] * self._workers
+        self._respawn_at = [now] * self._workers
+
+    def _check_workers(self, config, sockets):
+        now = time.monotonic()
+        for i, process in enumerate(self._processes):
+            if self._stopping:
+                return
+            if process is None:
+                if now >= self._respawn_at[i]:
+                    self._processes[i] = self._spawn(config, sockets)
+                    self._started[i] = now
+                continue
+            if process.is_alive():
+                continue
+            if now - self._started[i] < self._min_uptime:
+                self._crashes[i] += 1
+            else:
+                self._crashes[i] = 0
+            if self._crashes[i] >= self._max_crashes:
+                self._logger.log(
+                    50, '[CRITICAL] worker %s exited with %s, %s crashes within %ss of start, giving up',
+                    process.pid, process.exitcode, self._crashes[i], self._min_uptime,
+                )
+                self._failed = True
+                self._stopping = True
+                return
+            delay = self.backoff(self._crashes[i])
+            self._logger.log(
+                30, '[WARNING] worker %s exited with %s, restarting in %.1fs', process.pid, process.exitcode, delay
+            )
+            self._processes[i] = None
+            self._respawn_at[i] = now + delay
+
+    def backoff(self, crashes: int) -> float:
+        """no delay after a worker that ran for a while, then check_interval doubling up to max_backoff"""
+        if crashes == 0:
+            return 0.0
+        return min(self._check_interval * 2 ** (crashes - 1), self._max_backoff)
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reloading = True
+        elif signum == signal.SIGUSR1:
+            for process in self._processes:
+                if process is not None and process.is_alive():
+                    os.kill(process.pid, signal.SIGUSR1)
+        else:
+            self._stopping = True
+
+    def _spawn(self, config, sockets) -> multiprocessing.Process:
+        process = self._context.Process(target=self._worker_main, args=(config, sockets), daemon=False)
+        process.start()
+        return process
+
+    def _worker_main(self, config, sockets):
+        # SIGUSR1 is handled by the worker's loop once it started (config_reload_signal)
+        for sig in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(sig, signal.SIG_IGN)
+        if self._reuse_port:
+            sockets = self._create_sockets(config.bind, config.backlog, reuse_port=True)
+        config.bind = [f"fd://{sock.fileno()}" for sock in sockets]
+        shutdown = asyncio.Event()
+
+        def request_shutdown(*_):
+            self._server._loop.call_soon_threadsafe(shutdown.set)
+
+        signal.signal(signal.SIGTERM, request_shutdown)
+        self._server.run_worker(config, shutdown.wait, self._log_queue)
+
+    @staticmethod
+    def _drain(processes, graceful_timeout):
+        processes = [process for process in processes if process is not None]
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + graceful_timeout + 5
+        for process in processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    @staticmethod
+    def _create_sockets(binds, backlog, reuse_port=False) -> list[socket.socket]:
+        sockets = []
+        for bind in binds:
+            host, _, port = bind.rpartition(':')
+            host = host.strip('[]')
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((host, int(port)))
+            sock.listen(backlog)
+            sock.setblocking(False)
+            sock.set_inheritable(True)
+            sockets.append(sock)
+        return sockets
@@ -1,6 +1,10 @@
-import jwt
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+import jwt
+
 from reddwarf.services.config_service import BaseConfig
 
 
@@ -8,28 +12,116 @@ def make_salt():
     return 'salty-as-f'
 
 
+_secret = None
+
+
+def get_secret() -> str:
+    """APP SECRET, resolved from config on first use"""
+    global _secret
+    if _secret is None:
+        _secret = BaseConfig().settings.default.secret
+    return _secret
+
+
+def reset_secret():
+    global _secret
+    _secret = None
+    token_cache.clear()
+
+
+class TokenCache:
+    """
+    Bounded LRU of verified tokens keyed by token digest.
+    An entry is valid until the earlier of its ttl and the token's own expire_at.
+    """
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[bytes, tuple[dict, float, datetime]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, key: bytes) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        user, cached_until, expire_at = entry
+        if cached_until < time.monotonic() or expire_at < datetime.now():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return user
+
+    def put(self, key: bytes, user: dict, expire_at: datetime):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (user, time.monotonic() + self.ttl, expire_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, max_size=None, ttl=None):
+        if max_size is not None:
+            self.max_size = max_size
+        if ttl is not None:
+            self.ttl = ttl
+        while len(self._entries) > max(self.max_size, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'size': len(self._entries),
+        }
+
+
+token_cache = TokenCache()
+
+
+def _expire_at(decoded: dict) -> datetime | None:
+    match decoded:
+        case {"expire_at": expire_at}:
+            # create_token writes a local timestamp, compared against local datetime.now()
+            return datetime.fromtimestamp(float(expire_at))
+        case _:
+            return None
+
+
 def authenticate_token(token: str) -> dict | None:
     """
     token: jwt
     secret: APP SECRET
-    return: user dict
+    return: user dict, verified tokens are served from token_cache until they expire
     """
-    SECRET = BaseConfig().get_config()['DEFAULT']['secret']
     if not token:
         return None
-    decoded = jwt.decode(token, SECRET, algorithms='HS256')
-    match decoded:
-        case {"expire_at": expire_at}:
-            if datetime.utcfromtimestamp(float(expire_at)) < datetime.now():
-                return None
-            return decoded
-        case _:
-            return None
+    key = TokenCache.key(token)
+    user = token_cache.get(key)
+    if user is not None:
+        return user
+    decoded = jwt.decode(token, get_secret(), algorithms='HS256')
+    expire_at = _expire_at(decoded)
+    if expire_at is None or expire_at < datetime.now():
+        return None
+    token_cache.put(key, decoded, expire_at)
+    return decoded
 
 
 def create_token(user: dict):
-    SECRET = BaseConfig().get_config()['DEFAULT']['secret']
     return jwt.encode(
         {**user, "expire_at": str((datetime.now()+timedelta(days=24)).timestamp())},
-        SECRET, algorithm='HS256'
+        get_secret(), algorithm='HS256'
     )
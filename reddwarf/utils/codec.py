@@ -0,0 +1,86 @@
+import datetime
+import json
+import decimal
+import uuid
+from array import array
+from typing import Any, Callable
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
+
+
+def _default(obj):
+    match obj:
+        case decimal.Decimal():
+            return str(obj)
+        case datetime.datetime() | datetime.date() | datetime.time():
+            # what orjson emits natively, both codecs produce the same wire format
+            return obj.isoformat()
+        case uuid.UUID():
+            return str(obj)
+        case set() | frozenset():
+            return list(obj)
+        case array():
+            return obj.tolist()
+        case tuple():
+            # namedtuple rows
+            return list(obj)
+        case _:
+            raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+class JSONCodec:
+    """
+    loads: bytes | str -> object
+    dumps: object -> bytes
+    """
+    def __init__(self, loads: Callable[[bytes | str], Any], dumps: Callable[[Any], bytes], name='custom'):
+        self.loads = loads
+        self.dumps = dumps
+        self.name = name
+
+    def __repr__(self):
+        return f"<JSONCodec {self.name}>"
+
+
+def _stdlib_dumps(obj) -> bytes:
+    return json.dumps(
+        obj, ensure_ascii=False, allow_nan=False,
+        separators=(',', ':'), default=_default
+    ).encode('utf-8')
+
+
+def _orjson_dumps(obj) -> bytes:
+    try:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError as e:
+        # orjson only takes 64 bit ints, json does any size
+        if 'Integer exceeds' not in str(e):
+            raise
+        return _stdlib_dumps(obj)
+
+
+STDLIB_CODEC = JSONCodec(json.loads, _stdlib_dumps, name='json')
+ORJSON_CODEC = JSONCodec(orjson.loads, _orjson_dumps, name='orjson') if orjson else None
+
+_codec = ORJSON_CODEC or STDLIB_CODEC
+
+
+def get_json_codec() -> JSONCodec:
+    return _codec
+
+
+def set_json_codec(codec: JSONCodec | None):
+    """passing None restores the default (orjson when installed, json otherwise)"""
+    global _codec
+    _codec = codec if codec is not None else (ORJSON_CODEC or STDLIB_CODEC)
+
+
+def loads(data: bytes | str):
+    return _codec.loads(data)
+
+
+def dumps(obj) -> bytes:
+    return _codec.dumps(obj)
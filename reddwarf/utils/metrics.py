@@ -0,0 +1,161 @@
+import bisect
+import time
+
+# seconds, tuned for pool waits and queries
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """cumulative-bucket latency histogram, observe() is a bisect and two adds"""
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative = 0
+        buckets = {}
+        for bound, n in zip((*self.buckets, float('inf')), self.counts):
+            cumulative += n
+            buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+    def time(self) -> 'Timer':
+        """with histogram.time(): ..."""
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class MetricFamily:
+    """
+    One metric name and its children, one per combination of label values.
+    Resolve children once (at registration, per table, ...) and keep them,
+    labels() is a dict lookup but the hot path does not need to pay it.
+    """
+    __slots__ = ('name', 'help', 'type', 'label_names', 'children', '_factory')
+
+    def __init__(self, name, help, type, label_names, factory):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = tuple(label_names)
+        self.children: dict[tuple, Histogram | Counter] = {}
+        self._factory = factory
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}")
+            child = self.children[values] = self._factory()
+        return child
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Histograms and counters updated in place on the hot path, gauges sampled by a callback
+    when the registry is rendered. render() produces the Prometheus text format (0.0.4).
+    Every process has its own registry, with several workers each scrape sees one of them.
+    """
+    def __init__(self):
+        self._families: dict[str, MetricFamily] = {}
+        self._gauges: dict[str, tuple[str, tuple, object]] = {}
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_LATENCY_BUCKETS) -> MetricFamily:
+        return self._family(name, help, 'histogram', labels, lambda: Histogram(buckets))
+
+    def counter(self, name, help, labels=()) -> MetricFamily:
+        return self._family(name, help, 'counter', labels, Counter)
+
+    def gauge(self, name, help, callback, labels=()):
+        """callback() -> number, or {label values tuple: number} when labels are given"""
+        self._gauges[name] = (help, tuple(labels), callback)
+
+    def _family(self, name, help, type, labels, factory) -> MetricFamily:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(name, help, type, labels, factory)
+        elif family.type != type or family.label_names != tuple(labels):
+            raise ValueError(f"{name} is already registered as a {family.type} with labels {family.label_names}")
+        return family
+
+    def render(self) -> str:
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for values, child in family.children.items():
+                if family.type == 'counter':
+                    lines.append(f"{family.name}{_format_labels(family.label_names, values)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, n in zip((*child.buckets, float('inf')), child.counts):
+                    cumulative += n
+                    labels = _format_labels(family.label_names, values, (('le', _format_value(bound)),))
+                    lines.append(f"{family.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(family.label_names, values)
+                lines.append(f"{family.name}_sum{labels} {_format_value(child.sum)}")
+                lines.append(f"{family.name}_count{labels} {child.count}")
+        for name, (help, label_names, callback) in self._gauges.items():
+            try:
+                sample = callback()
+            except Exception:
+                # the service behind the gauge is not started
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            samples = sample.items() if label_names else [((), sample)]
+            for values, value in samples:
+                lines.append(f"{name}{_format_labels(label_names, values)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,29 @@
+import base64
+import binascii
+
+from reddwarf.utils import codec
+from reddwarf.utils.sql import InvalidSQLBuilderInstruction, normalize_order_by
+
+
+def encode_cursor(order_by, row: dict) -> str:
+    """opaque continuation token holding the order_by values of the last row of a page"""
+    order = normalize_order_by(order_by)
+    try:
+        values = [row[col] for col, _ in order]
+    except KeyError as e:
+        raise InvalidSQLBuilderInstruction(f"order_by column {e} must be selected to build a cursor")
+    payload = codec.dumps({"o": [col for col, _ in order], "v": values})
+    return base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(order_by, token: str) -> list:
+    """returns the keyset values of token, checking it was issued for the same order_by"""
+    order = normalize_order_by(order_by)
+    try:
+        payload = codec.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        columns, values = payload["o"], payload["v"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidSQLBuilderInstruction("malformed cursor")
+    if columns != [col for col, _ in order] or len(values) != len(order):
+        raise InvalidSQLBuilderInstruction("cursor does not match order_by")
+    return values
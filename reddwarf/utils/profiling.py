@@ -0,0 +1,147 @@
+import asyncio
+import cProfile
+import os
+import random
+import time
+from contextvars import ContextVar
+
+from reddwarf.utils.metrics import Histogram, Timer
+
+PROFILE_HEADER = 'x-reddwarf-profile'
+
+_active: ContextVar['Profile | None'] = ContextVar('reddwarf_profile', default=None)
+# set while any RPCProfiler can profile, keeps active() a global read when profiling is off
+_enabled = False
+
+
+def active() -> 'Profile | None':
+    """the Profile of the RPC call running in this context, if it is being profiled"""
+    if not _enabled:
+        return None
+    return _active.get()
+
+
+class PhaseTimer(Timer):
+    """Timer that also adds the elapsed time to a phase of a Profile"""
+    __slots__ = ('profile', 'phase')
+
+    def __init__(self, histogram: Histogram | None, profile: 'Profile', phase: str):
+        super().__init__(histogram)
+        self.profile = profile
+        self.phase = phase
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        if self.histogram is not None:
+            self.histogram.observe(elapsed)
+        self.profile.add(self.phase, elapsed)
+
+
+class Profile:
+    """time per phase of one RPC call, phases hit several times (db queries) are summed"""
+    __slots__ = ('name', 'phases', 'counts', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.phases: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.started = time.perf_counter()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def phase(self, phase: str, histogram: Histogram = None) -> PhaseTimer:
+        return PhaseTimer(histogram, self, phase)
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Server-Timing header value, durations in milliseconds"""
+        entries = [f'{phase.replace(":", "-")};dur={seconds * 1000:.3f}' for phase, seconds in self.phases.items()]
+        entries.append(f'total;dur={self.total * 1000:.3f}')
+        return ', '.join(entries)
+
+    def __repr__(self):
+        phases = ' '.join(
+            f'{phase}={seconds * 1000:.3f}ms' + (f'x{self.counts[phase]}' if self.counts[phase] > 1 else '')
+            for phase, seconds in self.phases.items()
+        )
+        return f"<Profile {self.name} total={self.total * 1000:.3f}ms {phases}>"
+
+
+class RPCProfiler:
+    """
+    Picks the RPC calls to profile: a sample_rate fraction of them, plus authenticated requests
+    carrying the profile header when allow_header is set (no-auth routes are only sampled). A profiled call records a Profile
+    (read, decode, validate, handler, db:<op>:<table>, encode) and with dump_dir set
+    also runs the handler under cProfile and writes <dump_dir>/<rpc>-<time>.prof,
+    a pstats file readable by snakeviz, flameprof or gprof2dot.
+    cProfile watches the whole thread, so other calls interleaving on the loop show up in the dump;
+    only one call is under cProfile at a time.
+
+    RedDwarf only wraps RPCs with the profiling path when enabled is true,
+    otherwise the plain execute runs and profiling costs nothing.
+    """
+    def __init__(self, sample_rate=0.0, allow_header=False, dump_dir=None):
+        global _enabled
+        self.sample_rate = sample_rate
+        self.allow_header = allow_header
+        self.dump_dir = dump_dir or None
+        self._cprofile_busy = False
+        self.profiled = 0
+        if self.enabled:
+            _enabled = True
+            if self.dump_dir:
+                os.makedirs(self.dump_dir, exist_ok=True)
+
+    def configure(self, sample_rate=None, allow_header=None):
+        """
+        changes the sampling of a running server, RPCs only take the profiling path
+        when the profiler was enabled at registration so turning it on needs a restart
+        """
+        global _enabled
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if allow_header is not None:
+            self.allow_header = allow_header
+        if self.enabled:
+            _enabled = True
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.allow_header
+
+    def wants(self, headers, authenticated=True) -> bool:
+        if self.allow_header and authenticated and PROFILE_HEADER in headers:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, name) -> tuple[Profile, object]:
+        """makes the Profile current for db timings, returns it with the token for finish()"""
+        self.profiled += 1
+        profile = Profile(name)
+        return profile, _active.set(profile)
+
+    @staticmethod
+    def finish(token):
+        _active.reset(token)
+
+    def cprofile(self) -> cProfile.Profile | None:
+        """a running cProfile for the handler, None when dumps are off or another call holds it"""
+        if not self.dump_dir or self._cprofile_busy:
+            return None
+        self._cprofile_busy = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    async def dump(self, profiler: cProfile.Profile, name) -> str:
+        """stops the cProfile and writes it from the default executor"""
+        profiler.disable()
+        self._cprofile_busy = False
+        path = os.path.join(self.dump_dir, f"{name}-{time.time_ns()}.prof")
+        await asyncio.get_running_loop().run_in_executor(None, profiler.dump_stats, path)
+        return path
@@ -0,0 +1,58 @@
+from array import array
+from collections import namedtuple
+from enum import Enum
+from functools import lru_cache
+
+
+class RowFormat(Enum):
+    DICT = 'dict'          # [{col: value}, ...]
+    TUPLE = 'tuple'        # {"columns": [col, ...], "rows": [(value, ...), ...]}
+    NAMED = 'named'        # [Row(col=value, ...), ...], one Row class per result shape
+    COLUMNS = 'columns'    # {col: [value, ...]}
+    ARRAYS = 'arrays'      # COLUMNS with all-int / all-float columns packed into array.array
+
+
+@lru_cache(maxsize=1024)
+def row_class(cols: tuple[str, ...]) -> type:
+    """namedtuple row class, generated once per result shape"""
+    return namedtuple('Row', cols, rename=True)
+
+
+def _pack(values: list):
+    if values and all(type(v) is int for v in values):
+        try:
+            return array('q', values)
+        except OverflowError:
+            return values
+    if values and all(type(v) is float for v in values):
+        return array('d', values)
+    return values
+
+
+def format_rows(cols: list[str], rows, row_format=RowFormat.DICT):
+    match RowFormat(row_format):
+        case RowFormat.DICT:
+            return [dict(zip(cols, row)) for row in rows]
+        case RowFormat.TUPLE:
+            return {"columns": cols, "rows": list(rows)}
+        case RowFormat.NAMED:
+            return list(map(row_class(tuple(cols))._make, rows))
+        case RowFormat.COLUMNS:
+            columns = list(zip(*rows)) if rows else [() for _ in cols]
+            return {col: list(values) for col, values in zip(cols, columns)}
+        case RowFormat.ARRAYS:
+            columns = list(zip(*rows)) if rows else [() for _ in cols]
+            return {col: _pack(list(values)) for col, values in zip(cols, columns)}
+
+
+def row_formatter(cols: list[str], row_format=RowFormat.DICT):
+    """per row converter for the row oriented formats, used when rows are streamed"""
+    match RowFormat(row_format):
+        case RowFormat.DICT:
+            return lambda row: dict(zip(cols, row))
+        case RowFormat.TUPLE:
+            return tuple
+        case RowFormat.NAMED:
+            return row_class(tuple(cols))._make
+        case _:
+            raise ValueError(f"{row_format} can not be used row by row")
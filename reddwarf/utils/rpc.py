@@ -0,0 +1,193 @@
+import asyncio
+import inspect
+from inspect import get_annotations, isclass
+
+import pydantic
+
+from reddwarf.utils import codec
+from reddwarf.utils.metrics import registry
+
+rpc_seconds = registry.histogram('reddwarf_rpc_seconds', 'RPC handler time', ('method',))
+rpc_errors = registry.counter('reddwarf_rpc_errors_total', 'failed RPC calls', ('method', 'kind'))
+
+
+class InvalidRPCParams(Exception):
+    """Request body does not match the RPC signature"""
+
+
+class DispatchPlan:
+    """
+    Everything rpc_wrapper needs to know about an RPC function, computed once at registration:
+    parameter names, the pydantic model (if the function takes a single model),
+    required/optional fields and how to decode the request body.
+    """
+    __slots__ = (
+        'func', 'name', 'model', 'model_param', 'param_names', 'required', 'optional', 'streaming',
+        'latency', 'failed', 'rejected',
+    )
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.streaming = inspect.isasyncgenfunction(func)
+        annotations = get_annotations(func)
+        annotations.pop('return', None)
+        signature = inspect.signature(func)
+
+        self.model = None
+        self.model_param = None
+        if len(annotations) == 1:
+            param_name, param_model = next(iter(annotations.items()))
+            if isclass(param_model) and issubclass(param_model, pydantic.BaseModel):
+                self.model = param_model
+                self.model_param = param_name
+
+        self.param_names = tuple(annotations)
+        self.required = frozenset(
+            name for name in self.param_names
+            if name in signature.parameters
+            and signature.parameters[name].default is inspect.Parameter.empty
+        )
+        self.optional = frozenset(self.param_names) - self.required
+
+        self.latency = rpc_seconds.labels(self.name)
+        self.failed = rpc_errors.labels(self.name, 'exception')
+        self.rejected = rpc_errors.labels(self.name, 'invalid_params')
+
+    @property
+    def takes_params(self) -> bool:
+        return bool(self.param_names)
+
+    def decode(self, body: bytes):
+        if not body:
+            return {}
+        return codec.loads(body)
+
+    def bind(self, body) -> dict:
+        if not self.param_names:
+            return {}
+        if not isinstance(body, dict):
+            raise InvalidRPCParams(f"{self.name} expects a JSON object")
+        if self.model is not None:
+            return {self.model_param: self.model(**body)}
+        missing = self.required.difference(body)
+        if missing:
+            raise InvalidRPCParams(f"{self.name} missing params: {', '.join(sorted(missing))}")
+        return {name: body[name] for name in self.param_names if name in body}
+
+    def __repr__(self):
+        return f"<DispatchPlan {self.name} params={self.param_names} model={self.model}>"
+
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+def rpc_error(code: int, message: str, id=None) -> dict:
+    return {"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": id}
+
+
+def rpc_notification(method: str, params=None) -> dict:
+    """server push over the websocket RPC transport"""
+    if params is None:
+        return {"jsonrpc": "2.0", "method": method}
+    return {"jsonrpc": "2.0", "method": method, "params": params}
+
+
+class RPCDispatcher:
+    """
+    JSON-RPC 2.0 dispatch over the registered DispatchPlans.
+    A batch runs its calls concurrently, at most max_concurrency at a time,
+    and answers in the order of the calls. Notifications (no id) are run but not answered.
+    Streaming RPCs are not callable through here.
+    on_error(plan, exception) is called when an RPC raises, the caller gets INTERNAL_ERROR.
+    """
+    def __init__(self, max_concurrency=32, max_batch=100, on_error=None):
+        self.plans: dict[str, DispatchPlan] = {}
+        self.max_batch = max_batch
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._on_error = on_error
+
+    def configure(self, max_concurrency=None, max_batch=None):
+        """calls already holding a slot finish against the old limit"""
+        if max_concurrency is not None:
+            self._slots = asyncio.Semaphore(max_concurrency)
+        if max_batch is not None:
+            self.max_batch = max_batch
+
+    def register(self, plan: DispatchPlan):
+        if not plan.streaming:
+            self.plans[plan.name] = plan
+
+    async def handle(self, body: bytes) -> dict | list | None:
+        """body of a request -> response object, list of them, or None when nothing is answered"""
+        try:
+            payload = codec.loads(body)
+        except ValueError:
+            return rpc_error(PARSE_ERROR, "parse error")
+        return await self.dispatch(payload)
+
+    async def dispatch(self, payload) -> dict | list | None:
+        """same as handle() for an already decoded call or batch"""
+        match payload:
+            case []:
+                return rpc_error(INVALID_REQUEST, "empty batch")
+            case list():
+                if len(payload) > self.max_batch:
+                    return rpc_error(INVALID_REQUEST, f"batch is limited to {self.max_batch} calls")
+                responses = await asyncio.gather(*(self._limited(call) for call in payload))
+                return [response for response in responses if response is not None] or None
+            case _:
+                return await self.call(payload)
+
+    async def _limited(self, call):
+        async with self._slots:
+            return await self.call(call)
+
+    async def call(self, call) -> dict | None:
+        match call:
+            case {"jsonrpc": "2.0", "method": str(method), **rest} if rest.keys() <= {"params", "id"}:
+                pass
+            case _:
+                return rpc_error(INVALID_REQUEST, "invalid request", call.get("id") if isinstance(call, dict) else None)
+        call_id = call.get("id")
+        notification = "id" not in call
+
+        plan = self.plans.get(method)
+        if plan is None:
+            return None if notification else rpc_error(METHOD_NOT_FOUND, f"method {method} not found", call_id)
+        try:
+            params = self.bind(plan, call.get("params"))
+        except (InvalidRPCParams, pydantic.ValidationError) as e:
+            plan.rejected.inc()
+            return None if notification else rpc_error(INVALID_PARAMS, str(e), call_id)
+
+        try:
+            with plan.latency.time():
+                result = await plan.func(**params)
+        except Exception as e:
+            plan.failed.inc()
+            if self._on_error is not None:
+                self._on_error(plan, e)
+            return None if notification else rpc_error(INTERNAL_ERROR, "internal error", call_id)
+        return None if notification else {"jsonrpc": "2.0", "result": result, "id": call_id}
+
+    @staticmethod
+    def bind(plan: DispatchPlan, params) -> dict:
+        """params may be by name (object) or by position (array)"""
+        match params:
+            case None:
+                return plan.bind({})
+            case list() if plan.model is None:
+                if len(params) > len(plan.param_names):
+                    raise InvalidRPCParams(f"{plan.name} takes {len(plan.param_names)} params")
+                return plan.bind(dict(zip(plan.param_names, params)))
+            case list():
+                if len(params) != 1:
+                    raise InvalidRPCParams(f"{plan.name} takes 1 param")
+                return plan.bind(params[0])
+            case _:
+                return plan.bind(params)
@@ -1,5 +1,6 @@
 import decimal
 from enum import Enum
+from functools import lru_cache
 
 __all__ = [
     'SQLDialect',
@@ -8,6 +9,15 @@ __all__ = [
     'build_update_query',
     'build_insert_query',
     'build_delete_query',
+    'build_bulk_update_query',
+    'compile_select_query',
+    'compile_update_query',
+    'compile_delete_query',
+    'IntList',
+    'in_values',
+    'int_list_literal',
+    'template_cache_info',
+    'clear_template_cache',
 ]
 
 
@@ -52,32 +62,85 @@ def build_select_query(
         limit: int = None,
         offset: int = None,
         group_by: list[str] = None,
+        order_by: list[str | tuple[str, str]] = None,
+        after: list | tuple | dict = None,
         dialect=SQLDialect.MySQL
 ) -> str:
-    return " ".join([
+    """
+    order_by: columns, 'col' or ('col', 'ASC' | 'DESC')
+    after: order_by values of the last row of the previous page (keyset pagination),
+        only rows after it in order_by order are selected
+    """
+    order = normalize_order_by(order_by)
+    where_sql = build_where(where, dialect=dialect)
+    if after is not None:
+        keyset = build_keyset(order, [to_literal(v) for v in keyset_values(order, after)])
+        where_sql = f"{where_sql} AND {keyset}" if where_sql else f"WHERE {keyset}"
+    return " ".join(filter(None, [
         build_select(cols, dialect=dialect),
         build_from(table),
-        build_where(where, dialect=dialect),
+        where_sql,
+        build_group_by(group_by),
+        build_order_by(order),
         build_window(limit, offset),
-        build_group_by(group_by)
-    ])
+    ]))
 
 
-def build_insert_query(table, data, dialect=SQLDialect.MySQL) -> tuple:
+def build_insert_query(table, data, dialect=SQLDialect.MySQL, on_duplicate=None) -> tuple:
+    """
+    on_duplicate: MySQL only, columns to overwrite when the row already exists
+        (INSERT ... ON DUPLICATE KEY UPDATE), True for every inserted column
+    """
     if not data:
         return 0
     cols = data[0].keys()
     if dialect == SQLDialect.ClickHouse:
+        if on_duplicate:
+            raise UnsupportedSQLDialect("ON DUPLICATE KEY UPDATE is not supported by ClickHouse")
         return (
             f"INSERT INTO {table} ({','.join(cols)}) VALUES", data
         )
+    sql = f'INSERT INTO {table}({",".join(cols)}) VALUES ({",".join([f"%({col})s" for col in cols])})'
+    if on_duplicate:
+        update_cols = cols if on_duplicate is True else on_duplicate
+        sql += f" ON DUPLICATE KEY UPDATE {','.join(f'{col}=VALUES({col})' for col in update_cols)}"
     return (
         # f'INSERT INTO {table}({",".join(cols)}) VALUES ({",".join([":"+col for col in cols])})',
-        f'INSERT INTO {table}({",".join(cols)}) VALUES ({",".join([f"%({col})s" for col in cols])})',
+        sql,
         data
     )
 
 
+def build_bulk_update_query(table, key, rows: list[dict], dialect=SQLDialect.MySQL) -> tuple[str, dict] | None:
+    """
+    Updates many rows keyed by primary key in one statement:
+    UPDATE t SET a = CASE id WHEN %(k0)s THEN %(a0)s ... ELSE a END, ... WHERE id IN %(keys)s
+    Columns missing from a row keep their value.
+    """
+    if not rows:
+        return
+    if dialect != SQLDialect.MySQL:
+        raise UnsupportedSQLDialect(f"bulk UPDATE is not supported by {dialect}")
+    cols = []
+    for row in rows:
+        if key not in row:
+            raise InvalidSQLBuilderInstruction(f"every row needs its key {key}")
+        cols.extend(col for col in row if col != key and col not in cols)
+    if not cols:
+        return
+    params = {f"k{i}": row[key] for i, row in enumerate(rows)}
+    params['keys'] = in_values(params.values())
+    assignments = []
+    for c, col in enumerate(cols):
+        cases = []
+        for i, row in enumerate(rows):
+            if col in row:
+                params[f"c{c}_{i}"] = row[col]
+                cases.append(f"WHEN %(k{i})s THEN %(c{c}_{i})s")
+        assignments.append(f"{col} = CASE {key} {' '.join(cases)} ELSE {col} END")
+    return f"UPDATE {table} SET {', '.join(assignments)} WHERE {key} IN %(keys)s", params
+
+
 def build_update_query(table, where, data, dialect=SQLDialect.MySQL):
     if not data:
         return
@@ -104,7 +167,7 @@ def build_select(cols: list[str, dict], dialect=DEFAULT_DIALECT) -> str:
             case str():
                 select_cols.append(col)
             case dict():
-                select_cols.append(build_func(col))
+                select_cols.append(build_func(col, dialect=dialect))
             case _:
                 raise InvalidSQLBuilderInstruction(f"{col}: {type(col)} is invalid for building select")
     return f"SELECT {', '.join(select_cols) if select_cols else '*'}"
@@ -120,6 +183,66 @@ def build_group_by(cols: list):
     return f"GROUP BY {', '.join(cols)}"
 
 
+def normalize_order_by(order_by) -> tuple[tuple[str, str], ...] | None:
+    if not order_by:
+        return None
+    order = []
+    for item in order_by:
+        match item:
+            case str():
+                order.append((item, 'ASC'))
+            case (str(col), str(direction)) if direction.upper() in ('ASC', 'DESC'):
+                order.append((col, direction.upper()))
+            case _:
+                raise InvalidSQLBuilderInstruction(f"{item} is invalid for building order by")
+    return tuple(order)
+
+
+def build_order_by(order: tuple[tuple[str, str], ...] | None):
+    if not order:
+        return ''
+    return f"ORDER BY {', '.join(f'{col} {direction}' for col, direction in order)}"
+
+
+def keyset_values(order, after) -> list:
+    if not order:
+        raise InvalidSQLBuilderInstruction("keyset pagination requires order_by")
+    match after:
+        case dict():
+            try:
+                values = [after[col] for col, _ in order]
+            except KeyError as e:
+                raise InvalidSQLBuilderInstruction(f"keyset is missing order_by column {e}")
+        case list() | tuple():
+            values = list(after)
+        case _:
+            raise InvalidSQLBuilderInstruction(f"{after} is invalid for keyset pagination")
+    if len(values) != len(order):
+        raise InvalidSQLBuilderInstruction("keyset must have one value per order_by column")
+    return values
+
+
+def build_keyset(order, rendered: list[str]) -> str:
+    """
+    Seek condition selecting the rows after the one whose order_by values are rendered.
+    A single direction compiles to a row comparison the database can range scan an index with,
+    mixed directions expand to (a > x) OR (a = x AND b < y) ...
+    """
+    directions = {direction for _, direction in order}
+    if len(directions) == 1:
+        op = '>' if 'ASC' in directions else '<'
+        if len(order) == 1:
+            return f"{order[0][0]} {op} {rendered[0]}"
+        return f"({', '.join(col for col, _ in order)}) {op} ({', '.join(rendered)})"
+    disjuncts = []
+    for i, (col, direction) in enumerate(order):
+        op = '>' if direction == 'ASC' else '<'
+        terms = [f"{c} = {v}" for (c, _), v in zip(order[:i], rendered[:i])]
+        terms.append(f"{col} {op} {rendered[i]}")
+        disjuncts.append(f"({' AND '.join(terms)})")
+    return f"({' OR '.join(disjuncts)})"
+
+
 def build_window(limit: int = None, offset: int = None):
     match limit, offset:
         case int(), int():
@@ -154,29 +277,264 @@ def to_literal(v):
             return str(v)
 
 
+class IntList(tuple):
+    """IN list made only of plain ints, rendered in one join instead of escaping every element"""
+    __slots__ = ()
+
+
+def in_values(values) -> tuple:
+    """values of an IN list as a bound param, IntList when they are all ints (bools excluded)"""
+    if type(values) is IntList:
+        return values
+    if all(type(v) is int for v in values):
+        return IntList(values)
+    return tuple(values)
+
+
+def int_list_literal(values) -> str:
+    return f"({','.join(map(str, values))})"
+
+
+def build_in_list(values) -> str:
+    if all(type(v) is int for v in values):
+        return int_list_literal(values)
+    return f"({','.join(map(to_literal, values))})"
+
+
+def translate_dialect(column, op, val: str, dialect):
+    """val is an already rendered literal or placeholder"""
+    match op:
+        case "regexp":
+            if dialect == SQLDialect.ClickHouse:
+                return f"match({column}, {val})"
+            else:
+                return f"{column} REGEXP {val}"
+        case _:
+            return f"{column} {op} {val}"
+
+
 def build_where(condition, dialect):
     if condition is None:
         return ''
 
-    def translate_dialect(column_, op_, val_):
-        match op_:
-            case "regexp":
-                if dialect == SQLDialect.ClickHouse:
-                    return f"match({column_}, {to_literal(val_)})"
-                else:
-                    return f"{column_} REGEXP {to_literal(val_)}"
-            case _:
-                return f"{column_} {op_} {to_literal(val_)}"
+    def translate_dialect_(column_, op_, val_):
+        return translate_dialect(column_, op_, to_literal(val_), dialect)
     where_statement = []
     for column, col_cond in condition.items():
         match col_cond:
             case list() | tuple():
-                where_statement.append(f"{column} IN ({','.join(map(to_literal, col_cond))})")
+                where_statement.append(f"{column} IN {build_in_list(col_cond)}")
             case dict():
                 # {">": 2, "<": 3}
                 composed_condition = []
                 for op, val in col_cond.items():
-                    where_statement.append(translate_dialect(column, op, val))
+                    where_statement.append(translate_dialect_(column, op, val))
             case _:
                 where_statement.append(f"{column} = {to_literal(col_cond)}")
     return 'WHERE '+' AND '.join(where_statement)
+
+
+# Compiled templates
+#
+# compile_*_query normalizes the structure of a query (table, cols, where keys and
+# operators, group_by, window) into a hashable shape, compiles a pyformat template
+# (%(p0)s ...) once per shape and returns (template, params). Values are never inlined,
+# they are bound by the driver, lists are bound as a single tuple param for IN
+# (an IntList when every element is an int, see in_values).
+
+TEMPLATE_CACHE_SIZE = 2048
+
+
+def _placeholder(name):
+    return f"%({name})s"
+
+
+def _escape(sql: str) -> str:
+    """% in identifiers and expressions (DATE_FORMAT(ts, '%Y')) would be read as a placeholder"""
+    return sql.replace('%', '%%')
+
+
+def _cols_shape(cols):
+    if cols is None:
+        return None
+    shape = []
+    for col in cols:
+        match col:
+            case str():
+                shape.append(col)
+            case dict():
+                shape.append(tuple(sorted(col.items())))
+            case _:
+                raise InvalidSQLBuilderInstruction(f"{col}: {type(col)} is invalid for building select")
+    return tuple(shape)
+
+
+def _where_shape(condition):
+    if condition is None:
+        return None
+    shape = []
+    for column, col_cond in condition.items():
+        match col_cond:
+            case list() | tuple():
+                shape.append((column, 'in'))
+            case dict():
+                shape.append((column, tuple(col_cond)))
+            case _:
+                shape.append((column, '='))
+    return tuple(shape)
+
+
+def _where_params(condition, params: dict, start=0) -> int:
+    i = start
+    if condition is None:
+        return i
+    for col_cond in condition.values():
+        match col_cond:
+            case list() | tuple():
+                params[f"p{i}"] = in_values(col_cond)
+                i += 1
+            case dict():
+                for val in col_cond.values():
+                    params[f"p{i}"] = val
+                    i += 1
+            case _:
+                params[f"p{i}"] = col_cond
+                i += 1
+    return i
+
+
+def _compile_where(shape, dialect, start=0) -> str:
+    if not shape:
+        return ''
+    i = start
+    where_statement = []
+    for column, kind in shape:
+        column = _escape(column)
+        match kind:
+            case 'in':
+                where_statement.append(f"{column} IN {_placeholder(f'p{i}')}")
+                i += 1
+            case '=':
+                where_statement.append(f"{column} = {_placeholder(f'p{i}')}")
+                i += 1
+            case tuple():
+                for op in kind:
+                    where_statement.append(translate_dialect(column, op, _placeholder(f'p{i}'), dialect))
+                    i += 1
+    return 'WHERE '+' AND '.join(where_statement)
+
+
+def _compile_window(has_limit: bool, has_offset: bool) -> str:
+    return " ".join(filter(None, [
+        f"LIMIT {_placeholder('limit')}" if has_limit else '',
+        f"OFFSET {_placeholder('offset')}" if has_offset else '',
+    ]))
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_select(
+        table, cols_shape, where_shape, has_limit, has_offset, group_by, order, has_after, dialect
+) -> str:
+    cols = None if cols_shape is None else [
+        _escape(col) if isinstance(col, str) else {k: _escape(v) if isinstance(v, str) else v for k, v in col}
+        for col in cols_shape
+    ]
+    if order is not None:
+        order = tuple((_escape(col), direction) for col, direction in order)
+    where_sql = _compile_where(where_shape, dialect)
+    if has_after:
+        keyset = build_keyset(order, [_placeholder(f"k{i}") for i in range(len(order))])
+        where_sql = f"{where_sql} AND {keyset}" if where_sql else f"WHERE {keyset}"
+    return " ".join(filter(None, [
+        build_select(cols, dialect=dialect),
+        build_from(_escape(table)),
+        where_sql,
+        build_group_by(None if group_by is None else list(map(_escape, group_by))),
+        build_order_by(order),
+        _compile_window(has_limit, has_offset),
+    ]))
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_update(table, set_cols, where_shape, dialect) -> str:
+    return " ".join([
+        f"UPDATE {_escape(table)} SET",
+        ",".join(f"{_escape(k)}={_placeholder(f'v{i}')}" for i, k in enumerate(set_cols)),
+        _compile_where(where_shape, dialect)
+    ])
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_delete(table, where_shape, dialect) -> str:
+    return " ".join([
+        f"DELETE FROM {_escape(table)}",
+        _compile_where(where_shape, dialect)
+    ])
+
+
+def _check_window(limit, offset):
+    for v in (limit, offset):
+        if v is not None and not isinstance(v, int):
+            raise InvalidSQLBuilderInstruction("invalid limit and offset")
+
+
+def compile_select_query(
+        table,
+        cols: list[str | dict] = None,
+        where: dict = None,
+        limit: int = None,
+        offset: int = None,
+        group_by: list[str] = None,
+        order_by: list[str | tuple[str, str]] = None,
+        after: list | tuple | dict = None,
+        dialect=SQLDialect.MySQL
+) -> tuple[str, dict]:
+    _check_window(limit, offset)
+    order = normalize_order_by(order_by)
+    keyset = None if after is None else keyset_values(order, after)
+    template = _compile_select(
+        table, _cols_shape(cols), _where_shape(where),
+        limit is not None, offset is not None,
+        None if group_by is None else tuple(group_by),
+        order, after is not None, dialect
+    )
+    params = {}
+    _where_params(where, params)
+    if keyset is not None:
+        for i, v in enumerate(keyset):
+            params[f"k{i}"] = v
+    if limit is not None:
+        params['limit'] = limit
+    if offset is not None:
+        params['offset'] = offset
+    return template, params
+
+
+def compile_update_query(table, where, data, dialect=SQLDialect.MySQL) -> tuple[str, dict] | None:
+    if not data:
+        return
+    template = _compile_update(table, tuple(data), _where_shape(where), dialect)
+    params = {f"v{i}": v for i, v in enumerate(data.values())}
+    _where_params(where, params)
+    return template, params
+
+
+def compile_delete_query(table, where, dialect=SQLDialect.MySQL) -> tuple[str, dict]:
+    template = _compile_delete(table, _where_shape(where), dialect)
+    params = {}
+    _where_params(where, params)
+    return template, params
+
+
+def template_cache_info() -> dict:
+    return {
+        'select': _compile_select.cache_info()._asdict(),
+        'update': _compile_update.cache_info()._asdict(),
+        'delete': _compile_delete.cache_info()._asdict(),
+    }
+
+
+def clear_template_cache():
+    _compile_select.cache_clear()
+    _compile_update.cache_clear()
+    _compile_delete.cache_clear()
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+from reddwarf.utils import auth
+from reddwarf.utils.auth import TokenCache, authenticate_token, token_cache
+
+SECRET = 'test-secret'
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(auth, '_secret', SECRET)
+    token_cache.clear()
+    yield
+    token_cache.clear()
+    token_cache.configure(max_size=10000, ttl=300)
+
+
+def make_token(expires_in: timedelta, **user):
+    return jwt.encode(
+        {**user, "expire_at": str((datetime.now() + expires_in).timestamp())}, SECRET, algorithm='HS256'
+    )
+
+
+def test_entry_expires_with_ttl():
+    cache = TokenCache(ttl=-1)
+    cache.put(b'k', {'username': 'a'}, datetime.now() + timedelta(days=1))
+    assert cache.get(b'k') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_size_evicts_least_recently_used():
+    cache = TokenCache(max_size=2)
+    expire_at = datetime.now() + timedelta(days=1)
+    for key in (b'a', b'b'):
+        cache.put(key, {'username': key.decode()}, expire_at)
+    assert cache.get(b'a') == {'username': 'a'}
+    cache.put(b'c', {'username': 'c'}, expire_at)
+    assert cache.get(b'b') is None
+    assert cache.get(b'a') is not None and cache.get(b'c') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_expired_jwt_is_rejected_while_cached(monkeypatch):
+    token = make_token(timedelta(minutes=1), username='a')
+    assert authenticate_token(token)['username'] == 'a'
+    assert token_cache.stats()['size'] == 1
+
+    class Later(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) + timedelta(minutes=2)
+    monkeypatch.setattr(auth, 'datetime', Later)
+    assert authenticate_token(token) is None
+    assert token_cache.stats()['size'] == 0
+
+
+def test_expired_jwt_is_not_cached():
+    assert authenticate_token(make_token(timedelta(minutes=-1), username='a')) is None
+    assert token_cache.stats()['size'] == 0
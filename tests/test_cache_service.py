@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+import decimal
+
+import pytest
+
+from reddwarf.services.cache_service import QueryCache, decode, encode
+from reddwarf.services.mysql_service import _cached, invalidate_cached
+from reddwarf.utils.rows import RowFormat
+
+ROW = {
+    'id': 1, 'status': 'paid', 'amount': decimal.Decimal('10.50'),
+    'created_at': datetime.datetime(2022, 11, 1, 12, 0, 0, 500), 'day': datetime.date(2022, 11, 1),
+    'duration': datetime.timedelta(hours=1, seconds=3), 'blob': b'\x00\xff', 'note': None,
+}
+
+
+class BrokenRedis:
+    async def smembers(self, key):
+        raise ConnectionError("redis is down")
+
+
+@pytest.fixture
+def cache():
+    cache = QueryCache()
+    cache.initialize(redis=None, l1_size=16, l1_ttl=60)
+    yield cache
+    cache.__dict__.clear()
+
+
+def test_encode_keeps_row_types():
+    assert decode(encode([ROW])) == [ROW]
+    assert decode(encode([ROW]).decode()) == [ROW]
+    assert decode(encode([{'id': 1}])) == [{'id': 1}]
+
+
+def test_hits_return_copies_with_query_types(cache):
+    loads = 0
+
+    async def load():
+        nonlocal loads
+        loads += 1
+        return [dict(ROW)]
+
+    async def scenario():
+        first = await _cached('orders', 'SELECT 1', {}, RowFormat.DICT, 60, load)
+        first[0]['status'] = 'MUTATED'
+        second = await _cached('orders', 'SELECT 1', {}, RowFormat.DICT, 60, load)
+        second.append({'id': 2})
+        third = await _cached('orders', 'SELECT 1', {}, RowFormat.DICT, 60, load)
+        return second, third
+    second, third = asyncio.run(scenario())
+    assert loads == 1
+    assert second[0] == ROW and third == [ROW]
+
+
+def test_tuple_rows_stay_tuples(cache):
+    async def load():
+        return {'columns': ['id'], 'rows': [(1,), (2,)]}
+
+    async def scenario():
+        await _cached('orders', 'SELECT id', {}, RowFormat.TUPLE, 60, load)
+        return await _cached('orders', 'SELECT id', {}, RowFormat.TUPLE, 60, load)
+    assert asyncio.run(scenario()) == {'columns': ['id'], 'rows': [(1,), (2,)]}
+
+
+def test_failed_invalidation_does_not_raise(cache):
+    cache.initialize(redis=BrokenRedis(), l1_size=16, l1_ttl=60)
+    asyncio.run(invalidate_cached('orders'))
+    assert cache.invalidations == 1
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+
+import httpx
+import pytest
+
+from reddwarf.services.clickhouse_service import (
+    ClickHouseError, insert_many, render_query, select_many, select_one, to_clickhouse_literal, to_columns,
+)
+from reddwarf.utils import codec
+from reddwarf.utils.sql import SQLDialect, compile_select_query
+
+
+def test_to_clickhouse_literal_escapes_strings():
+    assert to_clickhouse_literal("it's a \\ test") == "'it\\'s a \\\\ test'"
+    assert to_clickhouse_literal(None) == 'NULL'
+    assert to_clickhouse_literal(datetime.datetime(2022, 1, 2, 3, 4, 5)) == "'2022-01-02 03:04:05'"
+
+
+def test_render_compiled_template():
+    template, params = compile_select_query(
+        'events', where={'id': [1, 2], 'kind': 'a'}, limit=10, dialect=SQLDialect.ClickHouse
+    )
+    assert render_query(template, params) == "SELECT * FROM events WHERE id IN (1,2) AND kind = 'a' LIMIT 10"
+
+
+def test_to_columns():
+    assert to_columns([{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}]) == {'a': [1, 2], 'b': ['x', 'y']}
+
+
+class FakeClickHouse:
+    """answers the HTTP interface from a MockTransport, records every statement"""
+    def __init__(self):
+        self.queries = []
+        self.blocks = []
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if 'query' in request.url.params:
+            self.queries.append(request.url.params['query'])
+            self.blocks.append(codec.loads(request.content))
+            return httpx.Response(200)
+        sql = request.content.decode()
+        self.queries.append(sql)
+        if 'missing' in sql:
+            return httpx.Response(404, text="Code: 60. Table default.missing does not exist. ")
+        if sql.endswith('FORMAT JSONColumns'):
+            return httpx.Response(200, content=codec.dumps({'id': [1, 2], 'kind': ['a', 'b']}))
+        return httpx.Response(200, content=codec.dumps({
+            'meta': [{'name': 'id', 'type': 'UInt64'}, {'name': 'kind', 'type': 'String'}],
+            'data': [[1, 'a'], [2, 'b']],
+        }))
+
+
+def run(coro_fn):
+    server = FakeClickHouse()
+
+    async def main():
+        async with httpx.AsyncClient(base_url='http://ch:8123', transport=httpx.MockTransport(server.handle)) as chc:
+            return await coro_fn(chc)
+    return server, asyncio.run(main())
+
+
+def test_select_through_http():
+    async def queries(chc):
+        return (
+            await select_many(chc, 'events', where={'id': [1, 2]}),
+            await select_many(chc, 'events', columnar=True),
+            await select_one(chc, 'events', where={'kind': 'a'}),
+        )
+    server, (rows, columns, row) = run(queries)
+    assert rows == [{'id': 1, 'kind': 'a'}, {'id': 2, 'kind': 'b'}]
+    assert columns == {'id': [1, 2], 'kind': ['a', 'b']}
+    assert row == {'id': 1, 'kind': 'a'}
+    assert server.queries == [
+        "SELECT * FROM events WHERE id IN (1,2) FORMAT JSONCompact",
+        "SELECT * FROM events FORMAT JSONColumns",
+        "SELECT * FROM events WHERE kind = 'a' LIMIT 1 FORMAT JSONCompact",
+    ]
+
+
+def test_insert_sends_column_blocks():
+    rows = [{'id': i, 'kind': 'a'} for i in range(5)]
+    server, n = run(lambda chc: insert_many(chc, 'events', rows, block_size=2))
+    assert n == 5
+    assert server.queries == ["INSERT INTO events (id,kind) FORMAT JSONColumns"] * 3
+    assert server.blocks[-1] == {'id': [4], 'kind': ['a']}
+
+
+def test_errors_raise():
+    with pytest.raises(ClickHouseError, match='does not exist'):
+        run(lambda chc: select_many(chc, 'missing'))
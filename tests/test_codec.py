@@ -0,0 +1,40 @@
+import datetime
+import decimal
+import uuid
+
+import pytest
+
+from reddwarf.utils.codec import ORJSON_CODEC, STDLIB_CODEC
+
+CODECS = [STDLIB_CODEC] + ([ORJSON_CODEC] if ORJSON_CODEC else [])
+
+
+@pytest.mark.parametrize('codec', CODECS, ids=repr)
+def test_non_str_keys_and_big_ints(codec):
+    assert codec.loads(codec.dumps({1: 'a', 'n': 2 ** 70})) == {'1': 'a', 'n': 2 ** 70}
+
+
+@pytest.mark.parametrize('codec', CODECS, ids=repr)
+def test_wire_format(codec):
+    row = {
+        'amount': decimal.Decimal('1.50'),
+        'created_at': datetime.datetime(2022, 11, 1, 12, 0, 0, 4500),
+        'utc': datetime.datetime(2022, 11, 1, tzinfo=datetime.timezone.utc),
+        'day': datetime.date(2022, 11, 1),
+        'id': uuid.UUID(int=1),
+        'tags': ('a', 'b'),
+    }
+    assert codec.loads(codec.dumps(row)) == {
+        'amount': '1.50',
+        'created_at': '2022-11-01T12:00:00.004500',
+        'utc': '2022-11-01T00:00:00+00:00',
+        'day': '2022-11-01',
+        'id': '00000000-0000-0000-0000-000000000001',
+        'tags': ['a', 'b'],
+    }
+
+
+@pytest.mark.skipif(ORJSON_CODEC is None, reason='orjson is not installed')
+def test_codecs_agree():
+    row = {1: [2 ** 70, decimal.Decimal('3')], 'at': datetime.datetime(2022, 11, 1, 12, 30)}
+    assert ORJSON_CODEC.dumps(row) == STDLIB_CODEC.dumps(row)
@@ -0,0 +1,100 @@
+import configparser
+
+import pytest
+
+from reddwarf.services.config_service import BaseConfig, Settings, apply_env_overrides
+
+CONFIG = """
+[DEFAULT]
+secret = test-secret
+token_cache_ttl = 5m
+log_level = 20
+
+[MySQL]
+db_host = 127.0.0.1
+db_user = test
+db_password = test
+db_name = test
+acquire_timeout = 250ms
+max_packet_size = 4MiB
+
+[Redis]
+db_host = 127.0.0.1
+"""
+
+
+def parse(text) -> configparser.ConfigParser:
+    parser = configparser.ConfigParser()
+    parser.read_string(text)
+    return parser
+
+
+def test_settings_are_typed():
+    settings = Settings.from_parser(parse(CONFIG))
+    assert settings.default.token_cache_ttl == 300.0
+    assert settings.default.port == 8000
+    assert settings.mysql.acquire_timeout == 0.25
+    assert settings.mysql.max_packet_size == 4 * 1024 * 1024
+    assert settings.clickhouse is None
+
+
+def test_env_overrides():
+    parser = parse(CONFIG)
+    apply_env_overrides(parser, {
+        'REDDWARF_MYSQL__MAXSIZE': '20',
+        'REDDWARF_DEFAULT__PORT': '9000',
+        'REDDWARF_CLICKHOUSE__DB_HOST': 'ch',
+        'OTHER__KEY': 'ignored',
+    })
+    settings = Settings.from_parser(parser)
+    assert settings.mysql.maxsize == 20
+    assert settings.default.port == 9000
+    assert settings.clickhouse.db_host == 'ch'
+
+
+@pytest.fixture
+def fresh_config():
+    """a BaseConfig of its own, the process wide singleton is put back afterwards"""
+    previous = BaseConfig.__dict__.get('instance')
+    if previous is not None:
+        del BaseConfig.instance
+    yield BaseConfig()
+    if previous is None:
+        del BaseConfig.instance
+    else:
+        BaseConfig.instance = previous
+
+
+def test_invalid_reload_keeps_settings(tmp_path, monkeypatch, fresh_config, caplog):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('ENV', 'test')
+    path = tmp_path / 'config-test.ini'
+    path.write_text(CONFIG)
+    config = fresh_config
+    config.load_conf()
+    reloaded = []
+    config.on_reload(lambda old, new: reloaded.append((old.default.log_level, new.default.log_level)))
+
+    path.write_text(CONFIG.replace('log_level = 20', 'log_level = 30'))
+    assert config.reload().default.log_level == 30
+    path.write_text(CONFIG.replace('[MySQL]', '[MySQL]\nminsize = 5\nmaxsize = 2'))
+    assert config.reload() is None
+    assert 'config reload rejected' in caplog.text
+    assert config.settings.default.log_level == 30
+    assert config.get_config()['DEFAULT']['log_level'] == '30'
+    assert reloaded == [(20, 30)]
+
+
+def test_load_conf_keeps_reload_callbacks(tmp_path, monkeypatch, fresh_config):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('ENV', 'test')
+    path = tmp_path / 'config-test.ini'
+    path.write_text(CONFIG)
+    config = fresh_config
+    config.load_conf()
+    reloaded = []
+    config.on_reload(lambda old, new: reloaded.append(new.default.log_level))
+    config.load_conf()
+    path.write_text(CONFIG.replace('log_level = 20', 'log_level = 30'))
+    config.reload()
+    assert reloaded == [30]
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+from reddwarf.endpoints.http_endpoint import NDJSON_MEDIA_TYPE, RPCStreamingResponse, encode_json_array
+from reddwarf.services.mysql_service import iter_many
+
+
+class FakeSSCursor:
+    """hands out the rows fetchmany(size) at a time like an unbuffered server side cursor"""
+    description = [('id',), ('name',)]
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.fetches = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, params):
+        self.sql = sql
+
+    async def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches.append(len(batch))
+        return batch
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cur = FakeSSCursor(rows)
+
+    def cursor(self, cursor_class=None):
+        self.cursor_class = cursor_class
+        return self.cur
+
+
+def call(response, accept='application/json'):
+    """(headers, chunks) of the response sent through an ASGI call"""
+    scope = {'type': 'http', 'method': 'POST', 'path': '/rpc/rows', 'headers': [(b'accept', accept.encode())]}
+    messages = []
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+    asyncio.run(response(scope, receive, send))
+    start, *bodies = messages
+    return dict(start['headers']), [m['body'] for m in bodies if m['body']]
+
+
+def stream(rows, accept):
+    dbc = FakeConnection(rows)
+    scope = {'type': 'http', 'headers': [(b'accept', accept.encode())]}
+    response = RPCStreamingResponse(
+        iter_many(dbc, 'users', batch_size=2), ndjson=RPCStreamingResponse.wants_ndjson(Request(scope))
+    )
+    return dbc, *call(response, accept)
+
+
+ROWS = [(1, 'a'), (2, 'b'), (3, 'c')]
+
+
+def test_iter_many_fetches_in_batches():
+    dbc, headers, chunks = stream(ROWS, 'application/json')
+    assert dbc.cursor_class.__name__ == 'SSCursor'
+    assert dbc.cur.fetches == [2, 1, 0]
+    assert headers[b'content-type'].startswith(b'application/json')
+    assert json.loads(b''.join(chunks)) == [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}, {'id': 3, 'name': 'c'}]
+
+
+def test_ndjson():
+    _, headers, chunks = stream(ROWS, NDJSON_MEDIA_TYPE)
+    assert headers[b'content-type'].startswith(NDJSON_MEDIA_TYPE.encode())
+    assert b''.join(chunks) == b'{"id":1,"name":"a"}\n{"id":2,"name":"b"}\n{"id":3,"name":"c"}\n'
+
+
+@pytest.mark.parametrize('accept, body', [('application/json', b'[]'), (NDJSON_MEDIA_TYPE, b'')])
+def test_empty_result(accept, body):
+    _, _, chunks = stream([], accept)
+    assert b''.join(chunks) == body
+
+
+def test_json_array_is_chunked():
+    async def rows():
+        for n in range(100):
+            yield {'n': n}
+
+    async def collect():
+        return [chunk async for chunk in encode_json_array(rows(), chunk_size=64)]
+    chunks = asyncio.run(collect())
+    assert len(chunks) > 1 and all(len(chunk) < 64 + 16 for chunk in chunks)
+    assert json.loads(b''.join(chunks)) == [{'n': n} for n in range(100)]
@@ -0,0 +1,108 @@
+import logging
+import multiprocessing
+import queue
+import threading
+
+import pytest
+
+from reddwarf.services.logger_service import (
+    BaseLogger, BatchedRotatingFileHandler, BatchingQueueListener, BoundedQueueHandler, LoggerStats,
+)
+
+
+def make_record(n):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, 'record %s', (n,), None)
+
+
+def test_drop_policy():
+    stats = LoggerStats()
+    handler = BoundedQueueHandler(queue.Queue(2), stats, overflow='drop')
+    for n in range(3):
+        handler.emit(make_record(n))
+    assert (stats.enqueued, stats.dropped, stats.blocked) == (2, 1, 0)
+    assert [handler.queue.get_nowait().args for _ in range(2)] == [(0,), (1,)]
+
+
+def test_block_policy_waits_for_room():
+    stats = LoggerStats()
+    handler = BoundedQueueHandler(queue.Queue(1), stats, overflow='block')
+    handler.emit(make_record(0))
+    threading.Timer(0.05, handler.queue.get).start()
+    handler.emit(make_record(1))
+    assert (stats.enqueued, stats.dropped, stats.blocked) == (2, 0, 1)
+    assert handler.queue.get_nowait().args == (1,)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(queue.Queue(), LoggerStats(), overflow='spill')
+
+
+class CountingFileHandler(BatchedRotatingFileHandler):
+    flushes = 0
+
+    def flush(self):
+        if not self.batching:
+            self.flushes += 1
+        super().flush()
+
+
+def test_listener_flushes_once_per_batch(tmp_path):
+    stats = LoggerStats()
+    log_queue = queue.Queue()
+    for n in range(5):
+        log_queue.put(make_record(n))
+    handler = CountingFileHandler(str(tmp_path / 'server.log'))
+    listener = BatchingQueueListener(log_queue, handler, stats=stats, batch_size=3)
+    # queued up front so the batches do not depend on thread timing
+    listener.enqueue_sentinel()
+    listener.start()
+    listener._thread.join()
+    # 3 records, then 2 records and the stop sentinel
+    assert (stats.written, stats.batches, handler.flushes) == (5, 2, 2)
+    handler.close()
+    assert (tmp_path / 'server.log').read_text().splitlines() == [f'record {n}' for n in range(5)]
+
+
+def test_base_logger_stats(tmp_path):
+    logger = BaseLogger()
+    logger.setup_logger(str(tmp_path / 'server.log'), level=20, queue_size=10)
+    try:
+        logger.log(10, 'filtered out by the level')
+        for n in range(3):
+            logger.log(20, 'record %s', n)
+    finally:
+        logger.shutdown()
+    stats = logger.get_stats()
+    assert (stats['enqueued'], stats['dropped'], stats['written'], stats['queued']) == (3, 0, 3, 0)
+
+
+def _worker(log_queue):
+    logger = BaseLogger()
+    logger.setup_worker_logger(log_queue, level=10)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.log(40, 'worker %s failed', 1, exc_info=True)
+
+
+def test_workers_log_through_the_parent(tmp_path):
+    context = multiprocessing.get_context('fork')
+    log_queue = context.JoinableQueue(100)
+    log_file = tmp_path / 'server.log'
+    logger = BaseLogger()
+    logger.setup_logger(str(log_file), level=10, log_queue=log_queue)
+    try:
+        processes = [context.Process(target=_worker, args=(log_queue,)) for _ in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(5)
+        logger.log(20, 'parent %s', 'done')
+    finally:
+        logger.shutdown()
+    lines = log_file.read_text().splitlines()
+    assert lines.count('worker 1 failed') == 2
+    assert lines.count('ValueError: boom') == 2
+    assert lines[-1] == 'parent done'
+    assert not list(tmp_path.glob('server.log.*'))
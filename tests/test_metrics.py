@@ -0,0 +1,35 @@
+from reddwarf.utils.metrics import MetricsRegistry
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    latency = registry.histogram('rpc_seconds', 'rpc time', ('method',), buckets=(0.1, 1.0))
+    errors = registry.counter('rpc_errors_total', 'rpc errors', ('method',))
+    registry.gauge('connections', 'open sockets', lambda: 3)
+    registry.gauge('broken', 'not started', lambda: 1 / 0)
+
+    latency.labels('echo').observe(0.05)
+    latency.labels('echo').observe(0.5)
+    errors.labels('say "hi"').inc()
+
+    assert registry.render().splitlines() == [
+        '# HELP rpc_seconds rpc time',
+        '# TYPE rpc_seconds histogram',
+        'rpc_seconds_bucket{method="echo",le="0.1"} 1',
+        'rpc_seconds_bucket{method="echo",le="1.0"} 2',
+        'rpc_seconds_bucket{method="echo",le="+Inf"} 2',
+        'rpc_seconds_sum{method="echo"} 0.55',
+        'rpc_seconds_count{method="echo"} 2',
+        '# HELP rpc_errors_total rpc errors',
+        '# TYPE rpc_errors_total counter',
+        'rpc_errors_total{method="say \\"hi\\""} 1',
+        '# HELP connections open sockets',
+        '# TYPE connections gauge',
+        'connections 3',
+    ]
+
+
+def test_families_are_shared_by_name():
+    registry = MetricsRegistry()
+    assert registry.counter('a_total', 'a') is registry.counter('a_total', 'a')
+    assert registry.counter('a_total', 'a').labels() is registry.counter('a_total', 'a').labels()
@@ -0,0 +1,93 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from starlette_context import context
+
+from reddwarf.middlewares import AuthMiddleware
+from reddwarf.utils import auth
+from reddwarf.utils.auth import token_cache
+
+SECRET = 'test-secret'
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(auth, '_secret', SECRET)
+    token_cache.clear()
+    yield
+    token_cache.clear()
+
+
+def make_token(secret=SECRET, **user):
+    return jwt.encode(
+        {**user, "expire_at": str((datetime.now() + timedelta(hours=1)).timestamp())}, secret, algorithm='HS256'
+    )
+
+
+async def endpoint(scope, receive, send):
+    body = repr(sorted(context.data.items())).encode()
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def call(path='/rpc/echo', headers=()):
+    """(status, headers, body) of one request through AuthMiddleware"""
+    app = AuthMiddleware(endpoint, no_auth_routes=['/rpc/login'])
+    scope = {'type': 'http', 'method': 'POST', 'path': path, 'headers': [(k.encode(), v.encode()) for k, v in headers]}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+    asyncio.run(app(scope, receive, send))
+    start, body = messages
+    return start['status'], dict(start['headers']), body['body']
+
+
+@pytest.mark.parametrize('headers', [(), [('authorization', 'Token abc')], [('authorization', 'Bearer')]])
+def test_missing_or_malformed_header(headers):
+    assert call(headers=headers) == (200, {
+        b'content-type': b'application/json', b'content-length': b'18',
+    }, b'{"auth":"invalid"}')
+
+
+@pytest.mark.parametrize('token', ['not-a-jwt.x.y', make_token(secret='other', username='a')])
+def test_bad_token(token):
+    status, _, body = call(headers=[('authorization', f'Bearer {token}')])
+    assert (status, body) == (403, b'{"auth":"invalid"}')
+
+
+def test_valid_token_fills_the_context():
+    status, headers, body = call(headers=[('authorization', f"Bearer {make_token(username='alice')}")])
+    assert status == 200
+    assert b"('username', 'alice')" in body
+    assert headers[b'x-request-id'].decode() in body.decode()
+
+
+def test_no_auth_path():
+    status, headers, body = call('/rpc/login')
+    assert status == 200
+    assert b'username' not in body
+    uuid.UUID(headers[b'x-request-id'].decode())
+    uuid.UUID(headers[b'x-correlation-id'].decode())
+
+
+def test_request_id_is_echoed():
+    request_id, correlation_id = str(uuid.uuid4()), str(uuid.uuid4())
+    _, headers, body = call('/rpc/login', [('x-request-id', request_id), ('x-correlation-id', correlation_id)])
+    assert headers[b'x-request-id'] == request_id.encode()
+    assert headers[b'x-correlation-id'] == correlation_id.encode()
+    assert request_id in body.decode()
+
+
+@pytest.mark.parametrize('header', ['x-request-id', 'x-correlation-id'])
+def test_invalid_uuid(header):
+    status, headers, body = call('/rpc/login', [(header, 'not-a-uuid')])
+    assert status == 400
+    assert headers[b'content-type'] == b'text/plain; charset=utf-8'
+    assert body.decode().lower().endswith(header)
@@ -0,0 +1,225 @@
+import asyncio
+
+import pytest
+
+from reddwarf.services import mysql_service
+from reddwarf.services.mysql_service import (
+    MySQLPool, MySQLPoolTimeout, NestedTransactionError, db_pool_wait_seconds, select_many_in, transaction,
+)
+from reddwarf.utils.sql import InvalidSQLBuilderInstruction
+
+
+class FakeCursor:
+    """returns one (value,) row per value of the IN list"""
+    description = [('id',)]
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, params):
+        self.connection.log.append('select')
+        self.rows = [(value,) for param in params.values() if isinstance(param, (list, tuple)) for value in param]
+
+    async def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.log = []
+        self.healthy = True
+
+    async def ping(self, reconnect=False):
+        if not self.healthy:
+            raise ConnectionError("gone away")
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def begin(self):
+        self.log.append('begin')
+
+    async def commit(self):
+        self.log.append('commit')
+
+    async def rollback(self):
+        self.log.append('rollback')
+
+
+def test_nested_transaction_on_the_same_connection_joins():
+    dbc = FakeConnection()
+
+    async def scenario():
+        async with transaction(dbc):
+            async with transaction(dbc):
+                pass
+    asyncio.run(scenario())
+    assert dbc.log == ['begin', 'commit']
+
+
+def test_nested_transaction_on_another_connection_is_rejected():
+    outer, inner = FakeConnection(), FakeConnection()
+
+    async def scenario():
+        async with transaction(outer):
+            async with transaction(inner):
+                pass
+    with pytest.raises(NestedTransactionError):
+        asyncio.run(scenario())
+    assert outer.log == ['begin', 'rollback']
+    assert inner.log == []
+
+
+class FakePool:
+    """aiomysql.Pool opening connections on demand up to maxsize, records how many were out at once"""
+    def __init__(self, maxsize, minsize=1):
+        self.maxsize = maxsize
+        self.size = 0
+        self._free = asyncio.Queue()
+        for _ in range(minsize):
+            self._open()
+        self.out = 0
+        self.max_out = 0
+
+    def _open(self):
+        self.size += 1
+        self._free.put_nowait(FakeConnection())
+
+    @property
+    def freesize(self):
+        return self._free.qsize()
+
+    async def acquire(self):
+        if self._free.empty() and self.size < self.maxsize:
+            self._open()
+        conn = await self._free.get()
+        self.out += 1
+        self.max_out = max(self.max_out, self.out)
+        # let the other chunks ask for their connection
+        await asyncio.sleep(0)
+        return conn
+
+    def release(self, conn):
+        self.out -= 1
+        self._free.put_nowait(conn)
+
+
+@pytest.fixture
+def pool():
+    pool = MySQLPool()
+
+    async def create(maxsize, acquire_timeout=1):
+        await pool.create_mysql_pool(
+            host='127.0.0.1', port=3306, user='test', password='test', db='test',
+            loop=asyncio.get_running_loop(), maxsize=maxsize, acquire_timeout=acquire_timeout, lazy=True,
+        )
+        pool._pool = FakePool(maxsize)
+        return pool
+    yield create
+    pool.__dict__.clear()
+
+
+def test_select_many_in_leaves_a_connection_to_the_caller(pool):
+    async def scenario():
+        mysql = await pool(maxsize=2)
+        async with mysql.acquire():
+            rows = await select_many_in(mysql, 'orders', 'id', range(10), chunk_size=3, concurrency=4)
+        assert [row['id'] for row in rows] == list(range(10))
+        assert mysql._pool.max_out == 2
+    asyncio.run(scenario())
+
+
+def test_select_many_in_without_acquire_timeout_uses_one_connection(pool):
+    async def scenario():
+        mysql = await pool(maxsize=4, acquire_timeout=None)
+        rows = await select_many_in(mysql, 'orders', 'id', range(5), chunk_size=2)
+        assert [row['id'] for row in rows] == list(range(5))
+        assert mysql._pool.max_out == 1
+        mysql._pool.max_out = 0
+        dbc = FakeConnection()
+        rows = await select_many_in(mysql, 'orders', 'id', [1, 2, 3], chunk_size=2, dbc=dbc)
+        assert [row['id'] for row in rows] == [1, 2, 3]
+        assert dbc.log == ['select', 'select']
+        assert mysql._pool.max_out == 0
+    asyncio.run(scenario())
+
+
+def test_select_many_in_rejects_booleans(pool):
+    async def scenario():
+        mysql = await pool(maxsize=4)
+        rows = await select_many_in(mysql, 'orders', 'id', [1, 2, 1, 2.0])
+        assert [row['id'] for row in rows] == [1, 2]
+        with pytest.raises(InvalidSQLBuilderInstruction):
+            await select_many_in(mysql, 'orders', 'id', [1, True])
+        with pytest.raises(InvalidSQLBuilderInstruction):
+            await select_many_in(mysql, 'orders', 'id', [1, None])
+    asyncio.run(scenario())
+
+
+def test_acquire_timeout_and_waiters(pool):
+    async def scenario():
+        mysql = await pool(maxsize=1, acquire_timeout=0.05)
+        waited = db_pool_wait_seconds.labels().count
+        async with mysql.acquire():
+            waiter = asyncio.get_running_loop().create_task(mysql.acquire().__aenter__())
+            await asyncio.sleep(0.01)
+            assert mysql.get_stats()['waiters'] == 1
+            with pytest.raises(MySQLPoolTimeout):
+                await waiter
+        stats = mysql.get_stats()
+        assert (stats['waiters'], stats['acquire_timeouts'], stats['in_use'], stats['idle']) == (0, 1, 0, 1)
+        assert db_pool_wait_seconds.labels().count == waited + 2
+        assert stats['acquire_latency']['sum'] >= 0.05
+    asyncio.run(scenario())
+
+
+def test_lazy_pool_connects_on_first_acquire(pool, monkeypatch):
+    created = []
+
+    async def create_pool(**settings):
+        created.append(settings)
+        return FakePool(settings['maxsize'], settings['minsize'])
+    monkeypatch.setattr(mysql_service.aiomysql, 'create_pool', create_pool)
+
+    async def scenario():
+        mysql = await pool(maxsize=4)
+        mysql._pool = None
+        assert mysql.get_stats()['connected'] is False
+        held = [mysql.acquire() for _ in range(3)]
+        await asyncio.gather(*(cm.__aenter__() for cm in held))
+        assert len(created) == 1 and created[0]['db'] == 'test'
+        assert mysql.get_stats()['in_use'] == 3
+        for cm in held:
+            await cm.__aexit__(None, None, None)
+    asyncio.run(scenario())
+
+
+def test_warm_up_opens_up_to_maxsize(pool):
+    async def scenario():
+        mysql = await pool(maxsize=3)
+        await mysql.warm_up(2)
+        assert (mysql._pool.size, mysql._pool.freesize) == (2, 2)
+        await mysql.warm_up(10)
+        assert (mysql._pool.size, mysql._pool.freesize) == (3, 3)
+    asyncio.run(scenario())
+
+
+def test_health_check(pool):
+    async def scenario():
+        mysql = await pool(maxsize=1)
+        checker = asyncio.get_running_loop().create_task(mysql._health_check(0.01))
+        await asyncio.sleep(0.03)
+        assert mysql.get_stats()['healthy'] is True
+        mysql._pool._free._queue[0].healthy = False
+        await asyncio.sleep(0.03)
+        checker.cancel()
+        stats = mysql.get_stats()
+        assert stats['healthy'] is False and stats['health_check_failures'] >= 1
+    asyncio.run(scenario())
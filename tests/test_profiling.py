@@ -0,0 +1,12 @@
+from reddwarf.utils.profiling import PROFILE_HEADER, RPCProfiler
+
+
+def test_header_only_profiles_authenticated_calls():
+    profiler = RPCProfiler(allow_header=True)
+    headers = {PROFILE_HEADER: '1'}
+    assert profiler.wants(headers)
+    assert not profiler.wants(headers, authenticated=False)
+    assert not profiler.wants({})
+    # no-auth routes are still sampled
+    profiler.configure(sample_rate=1.0)
+    assert profiler.wants({}, authenticated=False)
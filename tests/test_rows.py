@@ -0,0 +1,55 @@
+from array import array
+
+import pytest
+
+from reddwarf.utils.rows import RowFormat, format_rows, row_class, row_formatter
+
+COLS = ['id', 'price', 'name']
+ROWS = [(1, 1.5, 'a'), (2, 2.5, 'b')]
+
+
+def test_dict_and_tuple():
+    assert format_rows(COLS, ROWS) == [{'id': 1, 'price': 1.5, 'name': 'a'}, {'id': 2, 'price': 2.5, 'name': 'b'}]
+    assert format_rows(COLS, ROWS, RowFormat.TUPLE) == {'columns': COLS, 'rows': ROWS}
+
+
+def test_named_rows_share_one_class():
+    rows = format_rows(COLS, ROWS, 'named')
+    assert rows[1].name == 'b' and rows[0].price == 1.5
+    assert type(rows[0]) is row_class(('id', 'price', 'name'))
+    # invalid identifiers are renamed instead of failing
+    assert format_rows(['id', 'count(*)'], [(1, 2)], RowFormat.NAMED)[0]._1 == 2
+
+
+def test_columns_and_arrays():
+    assert format_rows(COLS, ROWS, RowFormat.COLUMNS) == {'id': [1, 2], 'price': [1.5, 2.5], 'name': ['a', 'b']}
+    packed = format_rows(COLS, ROWS, RowFormat.ARRAYS)
+    assert packed['id'] == array('q', [1, 2])
+    assert packed['price'] == array('d', [1.5, 2.5])
+    assert packed['name'] == ['a', 'b']
+
+
+def test_arrays_fall_back_to_lists():
+    rows = [(2 ** 63, 1, None), (1, 2.0, None)]
+    packed = format_rows(['big', 'mixed', 'empty'], rows, RowFormat.ARRAYS)
+    # does not fit int64, mixed int and float, not numbers
+    assert packed == {'big': [2 ** 63, 1], 'mixed': [1, 2.0], 'empty': [None, None]}
+
+
+@pytest.mark.parametrize('row_format, empty', [
+    (RowFormat.DICT, []),
+    (RowFormat.TUPLE, {'columns': COLS, 'rows': []}),
+    (RowFormat.NAMED, []),
+    (RowFormat.COLUMNS, {'id': [], 'price': [], 'name': []}),
+    (RowFormat.ARRAYS, {'id': [], 'price': [], 'name': []}),
+])
+def test_empty_result(row_format, empty):
+    assert format_rows(COLS, [], row_format) == empty
+
+
+def test_row_formatter():
+    assert row_formatter(COLS)(ROWS[0]) == {'id': 1, 'price': 1.5, 'name': 'a'}
+    assert row_formatter(COLS, RowFormat.TUPLE)([1, 1.5, 'a']) == (1, 1.5, 'a')
+    assert row_formatter(COLS, RowFormat.NAMED)(ROWS[0]).id == 1
+    with pytest.raises(ValueError):
+        row_formatter(COLS, RowFormat.COLUMNS)
@@ -0,0 +1,57 @@
+import asyncio
+
+from reddwarf.utils import codec
+from reddwarf.utils.rpc import (
+    DispatchPlan, RPCDispatcher, INVALID_PARAMS, INVALID_REQUEST, METHOD_NOT_FOUND, PARSE_ERROR,
+)
+
+
+async def add(a: int, b: int = 0):
+    return a + b
+
+
+async def fail():
+    raise RuntimeError("boom")
+
+
+def make_dispatcher(**kwargs) -> RPCDispatcher:
+    dispatcher = RPCDispatcher(**kwargs)
+    dispatcher.register(DispatchPlan(add))
+    dispatcher.register(DispatchPlan(fail))
+    return dispatcher
+
+
+def handle(dispatcher, payload):
+    return asyncio.run(dispatcher.handle(codec.dumps(payload)))
+
+
+def test_batch_answers_in_order_and_skips_notifications():
+    errors = []
+    dispatcher = make_dispatcher(on_error=lambda plan, e: errors.append(plan.name))
+    response = handle(dispatcher, [
+        {"jsonrpc": "2.0", "method": "add", "params": {"a": 1, "b": 2}, "id": 1},
+        {"jsonrpc": "2.0", "method": "add", "params": [5]},
+        {"jsonrpc": "2.0", "method": "fail", "id": "x"},
+        {"jsonrpc": "2.0", "method": "add", "params": [2, 3], "id": 3},
+    ])
+    assert [r["id"] for r in response] == [1, "x", 3]
+    assert response[0]["result"] == 3
+    assert response[1]["error"]["code"] == -32603
+    assert response[2]["result"] == 5
+    assert errors == ["fail"]
+
+
+def test_errors():
+    dispatcher = make_dispatcher(max_batch=2)
+    assert asyncio.run(dispatcher.handle(b'{'))["error"]["code"] == PARSE_ERROR
+    assert handle(dispatcher, [])["error"]["code"] == INVALID_REQUEST
+    assert handle(dispatcher, [{}, {}, {}])["error"]["code"] == INVALID_REQUEST
+    assert handle(dispatcher, {"method": "add", "id": 1})["error"]["code"] == INVALID_REQUEST
+    assert handle(dispatcher, {"jsonrpc": "2.0", "method": "nope", "id": 1})["error"]["code"] == METHOD_NOT_FOUND
+    assert handle(dispatcher, {"jsonrpc": "2.0", "method": "add", "id": 1})["error"]["code"] == INVALID_PARAMS
+    assert handle(dispatcher, {"jsonrpc": "2.0", "method": "add", "params": [1, 2, 3], "id": 1})["error"]["code"] == INVALID_PARAMS
+
+
+def test_only_notifications_get_no_response():
+    dispatcher = make_dispatcher()
+    assert handle(dispatcher, [{"jsonrpc": "2.0", "method": "add", "params": [1]}]) is None
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from reddwarf.server import RedDwarf
+from reddwarf.services.config_service import BaseConfig
+from reddwarf.utils.metrics import registry
+
+CONFIG = """
+[DEFAULT]
+secret = test-secret
+log_file = server.log
+lazy_services = true
+
+[MySQL]
+db_host = 127.0.0.1
+db_user = test
+db_password = test
+db_name = test
+
+[Redis]
+db_host = 127.0.0.1
+"""
+
+
+class PoolStandIn:
+    """a pool that waits for the other one to start, which only happens when they start concurrently"""
+    def __init__(self, name, other, events, started):
+        self.name = name
+        self.other = other
+        self.events = events
+        self.started = started
+
+    async def create_mysql_pool(self, **kwargs):
+        await self.initialize(**kwargs)
+
+    async def initialize(self, *args, lazy=None, **kwargs):
+        self.events.append((f'{self.name} start', lazy))
+        self.started[self.name].set()
+        await asyncio.wait_for(self.started[self.other].wait(), 1)
+
+    def get_pool(self):
+        return None
+
+    async def close(self):
+        self.events.append(f'{self.name} close')
+
+
+class ServiceStandIn:
+    """write buffer, query cache and websocket manager"""
+    def __init__(self, events):
+        self.events = events
+
+    def initialize(self, *args, **kwargs):
+        pass
+
+    async def close_all(self, code):
+        self.events.append(('close_all', code))
+
+    async def flush(self):
+        self.events.append('flush')
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('ENV', 'test')
+    (tmp_path / 'config-test.ini').write_text(CONFIG)
+    previous = BaseConfig.__dict__.get('instance')
+    if previous is not None:
+        del BaseConfig.instance
+    gauges = dict(registry._gauges)
+    server = RedDwarf(routes=[], ws_routes=[], no_auth_routes=[])
+    yield server
+    server.get_logger().shutdown()
+    registry._gauges = gauges
+    del BaseConfig.instance
+    if previous is not None:
+        BaseConfig.instance = previous
+
+
+def test_lifespan_order(server):
+    events = []
+
+    async def lifespan():
+        started = {'mysql': asyncio.Event(), 'redis': asyncio.Event()}
+        server._mysql_pool = PoolStandIn('mysql', 'redis', events, started)
+        server._redis_pool = PoolStandIn('redis', 'mysql', events, started)
+        server._write_coalescer = server._query_cache = server._ws_connection = ServiceStandIn(events)
+        messages = asyncio.Queue()
+        for message in ('lifespan.startup', 'lifespan.shutdown'):
+            messages.put_nowait({'type': message})
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+        await server._app({'type': 'lifespan'}, messages.get, send)
+        return sent
+    sent = asyncio.run(lifespan())
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert set(events[:2]) == {('mysql start', True), ('redis start', None)}
+    # websockets are closed before buffered rows are written out, the pools close last
+    assert events[2:4] == [('close_all', 1001), 'flush']
+    assert set(events[4:]) == {'mysql close', 'redis close'}
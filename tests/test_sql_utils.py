@@ -0,0 +1,140 @@
+import pytest
+
+from reddwarf.utils.sql import (
+    SQLDialect, InvalidSQLBuilderInstruction,
+    build_select_query, build_delete_query, build_update_query, build_keyset, normalize_order_by,
+    build_insert_query, build_bulk_update_query,
+    compile_select_query, compile_update_query, compile_delete_query,
+    clear_template_cache, template_cache_info, IntList, build_where,
+)
+
+
+def test_build_select_query_inlines_literals():
+    sql = build_select_query('users', cols=['id', 'name'], where={'id': 1, 'name': 'a'}, limit=10)
+    assert sql == "SELECT id, name FROM users WHERE id = 1 AND name = 'a' LIMIT 10"
+
+
+def test_compile_select_query_binds_params():
+    sql, params = compile_select_query(
+        'users', cols=['id'], where={'id': [1, 2], 'age': {'>': 18, '<': 30}, 'name': 'a'},
+        limit=10, offset=20,
+    )
+    assert sql == (
+        "SELECT id FROM users "
+        "WHERE id IN %(p0)s AND age > %(p1)s AND age < %(p2)s AND name = %(p3)s "
+        "LIMIT %(limit)s OFFSET %(offset)s"
+    )
+    assert params == {'p0': (1, 2), 'p1': 18, 'p2': 30, 'p3': 'a', 'limit': 10, 'offset': 20}
+
+
+def test_compile_select_query_reuses_template_per_shape():
+    clear_template_cache()
+    first, first_params = compile_select_query('users', where={'id': [1, 2, 3]}, limit=1)
+    second, second_params = compile_select_query('users', where={'id': [4]}, limit=5)
+    assert first is second
+    assert first_params == {'p0': (1, 2, 3), 'limit': 1}
+    assert second_params == {'p0': (4,), 'limit': 5}
+    assert template_cache_info()['select']['hits'] == 1
+
+
+def test_compile_select_query_aggregates_do_not_mutate_cols():
+    cols = [{'aggr': 'count', 'col': 'id', 'as': 'n'}]
+    sql, _ = compile_select_query('users', cols=cols, group_by=['name'])
+    assert sql.startswith("SELECT count(id) n FROM users")
+    assert cols == [{'aggr': 'count', 'col': 'id', 'as': 'n'}]
+
+
+def test_compile_select_query_clickhouse_regexp():
+    sql, params = compile_select_query('logs', where={'msg': {'regexp': '^err'}}, dialect=SQLDialect.ClickHouse)
+    assert sql == "SELECT * FROM logs WHERE match(msg, %(p0)s)"
+    assert params == {'p0': '^err'}
+
+
+def test_compile_select_query_rejects_invalid_window():
+    with pytest.raises(InvalidSQLBuilderInstruction):
+        compile_select_query('users', limit='10')
+
+
+def test_compile_update_and_delete_query():
+    sql, params = compile_update_query('users', {'id': 3}, {'name': 'b', 'age': 4})
+    assert sql == "UPDATE users SET name=%(v0)s,age=%(v1)s WHERE id = %(p0)s"
+    assert params == {'v0': 'b', 'v1': 4, 'p0': 3}
+    assert build_update_query('users', {'id': 3}, {'name': 'b'}) == "UPDATE users SET name='b' WHERE id = 3"
+
+    sql, params = compile_delete_query('users', {'id': [1, 2]})
+    assert sql == "DELETE FROM users WHERE id IN %(p0)s"
+    assert params == {'p0': (1, 2)}
+    assert build_delete_query('users', {'id': [1, 2]}) == "DELETE FROM users WHERE id IN (1,2)"
+
+
+def test_build_select_query_clause_order():
+    sql = build_select_query(
+        'orders', cols=[{'aggr': 'sum', 'col': 'total'}], group_by=['user_id'],
+        order_by=[('user_id', 'desc')], limit=5,
+    )
+    assert sql == "SELECT sum(total) total FROM orders GROUP BY user_id ORDER BY user_id DESC LIMIT 5"
+
+
+def test_keyset_single_direction_uses_row_comparison():
+    sql = build_select_query('events', where={'kind': 'a'}, order_by=['ts', 'id'], after={'ts': 5, 'id': 9}, limit=2)
+    assert sql == "SELECT * FROM events WHERE kind = 'a' AND (ts, id) > (5, 9) ORDER BY ts ASC, id ASC LIMIT 2"
+
+    sql, params = compile_select_query('events', order_by=[('id', 'DESC')], after=[9], limit=2)
+    assert sql == "SELECT * FROM events WHERE id < %(k0)s ORDER BY id DESC LIMIT %(limit)s"
+    assert params == {'k0': 9, 'limit': 2}
+
+
+def test_keyset_mixed_directions_expands():
+    order = normalize_order_by([('ts', 'DESC'), 'id'])
+    assert build_keyset(order, ['%(k0)s', '%(k1)s']) == "((ts < %(k0)s) OR (ts = %(k0)s AND id > %(k1)s))"
+
+
+def test_keyset_requires_matching_order_by():
+    with pytest.raises(InvalidSQLBuilderInstruction):
+        compile_select_query('events', after=[1])
+    with pytest.raises(InvalidSQLBuilderInstruction):
+        compile_select_query('events', order_by=['ts', 'id'], after=[1])
+
+
+def test_build_insert_query_on_duplicate():
+    sql, _ = build_insert_query('users', [{'id': 1, 'name': 'a'}], on_duplicate=['name'])
+    assert sql == "INSERT INTO users(id,name) VALUES (%(id)s,%(name)s) ON DUPLICATE KEY UPDATE name=VALUES(name)"
+
+
+def test_build_bulk_update_query():
+    sql, params = build_bulk_update_query('users', 'id', [{'id': 1, 'name': 'a', 'age': 3}, {'id': 2, 'name': 'b'}])
+    assert sql == (
+        "UPDATE users SET "
+        "name = CASE id WHEN %(k0)s THEN %(c0_0)s WHEN %(k1)s THEN %(c0_1)s ELSE name END, "
+        "age = CASE id WHEN %(k0)s THEN %(c1_0)s ELSE age END "
+        "WHERE id IN %(keys)s"
+    )
+    assert params == {'k0': 1, 'k1': 2, 'keys': (1, 2), 'c0_0': 'a', 'c0_1': 'b', 'c1_0': 3}
+    with pytest.raises(InvalidSQLBuilderInstruction):
+        build_bulk_update_query('users', 'id', [{'name': 'a'}])
+
+
+def test_int_in_lists_take_the_fast_path():
+    _, params = compile_select_query('users', where={'id': [3, 1, 2], 'name': ['a', 1], 'flag': [True]})
+    assert type(params['p0']) is IntList
+    assert type(params['p1']) is tuple and type(params['p2']) is tuple
+    assert build_where({'id': [0, 1, 2], 'name': ['a', 1]}, SQLDialect.MySQL) == "WHERE id IN (0,1,2) AND name IN ('a',1)"
+
+
+def test_compiled_templates_escape_percent():
+    month = "DATE_FORMAT(created_at, '%Y-%m')"
+    sql, params = compile_select_query(
+        'orders', cols=[f"{month} AS month", {'aggr': 'count', 'col': 'id'}], group_by=[month],
+        order_by=[(month, 'DESC')],
+    )
+    assert params == {}
+    # what the driver does with the params, {} included
+    assert sql % params == (
+        f"SELECT {month} AS month, count(id) id FROM orders GROUP BY {month} ORDER BY {month} DESC"
+    )
+    sql, params = compile_select_query('orders', where={"note LIKE '%x'": 1, 'id': [1, 2]})
+    assert sql % params == "SELECT * FROM orders WHERE note LIKE '%x' = 1 AND id IN (1, 2)"
+    sql, params = compile_delete_query('t%x', {'id': 1})
+    assert sql % params == "DELETE FROM t%x WHERE id = 1"
+    # built statements run without params, nothing to escape
+    assert build_delete_query('t%x', {'id': 1}) == "DELETE FROM t%x WHERE id = 1"
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import signal
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from hypercorn.config import Config
+
+from reddwarf.services.logger_service import BaseLogger
+from reddwarf.supervisor import WorkerSupervisor
+
+
+class FakeConfig:
+    def __init__(self, workers, host, reloaded=None):
+        self.settings = SimpleNamespace(default=SimpleNamespace(workers=workers, host=host, reuse_port=False))
+        self.reloaded = reloaded
+
+    def reload(self):
+        if self.reloaded is not None:
+            self.settings.default.__dict__.update(self.reloaded)
+        return self.settings
+
+
+class FakeServer:
+    """run_worker exits with exit_code, or serves nothing until SIGTERM"""
+    def __init__(self, workers=1, host='127.0.0.1', exit_code=None, reloaded=None):
+        self._config = FakeConfig(workers, host, reloaded)
+        self._loop = None
+        self.exit_code = exit_code
+
+    def get_logger(self):
+        return BaseLogger()
+
+    def share_logger(self, context):
+        return None
+
+    def get_hypercorn_config(self):
+        config = Config()
+        config.bind = [f"{self._config.settings.default.host}:0"]
+        config.graceful_timeout = 1
+        return config
+
+    def run_worker(self, config, shutdown_trigger, log_queue=None):
+        if self.exit_code is not None:
+            raise SystemExit(self.exit_code)
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(shutdown_trigger())
+
+
+class RecordingSupervisor(WorkerSupervisor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spawned = []
+
+    def _spawn(self, config, sockets):
+        self.spawned.append((time.monotonic(), [sock.getsockname()[0] for sock in sockets]))
+        return super()._spawn(config, sockets)
+
+
+def test_backoff():
+    supervisor = WorkerSupervisor(FakeServer(), check_interval=0.5, max_backoff=4)
+    assert [supervisor.backoff(crashes) for crashes in range(6)] == [0.0, 0.5, 1.0, 2.0, 4.0, 4.0]
+
+
+def test_crash_loop_gives_up():
+    supervisor = RecordingSupervisor(FakeServer(exit_code=3), check_interval=0.02, max_crashes=4)
+    with pytest.raises(SystemExit):
+        supervisor.run()
+    started = [at for at, _ in supervisor.spawned]
+    assert len(started) == 4
+    gaps = [b - a for a, b in zip(started, started[1:])]
+    assert gaps[1] >= 0.04 and gaps[2] >= 0.08
+
+
+def test_sighup_applies_bind_and_workers():
+    server = FakeServer(workers=1, host='127.0.0.1', reloaded={'workers': 2, 'host': '127.0.0.2'})
+    supervisor = RecordingSupervisor(server, check_interval=0.02)
+    pid = os.getpid()
+    threading.Timer(0.3, os.kill, (pid, signal.SIGHUP)).start()
+    threading.Timer(1.0, os.kill, (pid, signal.SIGTERM)).start()
+    supervisor.run()
+    assert [hosts for _, hosts in supervisor.spawned] == [['127.0.0.1'], ['127.0.0.2'], ['127.0.0.2']]
+    assert all(process.exitcode == 0 for process in supervisor._processes)
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from reddwarf.endpoints.websocket_endpoint import ConcurrentWebsocketHandler, push_notification
+from reddwarf.services.websocket_service import WSConnectionManager
+from reddwarf.utils import codec
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(codec.loads(text))
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+
+class SlowHandler(ConcurrentWebsocketHandler):
+    """handlers wait until their message id is released"""
+    max_in_flight = 2
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.authenticated = True
+        self.released: dict[int, asyncio.Event] = {}
+        self.batches = []
+
+    @staticmethod
+    def get_endpoint():
+        return 'slow'
+
+    async def handle_received_message(self, message):
+        await self.released.setdefault(message['id'], asyncio.Event()).wait()
+        return {'id': message['id']}
+
+    async def handle_batch(self, messages: list):
+        self.batches.append([message['id'] for message in messages])
+        return [message['id'] for message in messages]
+
+    def release(self, n):
+        self.released.setdefault(n, asyncio.Event()).set()
+
+
+async def _noop(*_):
+    pass
+
+
+def create(handler_class, **attrs):
+    handler_class = type(handler_class.__name__, (handler_class,), attrs)
+    return handler_class({'type': 'websocket'}, _noop, _noop)
+
+
+@pytest.fixture
+def manager():
+    manager = WSConnectionManager()
+    manager.initialize()
+    yield manager
+    manager.__dict__.clear()
+
+
+def test_in_flight_limit_and_backpressure():
+    async def scenario():
+        handler, websocket = create(SlowHandler), FakeWebSocket()
+        await handler.on_receive(websocket, '{"id": 1}')
+        await handler.on_receive(websocket, '{"id": 2}')
+        assert handler.in_flight == 2
+        # every slot is taken, the third frame is not read until one frees up
+        third = asyncio.create_task(handler.on_receive(websocket, '{"id": 3}'))
+        await asyncio.sleep(0.01)
+        assert not third.done() and handler.in_flight == 2
+        handler.release(2)
+        await asyncio.wait_for(third, 1)
+        # replies go out as handlers finish, not in receive order
+        handler.release(3)
+        handler.release(1)
+        while handler.in_flight:
+            await asyncio.sleep(0)
+        assert websocket.sent == [{'id': 2}, {'id': 3}, {'id': 1}]
+    asyncio.run(scenario())
+
+
+def test_invalid_frame():
+    async def scenario():
+        handler, websocket = create(SlowHandler), FakeWebSocket()
+        await handler.on_receive(websocket, 'not json')
+        assert websocket.sent == [{'error': 'invalid message'}]
+        assert handler.in_flight == 0
+    asyncio.run(scenario())
+
+
+def test_batches():
+    async def scenario():
+        handler, websocket = create(SlowHandler, batch_size=2, batch_delay=0.01), FakeWebSocket()
+        for n in range(3):
+            await handler.on_receive(websocket, codec.dumps({'id': n}).decode())
+        # the partial batch is handed over after batch_delay
+        await asyncio.sleep(0.05)
+        while handler.in_flight:
+            await asyncio.sleep(0)
+        assert handler.batches == [[0, 1], [2]]
+        assert websocket.sent == [[0, 1], [2]]
+    asyncio.run(scenario())
+
+
+def test_push_notification(manager):
+    async def scenario():
+        websocket = FakeWebSocket()
+        manager.register_connection('alice::rpc', websocket)
+        assert push_notification('alice', 'updated', {'n': 1})
+        assert not push_notification('bob', 'updated')
+        await asyncio.sleep(0)
+        assert websocket.sent == [{'jsonrpc': '2.0', 'method': 'updated', 'params': {'n': 1}}]
+        await manager.close_all()
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from reddwarf.exceptions import TooManyConnections
+from reddwarf.services.websocket_service import SLOW_CONSUMER_CLOSE_CODE, WSConnectionManager
+
+
+class FakeWebSocket:
+    """send_text blocks until released, like a client that stopped reading"""
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+        self.released = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.released.wait()
+        self.sent.append(text)
+
+    async def close(self, code=1000, reason=None):
+        self.closed = code
+
+
+@pytest.fixture
+def manager():
+    manager = WSConnectionManager()
+    manager.initialize(max_clients=2, send_queue_size=2)
+    yield manager
+    manager.__dict__.clear()
+
+
+def test_max_clients(manager):
+    async def scenario():
+        manager.register_connection('a::feed', FakeWebSocket())
+        manager.register_connection('b::feed', FakeWebSocket())
+        # reconnecting replaces the connection instead of counting twice
+        manager.register_connection('a::feed', FakeWebSocket())
+        with pytest.raises(TooManyConnections):
+            manager.register_connection('c::feed', FakeWebSocket())
+        assert manager.count() == 2
+        await manager.close_all()
+    asyncio.run(scenario())
+
+
+def test_slow_consumer_is_evicted(manager):
+    async def scenario():
+        slow, fast = FakeWebSocket(), FakeWebSocket()
+        fast.released.set()
+        manager.register_connection('slow::feed', slow)
+        manager.register_connection('fast::feed', fast)
+        await asyncio.sleep(0)
+        # the sender holds one message, the queue two more, the fourth does not fit
+        queued = []
+        for n in range(4):
+            queued.append(manager.broadcast({'n': n}, endpoint='feed'))
+            await asyncio.sleep(0)
+        assert queued == [2, 2, 2, 1]
+        assert manager.get_connection('slow::feed') is None
+        assert manager.get_stats()['closing'] == 1
+        await manager.close_all()
+        assert slow.closed == SLOW_CONSUMER_CLOSE_CODE
+        assert manager.get_stats()['closing'] == 0
+        assert manager.evicted == 1
+        assert len(fast.sent) == 4
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from reddwarf.services.cache_service import QueryCache
+from reddwarf.services.write_buffer import WriteCoalescer
+
+
+class BadRow(Exception):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.max_stmt_length = 1024000
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, row):
+        await self.executemany(sql, [row])
+
+    async def executemany(self, sql, rows):
+        if any(row.get('name') == 'bad' for row in rows):
+            raise BadRow(sql)
+        self.conn.pending.extend(rows)
+
+
+class FakeConnection:
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    async def begin(self):
+        self.pending = []
+
+    async def commit(self):
+        self.table.extend(self.pending)
+        self.pending = []
+
+    async def rollback(self):
+        self.pending = []
+
+
+class FakePool:
+    def __init__(self):
+        self.table = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection(self.table)
+
+
+class BrokenRedis:
+    async def smembers(self, key):
+        raise ConnectionError("redis is down")
+
+
+@pytest.fixture
+def coalescer():
+    coalescer = WriteCoalescer()
+    pool = FakePool()
+    coalescer.initialize(pool, max_batch=100, max_delay=0.001)
+    yield coalescer, pool
+    coalescer.__dict__.clear()
+
+
+async def insert_all(coalescer, rows):
+    return await asyncio.gather(*(coalescer.insert('users', row) for row in rows), return_exceptions=True)
+
+
+def test_failed_batch_reports_per_caller(coalescer):
+    coalescer, pool = coalescer
+    rows = [{'name': 'a'}, {'name': 'bad'}, {'name': 'c'}]
+    results = asyncio.run(insert_all(coalescer, rows))
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], BadRow)
+    assert pool.table == [{'name': 'a'}, {'name': 'c'}]
+    assert coalescer.get_stats()['fallbacks'] == 1
+
+
+def test_failure_after_commit_does_not_rewrite(coalescer):
+    coalescer, pool = coalescer
+    cache = QueryCache()
+    cache.initialize(redis=BrokenRedis())
+    try:
+        rows = [{'name': str(i)} for i in range(4)]
+        assert asyncio.run(insert_all(coalescer, rows)) == [None] * 4
+    finally:
+        cache.__dict__.clear()
+    assert pool.table == rows
+    assert coalescer.get_stats()['batches'] == 1 and coalescer.get_stats()['fallbacks'] == 0
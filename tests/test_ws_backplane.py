@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+from reddwarf.services.websocket_service import WSConnectionManager
+from reddwarf.services.ws_backplane import WSBackplane
+
+
+class FakeRedis:
+    """the directory hash, alive keys and the unregister script, decode_responses=True"""
+    def __init__(self):
+        self.hashes: dict[str, dict] = {}
+        self.values: dict[str, str] = {}
+
+    async def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    async def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    async def eval(self, script, numkeys, key, field, node):
+        entries = self.hashes.get(key, {})
+        if entries.get(field) == node:
+            del entries[field]
+            return 1
+        return 0
+
+
+class FakeWebSocket:
+    async def send_text(self, text):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+
+@pytest.fixture
+def backplane():
+    manager = WSConnectionManager()
+    manager.initialize()
+    backplane = WSBackplane()
+    redis = FakeRedis()
+    backplane.initialize(redis, manager)
+    manager.backplane = backplane
+    yield backplane, manager, redis
+    manager.__dict__.clear()
+    backplane.__dict__.clear()
+
+
+def test_reconnect_within_one_flush_stays_registered(backplane):
+    backplane, manager, redis = backplane
+
+    async def scenario():
+        manager.register_connection('alice::feed', FakeWebSocket())
+        await backplane.flush()
+        # a disconnect and a reconnect, then a takeover, all before the next flush
+        manager.unregister_connection('alice::feed')
+        manager.register_connection('alice::feed', FakeWebSocket())
+        manager.register_connection('alice::feed', FakeWebSocket())
+        manager.register_connection('bob::feed', FakeWebSocket())
+        manager.unregister_connection('bob::feed')
+        await backplane.flush()
+        await manager.close_all()
+    asyncio.run(scenario())
+    assert redis.hashes['rdw:ws:conn'] == {'alice::feed': backplane.node_id}
+
+
+def test_failed_flush_keeps_membership(backplane):
+    backplane, manager, redis = backplane
+
+    async def broken(*args, **kwargs):
+        raise ConnectionError("redis is down")
+
+    async def scenario():
+        manager.register_connection('alice::feed', FakeWebSocket())
+        backplane.send('bob::feed', {'hi': 1})
+        hset, redis.hset = redis.hset, broken
+        with pytest.raises(ConnectionError):
+            await backplane.flush()
+        # the message for bob is still buffered for the next flush
+        assert backplane.get_stats()['pending'] == 1
+        redis.hset = hset
+        await backplane.flush()
+        await manager.close_all()
+    asyncio.run(scenario())
+    assert redis.hashes['rdw:ws:conn'] == {'alice::feed': backplane.node_id}
+    assert backplane.get_stats()['pending'] == 0 and backplane.undeliverable == 1
+
+
+def test_entries_of_dead_nodes_are_dropped(backplane):
+    backplane, manager, redis = backplane
+    redis.hashes['rdw:ws:conn'] = {'bob::feed': 'dead', 'carol::feed': 'dead'}
+
+    async def scenario():
+        backplane.send('bob::feed', {'hi': 1})
+        await backplane.flush()
+    asyncio.run(scenario())
+    # the dead node never refreshed rdw:ws:alive:dead, nothing is published to it
+    assert backplane.undeliverable == 1 and backplane.published == 0
+    assert redis.hashes['rdw:ws:conn'] == {'carol::feed': 'dead'}
+
+
+class FlakyPubSub:
+    """the first subscription drops, the next one delivers a broadcast from another node"""
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def subscribe(self, *channels):
+        self.redis.subscriptions += 1
+
+    async def close(self):
+        pass
+
+    async def listen(self):
+        if self.redis.subscriptions == 1:
+            raise ConnectionError("connection lost")
+        yield {'type': 'message', 'data': '{"n":"other","m":[{"u":"alice","p":{"hi":1}}]}'}
+        self.redis.received.set()
+        await asyncio.Event().wait()
+
+
+def test_listener_resubscribes(backplane):
+    backplane, manager, redis = backplane
+    redis.subscriptions = 0
+    redis.pubsub = lambda: FlakyPubSub(redis)
+
+    async def scenario():
+        redis.received = asyncio.Event()
+        manager.register_connection('alice::feed', FakeWebSocket())
+        await backplane._subscribe()
+        listener = asyncio.get_running_loop().create_task(backplane._listen())
+        await asyncio.wait_for(redis.received.wait(), 2)
+        listener.cancel()
+        await manager.close_all()
+    asyncio.run(scenario())
+    assert backplane.reconnects == 1 and backplane.delivered == 1